@@ -0,0 +1,212 @@
+"""
+Pipeline asynchrone (asyncio + httpx) pour le rafraîchissement TikTok et Instagram
+Les appels indépendants d'un même compte partent en parallèle, et de nombreux
+comptes sont traités simultanément sous un sémaphore.
+"""
+
+import os
+import asyncio
+import httpx
+from lib import tiktok, instagram
+from lib.http_client import GOVERNED_HOSTS, observe_response
+from lib.quota import QuotaExceededError, get_governor
+from lib.resilience import (
+    IDEMPOTENT_METHODS,
+    RETRY_ATTEMPTS,
+    RETRY_STATUSES,
+    CircuitOpenError,
+    backoff_delay,
+    get_breaker,
+)
+
+# Active le pipeline asynchrone dans le cron (sinon: un thread par compte)
+ASYNC_REFRESH = os.getenv('ASYNC_REFRESH', 'true').lower() == 'true'
+# Nombre de comptes rafraîchis simultanément par boucle asyncio
+ASYNC_REFRESH_CONCURRENCY = int(os.getenv('ASYNC_REFRESH_CONCURRENCY', '20'))
+ASYNC_HTTP_TIMEOUT = float(os.getenv('HTTP_DEFAULT_TIMEOUT', '20'))
+
+
+async def _request(client: httpx.AsyncClient, method: str, url: str,
+                   idempotent: bool | None = None, **kwargs) -> httpx.Response:
+    """Équivalent asynchrone de http_client.request (retries avec jitter + disjoncteur)."""
+    breaker = get_breaker(httpx.URL(url).host)
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    retries = RETRY_ATTEMPTS if idempotent else 0
+
+    for attempt in range(retries + 1):
+        breaker.before_call()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except (httpx.TimeoutException, httpx.NetworkError):
+            breaker.record_failure()
+            if attempt >= retries:
+                raise
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+        except httpx.HTTPError:
+            # Erreur de protocole ou de décodage : échec non retenté
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Rejet du gouverneur (hook de requête, rien n'a été envoyé), annulation... :
+            # libère l'essai semi-ouvert éventuel
+            breaker.cancel_call()
+            raise
+
+        if response.status_code in RETRY_STATUSES:
+            breaker.record_failure()
+            if attempt < retries:
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+        else:
+            breaker.record_success()
+        return response
+
+
+# ========================
+# TIKTOK
+# ========================
+
+async def _fetch_tiktok_user(client: httpx.AsyncClient, access_token: str, fields: str) -> dict:
+    response = await _request(
+        client, 'GET', tiktok.TIKTOK_USER_INFO_URL,
+        headers={"Authorization": f"Bearer {access_token}"},
+        params={"fields": fields}
+    )
+    response.raise_for_status()
+    return response.json().get("data", {}).get("user", {})
+
+
+async def _get_tiktok_user_with_fallback(client: httpx.AsyncClient, access_token: str) -> tuple[dict, bool]:
+    try:
+        return await _fetch_tiktok_user(client, access_token, tiktok.TIKTOK_USER_FIELDS), True
+    except httpx.HTTPStatusError as exc:
+        if exc.response.status_code not in (401, 403):
+            raise
+
+    basic_user = await _fetch_tiktok_user(client, access_token, tiktok.TIKTOK_USER_BASIC_FIELDS)
+    return basic_user, False
+
+
+async def _fetch_tiktok_video_insights(client: httpx.AsyncClient, access_token: str,
+                                       max_count: int = 20, recent_limit: int = 6) -> tuple:
+    try:
+        response = await _request(
+            client, 'POST', tiktok.TIKTOK_VIDEO_LIST_URL, idempotent=True,
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json"
+            },
+            params={"fields": tiktok.TIKTOK_VIDEO_FIELDS},
+            json={"max_count": max_count}
+        )
+        response.raise_for_status()
+    except httpx.HTTPError:
+        return None, None, 0, False, []
+
+    return tiktok._parse_video_insights(response.json() or {}, recent_limit)
+
+
+async def update_tiktok_stats_async(client: httpx.AsyncClient, user_id: str, tokens: dict,
+                                    writer=None, previous_hash: str | None = None) -> dict:
+    """Variante asynchrone de tiktok.update_tiktok_stats (profil et vidéos en parallèle)."""
+    access_token = tokens["accessToken"]
+
+    # Rafraîchir le token si nécessaire (coordonné avec les autres appelants)
+    if tiktok._token_expired(tokens):
+        refreshed = await asyncio.to_thread(tiktok.ensure_fresh_tiktok_tokens, user_id, tokens)
+        access_token = refreshed["accessToken"]
+
+    (user, has_stats_access), insights = await asyncio.gather(
+        _get_tiktok_user_with_fallback(client, access_token),
+        _fetch_tiktok_video_insights(client, access_token)
+    )
+
+    return await asyncio.to_thread(
+        tiktok._persist_tiktok_stats, user_id, user, has_stats_access, insights,
+        writer, previous_hash
+    )
+
+
+# ========================
+# INSTAGRAM
+# ========================
+
+async def update_instagram_stats_async(client: httpx.AsyncClient, user_id: str, tokens: dict,
+                                       writer=None, previous_hash: str | None = None) -> dict:
+    """Variante asynchrone de instagram.update_instagram_stats."""
+    if instagram._token_expired(tokens):
+        return {'success': False, 'error': 'Token expired'}
+
+    profile_url, profile_params = instagram._profile_request(tokens)
+    response = await _request(client, 'GET', profile_url, params=profile_params)
+    response.raise_for_status()
+
+    return await asyncio.to_thread(
+        instagram._persist_instagram_stats, user_id, response.json(), writer, previous_hash
+    )
+
+
+# ========================
+# EXÉCUTION
+# ========================
+
+async def _acquire_quota(request: httpx.Request) -> None:
+    platform = GOVERNED_HOSTS.get(request.url.host)
+    if platform:
+        await get_governor(platform).acquire_async()
+
+
+async def _observe_quota(response: httpx.Response) -> None:
+    platform = GOVERNED_HOSTS.get(response.request.url.host)
+    if not platform:
+        return
+    payload = None
+    if response.status_code >= 400:
+        await response.aread()
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = None
+    observe_response(platform, response.status_code, response.headers, payload)
+
+
+async def _refresh_many(handler, jobs, writer=None, concurrency: int = ASYNC_REFRESH_CONCURRENCY) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency)
+    # Chaque requête passe par le gouverneur de quota de sa plateforme
+    event_hooks = {'request': [_acquire_quota], 'response': [_observe_quota]}
+
+    async with httpx.AsyncClient(timeout=ASYNC_HTTP_TIMEOUT, limits=limits, event_hooks=event_hooks) as client:
+        async def _refresh_one(user_id, tokens, previous_hash):
+            async with semaphore:
+                try:
+                    result = await handler(client, user_id, tokens, writer=writer, previous_hash=previous_hash)
+                except (QuotaExceededError, CircuitOpenError) as exc:
+                    # Compte reporté au prochain passage
+                    result = {'success': False, 'skipped': True, 'error': str(exc)}
+                except Exception as exc:
+                    print(f"Erreur rafraîchissement asynchrone pour {user_id}: {str(exc)}")
+                    result = {'success': False, 'error': str(exc)}
+                return user_id, result
+
+        results = await asyncio.gather(*(_refresh_one(*job) for job in jobs))
+    return dict(results)
+
+
+def run_async_refresh(handler, jobs, writer=None, concurrency: int = ASYNC_REFRESH_CONCURRENCY) -> dict:
+    """
+    Point d'entrée synchrone : exécute `handler` pour chaque job
+    (user_id, tokens, previous_hash) dans une boucle asyncio dédiée.
+    Retourne {user_id: résultat}.
+    """
+    return asyncio.run(_refresh_many(handler, jobs, writer=writer, concurrency=concurrency))
+
+
+def update_tiktok_stats_many(jobs, writer=None) -> dict:
+    return run_async_refresh(update_tiktok_stats_async, jobs, writer=writer)
+
+
+def update_instagram_stats_many(jobs, writer=None) -> dict:
+    return run_async_refresh(update_instagram_stats_async, jobs, writer=writer)
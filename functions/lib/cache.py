@@ -0,0 +1,52 @@
+"""
+Cache mémoire LRU + TTL, partagé par les invocations d'une même instance
+Borné en nombre d'entrées, chaque entrée expire après son TTL.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Cache thread-safe : éviction LRU au-delà de `maxsize`, expiration par entrée."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
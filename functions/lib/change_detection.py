@@ -0,0 +1,29 @@
+"""
+Détection de changement pour les rafraîchissements de stats
+Évite de réécrire un profil (et de réveiller les listeners du frontend)
+quand les statistiques récupérées sont identiques à celles stockées.
+"""
+
+import os
+import json
+import hashlib
+from firebase_admin import firestore
+
+# Si activé, un rafraîchissement sans changement écrit seulement `lastChecked`
+HEARTBEAT_ON_UNCHANGED = os.getenv('STATS_HEARTBEAT_ON_UNCHANGED', 'false').lower() == 'true'
+
+
+def stats_fingerprint(stats: dict, video_ids=()) -> str:
+    """Empreinte stable des stats d'un compte et des IDs de ses vidéos récentes."""
+    payload = json.dumps({
+        'stats': stats,
+        'videos': [str(video_id) for video_id in video_ids]
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def heartbeat_update(platform: str) -> dict | None:
+    """Champs écrits quand rien n'a changé (None = aucune écriture)."""
+    if not HEARTBEAT_ON_UNCHANGED:
+        return None
+    return {f'socialAccounts.{platform}.lastChecked': firestore.SERVER_TIMESTAMP}
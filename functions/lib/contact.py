@@ -3,7 +3,7 @@ Module pour gérer l'envoi d'emails de contact via Resend
 """
 
 import os
-import requests
+from lib import http_client
 from firebase_admin import firestore
 
 RESEND_API_URL = 'https://api.resend.com/emails'
@@ -136,7 +136,7 @@ def send_contact_email(user_type, name, email, subject, message):
         user_type_fr = "Marque" if user_type == "marque" else "Influenceur"
         email_subject = f"[{user_type_fr}] {subject}"
 
-        response = requests.post(
+        response = http_client.post(
             RESEND_API_URL,
             headers={
                 'Authorization': f'Bearer {resend_api_key}',
@@ -0,0 +1,151 @@
+"""
+Conversations marque <-> influenceur
+Une seule conversation par couple, stockée sous l'ID déterministe
+`conversations/{brandId}_{influencerId}` : son existence se vérifie par lecture
+directe (ou création conditionnelle) au lieu d'une requête sur brandId/influencerId.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.write_buffer import MAX_WRITE_ATTEMPTS
+
+CONVERSATIONS_COLLECTION = 'conversations'
+MESSAGES_SUBCOLLECTION = 'messages'
+GET_ALL_CHUNK_SIZE = 100
+
+
+def conversation_id(brand_id: str, influencer_id: str) -> str:
+    return f'{brand_id}_{influencer_id}'
+
+
+def conversation_ref(db, brand_id: str, influencer_id: str):
+    return db.collection(CONVERSATIONS_COLLECTION).document(conversation_id(brand_id, influencer_id))
+
+
+def _create_if_absent(reference, data: dict) -> bool:
+    from google.api_core.exceptions import AlreadyExists
+
+    try:
+        reference.create(data)
+        return True
+    except AlreadyExists:
+        # Créée entre-temps par une requête concurrente
+        return False
+
+
+def ensure_conversations(db, brand_id: str, conversations: dict) -> int:
+    """
+    Crée les conversations absentes pour une marque.
+
+    Args:
+        conversations: {influencer_id: données de la conversation à créer}
+
+    Returns:
+        Nombre de conversations créées
+    """
+    refs = {influencer_id: conversation_ref(db, brand_id, influencer_id) for influencer_id in conversations}
+    if not refs:
+        return 0
+
+    # Existence vérifiée en un get_all (lecture des IDs seulement)
+    existing = set()
+    ref_list = list(refs.values())
+    for start in range(0, len(ref_list), GET_ALL_CHUNK_SIZE):
+        for snapshot in db.get_all(ref_list[start:start + GET_ALL_CHUNK_SIZE], field_paths=['brandId']):
+            if snapshot.exists:
+                existing.add(snapshot.id)
+
+    missing = [
+        (ref, conversations[influencer_id])
+        for influencer_id, ref in refs.items()
+        if ref.id not in existing
+    ]
+    if not missing:
+        return 0
+
+    # create() échoue si le document existe déjà : pas de doublon en cas de course
+    with ThreadPoolExecutor(max_workers=min(8, len(missing))) as executor:
+        created = list(executor.map(lambda job: _create_if_absent(*job), missing))
+    return sum(created)
+
+
+def _latest(conversations: list[dict]) -> dict:
+    """Conversation la plus récemment active d'un groupe de doublons."""
+    def _last_activity(data):
+        return data.get('lastMessageAt') or data.get('createdAt')
+
+    dated = [data for data in conversations if _last_activity(data) is not None]
+    if not dated:
+        return conversations[0]
+    return max(dated, key=_last_activity)
+
+
+def migrate_conversation_ids(db) -> dict:
+    """
+    Migration ponctuelle : déplace les conversations à ID aléatoire vers leur ID
+    déterministe, messages compris. Les doublons d'un même couple sont fusionnés
+    (dernier message le plus récent, date de création la plus ancienne).
+    Les anciens documents ne sont supprimés qu'une fois toutes les copies écrites.
+
+    Retourne {'migrated': conversations déplacées, 'messages': messages copiés,
+    'failed': écritures en échec}.
+    """
+    groups = {}
+    for snapshot in db.collection(CONVERSATIONS_COLLECTION).stream():
+        data = snapshot.to_dict() or {}
+        brand_id = data.get('brandId')
+        influencer_id = data.get('influencerId')
+        if not brand_id or not influencer_id:
+            continue
+        groups.setdefault((brand_id, influencer_id), []).append((snapshot.reference, data))
+
+    summary = {'migrated': 0, 'messages': 0, 'failed': 0}
+    to_delete = []
+
+    def _on_write_error(error, bulk_writer) -> bool:
+        if getattr(error, 'attempts', MAX_WRITE_ATTEMPTS) < MAX_WRITE_ATTEMPTS:
+            return True
+        summary['failed'] += 1
+        print(f"❌ Écriture impossible sur {error.operation.reference.path}: {error.message}")
+        return False
+
+    # 1) Copie vers les IDs déterministes
+    writer = db.bulk_writer()
+    writer.on_write_error(_on_write_error)
+    for (brand_id, influencer_id), entries in groups.items():
+        target = conversation_ref(db, brand_id, influencer_id)
+        legacy = [ref for ref, _ in entries if ref.id != target.id]
+        if not legacy:
+            continue
+
+        all_data = [data for _, data in entries]
+        merged = dict(_latest(all_data))
+        created_at = [data['createdAt'] for data in all_data if data.get('createdAt') is not None]
+        if created_at:
+            merged['createdAt'] = min(created_at)
+        writer.set(target, merged)
+
+        for ref in legacy:
+            # Les IDs de messages sont aléatoires : conservés tels quels à la copie
+            for message in ref.collection(MESSAGES_SUBCOLLECTION).stream():
+                writer.set(target.collection(MESSAGES_SUBCOLLECTION).document(message.id), message.to_dict() or {})
+                to_delete.append(message.reference)
+                summary['messages'] += 1
+            to_delete.append(ref)
+            summary['migrated'] += 1
+    writer.close()
+
+    if summary['failed']:
+        print("⚠️ Copie incomplète : anciennes conversations conservées, relancer la migration")
+        return summary
+
+    # 2) Suppression des anciens documents (messages avant leur conversation)
+    writer = db.bulk_writer()
+    writer.on_write_error(_on_write_error)
+    for reference in to_delete:
+        writer.delete(reference)
+    writer.close()
+
+    print(f"✅ Conversations migrées vers un ID déterministe: {summary['migrated']} "
+          f"({summary['messages']} messages)")
+    return summary
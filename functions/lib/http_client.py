@@ -0,0 +1,147 @@
+"""
+Client HTTP partagé pour les intégrations Collabzz
+Session keep-alive réutilisée entre invocations, pools de connexions par hôte,
+timeouts par défaut, retries avec jitter pour les appels idempotents et
+disjoncteur par hôte (voir lib/resilience.py).
+"""
+
+import os
+import time
+import threading
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from lib.quota import get_governor, is_graph_rate_limited, retry_after_seconds
+from lib.resilience import (
+    IDEMPOTENT_METHODS,
+    RETRY_ATTEMPTS,
+    RETRY_STATUSES,
+    backoff_delay,
+    get_breaker,
+)
+
+DEFAULT_TIMEOUT = float(os.getenv('HTTP_DEFAULT_TIMEOUT', '20'))
+# Timeout d'établissement de connexion, court pour détecter vite un hôte injoignable
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+
+# Taille des pools de connexions par hôte (≈ nombre d'appels simultanés vers cet hôte)
+HOST_POOL_SIZES = {
+    'https://open.tiktokapis.com': int(os.getenv('HTTP_POOL_SIZE_TIKTOK', '16')),
+    'https://graph.facebook.com': int(os.getenv('HTTP_POOL_SIZE_GRAPH', '16')),
+    'https://api.resend.com': int(os.getenv('HTTP_POOL_SIZE_RESEND', '8')),
+    'https://api.stripe.com': int(os.getenv('HTTP_POOL_SIZE_STRIPE', '8')),
+}
+DEFAULT_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE_DEFAULT', '8'))
+
+# Hôtes dont le débit est régulé par le gouverneur de quota de la plateforme
+GOVERNED_HOSTS = {
+    'open.tiktokapis.com': 'tiktok',
+    'graph.facebook.com': 'instagram',
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _adapter(pool_size: int) -> HTTPAdapter:
+    # Les retries sont gérés dans request() (jitter + disjoncteur), pas par urllib3
+    return HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=0
+    )
+
+
+def get_session() -> requests.Session:
+    """Session partagée par toute l'instance (connexions TCP+TLS réutilisées)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.mount('https://', _adapter(DEFAULT_POOL_SIZE))
+                for prefix, pool_size in HOST_POOL_SIZES.items():
+                    session.mount(prefix, _adapter(pool_size))
+                _session = session
+    return _session
+
+
+def observe_response(platform: str, status_code: int, headers, payload) -> None:
+    """Informe le gouverneur de la plateforme d'un succès ou d'une limite de débit."""
+    governor = get_governor(platform)
+    if is_graph_rate_limited(status_code, payload):
+        governor.on_throttled(retry_after_seconds(headers))
+    elif status_code < 400:
+        governor.on_success()
+
+
+def _observe_quota(platform: str, response: requests.Response) -> None:
+    payload = None
+    if response.status_code >= 400:
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = None
+    observe_response(platform, response.status_code, response.headers, payload)
+
+
+def request(method: str, url: str, timeout: float | None = None,
+            idempotent: bool | None = None, **kwargs) -> requests.Response:
+    """
+    Envoie une requête via la session partagée avec les timeouts par défaut.
+
+    - Les appels vers une API gouvernée attendent un jeton de quota (QuotaExceededError sinon).
+    - Les appels idempotents (GET..., ou `idempotent=True` pour un POST de lecture ou
+      muni d'une clé d'idempotence) sont retentés sur timeout, erreur de connexion et 5xx.
+    - Le disjoncteur de l'hôte court-circuite les appels (CircuitOpenError) tant
+      que le fournisseur est considéré comme indisponible.
+    """
+    host = urlsplit(url).hostname or ''
+    platform = GOVERNED_HOSTS.get(host)
+    breaker = get_breaker(host)
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    retries = RETRY_ATTEMPTS if idempotent else 0
+    timeouts = (CONNECT_TIMEOUT, timeout or DEFAULT_TIMEOUT)
+
+    for attempt in range(retries + 1):
+        if platform:
+            get_governor(platform).acquire()
+        breaker.before_call()
+
+        try:
+            response = get_session().request(method, url, timeout=timeouts, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            breaker.record_failure()
+            if attempt >= retries:
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        except requests.RequestException:
+            # Réponse illisible, redirections en boucle... : échec non retenté
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Aucune issue à enregistrer : libère l'essai semi-ouvert éventuel
+            breaker.cancel_call()
+            raise
+
+        if platform:
+            _observe_quota(platform, response)
+        if response.status_code in RETRY_STATUSES:
+            breaker.record_failure()
+            if attempt < retries:
+                response.close()
+                time.sleep(backoff_delay(attempt))
+                continue
+        else:
+            breaker.record_success()
+        return response
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
@@ -4,10 +4,15 @@ Gestion de l'OAuth et récupération des statistiques
 """
 
 import os
-import requests
+from lib import http_client
 from firebase_admin import firestore
 from datetime import datetime, timedelta
 from lib.token_store import save_tokens
+from lib.token_refresh import refresh_tokens_once
+from lib.write_buffer import write_update
+from lib.change_detection import stats_fingerprint, heartbeat_update
+from lib.quota import QuotaExceededError
+from lib.resilience import CircuitOpenError
 
 # Configuration Facebook/Instagram OAuth (via Facebook Graph API)
 # Priorité : variables d'environnement > valeurs par défaut
@@ -78,7 +83,8 @@ def instagram_callback(code: str, user_id: str) -> dict:
         'code': code
     }
     
-    token_response = requests.get(token_url, params=token_params)
+    # Code d'autorisation à usage unique : pas de retry (un succès perdu le consommerait)
+    token_response = http_client.get(token_url, params=token_params, idempotent=False)
     token_json = token_response.json()
     
     # Log pour debug
@@ -105,7 +111,7 @@ def instagram_callback(code: str, user_id: str) -> dict:
         'fields': 'id,name,access_token'
     }
     
-    pages_response = requests.get(pages_url, params=pages_params)
+    pages_response = http_client.get(pages_url, params=pages_params)
     pages_response.raise_for_status()
     pages_json = pages_response.json()
     
@@ -124,7 +130,7 @@ def instagram_callback(code: str, user_id: str) -> dict:
         'access_token': page_access_token
     }
     
-    instagram_response = requests.get(instagram_account_url, params=instagram_params)
+    instagram_response = http_client.get(instagram_account_url, params=instagram_params)
     instagram_response.raise_for_status()
     instagram_json = instagram_response.json()
     
@@ -140,7 +146,7 @@ def instagram_callback(code: str, user_id: str) -> dict:
         'access_token': page_access_token
     }
     
-    ig_response = requests.get(ig_profile_url, params=ig_params)
+    ig_response = http_client.get(ig_profile_url, params=ig_params)
     ig_response.raise_for_status()
     ig_profile = ig_response.json()
     
@@ -158,7 +164,7 @@ def instagram_callback(code: str, user_id: str) -> dict:
         'fb_exchange_token': page_access_token
     }
     
-    long_token_response = requests.get(long_token_url, params=long_token_params)
+    long_token_response = http_client.get(long_token_url, params=long_token_params, idempotent=False)
     long_token_response.raise_for_status()
     long_token_json = long_token_response.json()
     
@@ -183,7 +189,8 @@ def instagram_callback(code: str, user_id: str) -> dict:
             'profilePicture': profile_picture,
             'pageId': page_id,
             'lastUpdated': firestore.SERVER_TIMESTAMP
-        }
+        },
+        'connectedPlatforms': firestore.ArrayUnion(['instagram'])
     })
 
     save_tokens(user_id, 'instagram', {
@@ -202,56 +209,127 @@ def instagram_callback(code: str, user_id: str) -> dict:
     }
 
 
-def update_instagram_stats(user_id: str, tokens: dict) -> dict:
+INSTAGRAM_PROFILE_FIELDS = 'username,followers_count,follows_count,media_count'
+
+# Renouvellement du long-lived token (60 jours) quand il expire dans moins de N jours
+INSTAGRAM_RENEWAL_WINDOW_DAYS = int(os.getenv('INSTAGRAM_RENEWAL_WINDOW_DAYS', '10'))
+
+
+def _token_expired(tokens: dict) -> bool:
+    expires_at = tokens.get('expiresAt')
+    return bool(expires_at) and datetime.now() >= expires_at.replace(tzinfo=None)
+
+
+def token_needs_renewal(tokens: dict, margin: timedelta | None = None) -> bool:
+    """Vrai si le token est encore valide mais expire dans la fenêtre de renouvellement."""
+    expires_at = tokens.get('expiresAt')
+    if not expires_at or _token_expired(tokens):
+        return False
+    if margin is None:
+        margin = timedelta(days=INSTAGRAM_RENEWAL_WINDOW_DAYS)
+    return datetime.now() + margin >= expires_at.replace(tzinfo=None)
+
+
+def _request_token_renewal(tokens: dict) -> dict:
+    """Appel fb_exchange_token ; retourne les tokens renouvelés (non sauvegardés)."""
+    response = http_client.get(FACEBOOK_TOKEN_URL, params={
+        'grant_type': 'fb_exchange_token',
+        'client_id': INSTAGRAM_CLIENT_ID,
+        'client_secret': INSTAGRAM_CLIENT_SECRET,
+        'fb_exchange_token': tokens.get('accessToken')
+    }, idempotent=False)
+    response.raise_for_status()
+    token_json = response.json()
+    
+    expires_in = token_json.get('expires_in', 5184000)  # 60 jours par défaut
+    return {
+        **tokens,
+        'accessToken': token_json.get('access_token', tokens.get('accessToken')),
+        'expiresAt': datetime.now() + timedelta(seconds=expires_in),
+        'renewedAt': firestore.SERVER_TIMESTAMP
+    }
+
+
+def ensure_fresh_instagram_tokens(user_id: str, tokens: dict, margin: timedelta | None = None) -> dict:
+    """Renouvelle (une seule fois, sous bail) un token qui expire dans la fenêtre."""
+    return refresh_tokens_once(
+        user_id, 'instagram', tokens,
+        lambda current: token_needs_renewal(current, margin),
+        _request_token_renewal
+    )
+
+
+def _profile_request(tokens: dict) -> tuple[str, dict]:
+    """URL et paramètres de la requête Graph API des stats du compte."""
+    profile_url = f'https://graph.facebook.com/v21.0/{tokens.get("instagramId")}'
+    profile_params = {
+        'fields': INSTAGRAM_PROFILE_FIELDS,
+        'access_token': tokens.get('accessToken')
+    }
+    return profile_url, profile_params
+
+
+def _persist_instagram_stats(user_id: str, profile_json: dict, writer=None,
+                             previous_hash: str | None = None) -> dict:
+    """Écrit les stats Instagram (si elles ont changé) et retourne le résultat."""
+    followers = profile_json.get('followers_count', 0)
+    media_count = profile_json.get('media_count', 0)
+    
+    # Mettre à jour Firestore uniquement si les stats ont changé
+    db = firestore.client()
+    user_ref = db.collection('influencers').document(user_id)
+    
+    stats_hash = stats_fingerprint({'followers': followers, 'mediaCount': media_count})
+    changed = stats_hash != previous_hash
+    if changed:
+        write_update(user_ref, {
+            'socialAccounts.instagram.followers': followers,
+            'socialAccounts.instagram.mediaCount': media_count,
+            'socialAccounts.instagram.statsHash': stats_hash,
+            'socialAccounts.instagram.lastUpdated': firestore.SERVER_TIMESTAMP
+        }, writer=writer, tag=('instagram', user_id))
+    elif heartbeat_update('instagram'):
+        write_update(user_ref, heartbeat_update('instagram'), writer=writer, tag=('instagram', user_id))
+    
+    return {
+        'success': True,
+        'changed': changed,
+        'followers': followers,
+        'mediaCount': media_count
+    }
+
+
+def update_instagram_stats(user_id: str, tokens: dict, writer=None, previous_hash: str | None = None) -> dict:
     """
     Met à jour les statistiques Instagram Business (appelé quotidiennement)
     
     Args:
         user_id: ID de l'utilisateur Firebase
         tokens: Dictionnaire avec les tokens Instagram
+        writer: DeferredWriter optionnel pour différer les écritures Firestore
+        previous_hash: Empreinte stockée des stats, pour ignorer les écritures sans changement
         
     Returns:
         Résultat de la mise à jour
     """
     try:
-        access_token = tokens.get('accessToken')
-        expires_at = tokens.get('expiresAt')
-        instagram_id = tokens.get('instagramId')
-        
         # Vérifier si le token a expiré
-        if expires_at and datetime.now() >= expires_at.replace(tzinfo=None):
+        if _token_expired(tokens):
             return {'success': False, 'error': 'Token expired'}
         
         # Récupérer les stats mises à jour depuis l'API Facebook Graph
-        profile_url = f'https://graph.facebook.com/v21.0/{instagram_id}'
-        profile_params = {
-            'fields': 'username,followers_count,follows_count,media_count',
-            'access_token': access_token
-        }
-        
-        profile_response = requests.get(profile_url, params=profile_params)
+        profile_url, profile_params = _profile_request(tokens)
+        profile_response = http_client.get(profile_url, params=profile_params)
         profile_response.raise_for_status()
-        profile_json = profile_response.json()
-        
-        followers = profile_json.get('followers_count', 0)
-        media_count = profile_json.get('media_count', 0)
-        
-        # Mettre à jour Firestore
-        db = firestore.client()
-        user_ref = db.collection('influencers').document(user_id)
         
-        user_ref.update({
-            'socialAccounts.instagram.followers': followers,
-            'socialAccounts.instagram.mediaCount': media_count,
-            'socialAccounts.instagram.lastUpdated': firestore.SERVER_TIMESTAMP
-        })
-        
-        return {
-            'success': True,
-            'followers': followers,
-            'mediaCount': media_count
-        }
+        return _persist_instagram_stats(
+            user_id, profile_response.json(),
+            writer=writer, previous_hash=previous_hash
+        )
         
+    except (QuotaExceededError, CircuitOpenError):
+        # Compte reporté : ce n'est pas une erreur du compte
+        raise
     except Exception as e:
         print(f"Erreur mise à jour Instagram pour {user_id}: {str(e)}")
         return {'success': False, 'error': str(e)}
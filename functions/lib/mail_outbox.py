@@ -0,0 +1,390 @@
+"""
+Outbox des emails transactionnels
+Les handlers écrivent le message dans `mailOutbox/{id}` dans le même lot que
+leurs écritures métier ; l'envoi se fait hors requête :
+- le trigger de création du document envoie immédiatement les emails urgents
+  (code de vérification, bienvenue) ;
+- les notifications de collaboration attendent une courte fenêtre de regroupement,
+  puis le balayage planifié fusionne celles d'un même destinataire en un digest
+  et envoie le tout par l'endpoint batch de Resend (100 emails par appel). La
+  fenêtre court depuis la première notification en attente du destinataire :
+  celles arrivées pendant cette fenêtre partent dans le même digest ;
+- ce même balayage reprend les envois en échec transitoire ou interrompus.
+
+Chaque document est réservé par transaction avant l'envoi, et l'ID du document
+(ou des documents regroupés) sert de clé d'idempotence Resend : un message n'est
+pas envoyé deux fois même si le trigger et le balayage se chevauchent. Un lot
+est enregistré dans `mailOutboxPlans/{id}` avant son premier envoi et chaque
+message garde la référence `sendPlan` : après un échec ambigu (timeout, 5xx),
+la nouvelle tentative rejoue exactement le même lot sous la même clé.
+
+Statuts : pending → sending → sent | failed. `nextAttemptAt` (absent une fois
+le message terminé) porte la prochaine tentative ou la fin de la réservation.
+"""
+
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+
+OUTBOX_COLLECTION = 'mailOutbox'
+# Composition des lots envoyés (rejouée à l'identique en cas de nouvelle tentative)
+OUTBOX_PLANS_COLLECTION = 'mailOutboxPlans'
+
+MAIL_MAX_ATTEMPTS = int(os.getenv('MAIL_MAX_ATTEMPTS', '6'))
+MAIL_RETRY_BASE_SECONDS = int(os.getenv('MAIL_RETRY_BASE_SECONDS', '60'))
+MAIL_RETRY_MAX_SECONDS = int(os.getenv('MAIL_RETRY_MAX_SECONDS', '3600'))
+# Durée de réservation d'un message : au-delà, un envoi interrompu est repris
+MAIL_SEND_LEASE_SECONDS = int(os.getenv('MAIL_SEND_LEASE_SECONDS', '120'))
+MAIL_DRAIN_BATCH_SIZE = int(os.getenv('MAIL_DRAIN_BATCH_SIZE', '500'))
+# Appels batch Resend simultanés (l'API limite le nombre de requêtes par seconde)
+MAIL_SEND_CONCURRENCY = int(os.getenv('MAIL_SEND_CONCURRENCY', '2'))
+# Fenêtre de regroupement, comptée depuis la première notification en attente d'un destinataire
+MAIL_COALESCE_WINDOW_SECONDS = int(os.getenv('MAIL_COALESCE_WINDOW_SECONDS', '60'))
+
+# Types de messages regroupables ; les autres partent dès leur écriture
+COALESCED_KINDS = frozenset({'collaboration_request', 'collaboration_response'})
+CLAIMABLE_STATUSES = ('pending', 'sending')
+# Champs d'un message construit par lib.notifications
+EMAIL_FIELDS = ('kind', 'to', 'subject', 'title', 'bodyHtml', 'ctaUrl', 'ctaLabel')
+# Réservation par transaction : lectures et écritures bornées par transaction
+CLAIM_CHUNK_SIZE = 100
+# Valeurs par filtre 'in' de Firestore
+RECIPIENT_QUERY_CHUNK_SIZE = 30
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def outbox_ref(db):
+    """Référence d'un nouveau message, à écrire dans le lot des écritures métier."""
+    return db.collection(OUTBOX_COLLECTION).document()
+
+
+def is_coalesced(message: dict) -> bool:
+    return message.get('kind') in COALESCED_KINDS
+
+
+def outbox_entry(message: dict) -> dict:
+    """Document outbox d'un message construit par lib.notifications."""
+    delay = timedelta(seconds=MAIL_COALESCE_WINDOW_SECONDS) if is_coalesced(message) else timedelta(0)
+    return {
+        **message,
+        'status': 'pending',
+        'attempts': 0,
+        'nextAttemptAt': _now() + delay,
+        'createdAt': firestore.SERVER_TIMESTAMP
+    }
+
+
+def enqueue_email(db, message: dict, batch=None):
+    """Ajoute un message à l'outbox (dans `batch` s'il est fourni)."""
+    reference = outbox_ref(db)
+    if batch is not None:
+        batch.set(reference, outbox_entry(message))
+    else:
+        reference.set(outbox_entry(message))
+    return reference
+
+
+def _is_due(data: dict, now: datetime) -> bool:
+    next_attempt_at = data.get('nextAttemptAt')
+    return data.get('status') in CLAIMABLE_STATUSES and not (next_attempt_at and next_attempt_at > now)
+
+
+def _is_waiting(data: dict, now: datetime | None = None) -> bool:
+    """Notification regroupable jamais envoyée, dans sa fenêtre ou non."""
+    return (
+        data.get('status') == 'pending' and is_coalesced(data)
+        and not data.get('attempts') and not data.get('sendPlan')
+    )
+
+
+def _claim_many(db, references, is_claimable=_is_due) -> list[tuple]:
+    """
+    Réserve en une transaction les messages de `references` qui vérifient
+    `is_claimable(données, maintenant)` (par défaut : les messages dus).
+    Retourne [(reference, données)] des messages réservés.
+    """
+
+    @firestore.transactional
+    def _transaction(transaction):
+        now = _now()
+        claimed = []
+        for snapshot in transaction.get_all(references):
+            if not snapshot.exists:
+                continue
+            data = snapshot.to_dict() or {}
+            if not is_claimable(data, now):
+                continue
+            transaction.update(snapshot.reference, {
+                'status': 'sending',
+                'nextAttemptAt': now + timedelta(seconds=MAIL_SEND_LEASE_SECONDS)
+            })
+            claimed.append((snapshot.reference, data))
+        return claimed
+
+    return _transaction(db.transaction())
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(MAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1), MAIL_RETRY_MAX_SECONDS))
+
+
+def _record_result(reference, message: dict, result: dict) -> str:
+    """Enregistre le résultat d'un envoi sur le document ; retourne le nouveau statut."""
+    attempts = int(message.get('attempts', 0)) + 1
+
+    if result.get('success'):
+        reference.update({
+            'status': 'sent',
+            'attempts': attempts,
+            'sentAt': firestore.SERVER_TIMESTAMP,
+            'nextAttemptAt': firestore.DELETE_FIELD,
+            'lastError': firestore.DELETE_FIELD
+        })
+        return 'sent'
+
+    if result.get('retryable') and attempts < MAIL_MAX_ATTEMPTS:
+        reference.update({
+            'status': 'pending',
+            'attempts': attempts,
+            'nextAttemptAt': _now() + _retry_delay(attempts),
+            'lastError': result.get('error', '')
+        })
+        return 'pending'
+
+    print(f"❌ Email {message.get('kind')} abandonné pour {message.get('to')}: {result.get('error')}")
+    reference.update({
+        'status': 'failed',
+        'attempts': attempts,
+        'nextAttemptAt': firestore.DELETE_FIELD,
+        'lastError': result.get('error', '')
+    })
+    return 'failed'
+
+
+def deliver(db, reference) -> str | None:
+    """
+    Envoie un message de l'outbox s'il est dû.
+    Retourne le nouveau statut ('sent', 'pending', 'failed') ou None si rien n'a été fait.
+    """
+    from lib.notifications import send_email
+
+    claimed = _claim_many(db, [reference])
+    if not claimed:
+        return None
+
+    _, message = claimed[0]
+    result = send_email(message, idempotency_key=_idempotency_key([reference.id]))
+    return _record_result(reference, message, result)
+
+
+def _idempotency_key(message_ids) -> str:
+    if len(message_ids) == 1:
+        return f'{OUTBOX_COLLECTION}/{message_ids[0]}'
+    digest = hashlib.sha256('|'.join(sorted(message_ids)).encode('utf-8')).hexdigest()
+    return f'{OUTBOX_COLLECTION}/digest/{digest}'
+
+
+def _coalesce(claimed) -> list[tuple]:
+    """
+    Regroupe les messages réservés par destinataire.
+    Retourne [(email à envoyer, [(reference, message)])].
+    """
+    from lib.notifications import digest_email
+
+    groups = {}
+    for reference, message in sorted(claimed, key=lambda entry: entry[0].id):
+        groups.setdefault(message['to'].strip().lower(), []).append((reference, message))
+    return [(digest_email([message for _, message in entries]), entries) for entries in groups.values()]
+
+
+def _claim_waiting_siblings(db, fresh) -> list[tuple]:
+    """
+    Réserve les notifications encore dans leur fenêtre des destinataires de
+    `fresh` : la fenêtre d'un destinataire se ferme avec sa première notification
+    due, et toute la rafale part dans le même digest.
+    """
+    claimed_ids = {reference.id for reference, _ in fresh}
+    recipients = sorted({message['to'] for _, message in fresh})
+    collection = db.collection(OUTBOX_COLLECTION)
+
+    references = []
+    for start in range(0, len(recipients), RECIPIENT_QUERY_CHUNK_SIZE):
+        waiting = (
+            collection
+            .where('to', 'in', recipients[start:start + RECIPIENT_QUERY_CHUNK_SIZE])
+            .where('status', '==', 'pending')
+            .get()
+        )
+        references.extend(
+            snapshot.reference for snapshot in waiting
+            if snapshot.id not in claimed_ids and _is_waiting(snapshot.to_dict() or {})
+        )
+
+    claimed = []
+    for start in range(0, len(references), CLAIM_CHUNK_SIZE):
+        claimed.extend(_claim_many(db, references[start:start + CLAIM_CHUNK_SIZE], is_claimable=_is_waiting))
+    return claimed
+
+
+def _save_plan(db, chunk) -> tuple[str, dict]:
+    """
+    Enregistre la composition d'un lot avant son premier envoi : le lot et ses
+    clés d'idempotence sont rejoués à l'identique aux tentatives suivantes, même
+    si les messages ont entre-temps été regroupés autrement.
+    Retourne (plan_id, plan).
+    """
+    from lib.write_buffer import commit_sets
+
+    message_ids = [reference.id for _, entries in chunk for reference, _ in entries]
+    plan_id = hashlib.sha256('|'.join(sorted(message_ids)).encode('utf-8')).hexdigest()
+    plan = {
+        'key': f'{OUTBOX_COLLECTION}/batch/{plan_id}',
+        'emails': [
+            {
+                # Champs du message seulement (sans l'état de l'outbox)
+                'email': {field: email.get(field) for field in EMAIL_FIELDS},
+                'key': _idempotency_key([reference.id for reference, _ in entries]),
+                'members': [reference.id for reference, _ in entries]
+            }
+            for email, entries in chunk
+        ],
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        # Au-delà, Resend ne garantit plus l'idempotence : le plan peut être purgé (TTL)
+        'expiresAt': _now() + timedelta(days=2)
+    }
+    # Le plan d'abord : un message ne pointe jamais vers un plan absent
+    commit_sets(db, [(db.collection(OUTBOX_PLANS_COLLECTION).document(plan_id), plan, False)] + [
+        (reference, {'sendPlan': plan_id}, True)
+        for _, entries in chunk for reference, _ in entries
+    ])
+    return plan_id, plan
+
+
+def _send_plan(plan: dict, members: dict) -> dict:
+    """
+    Envoie (ou rejoue) un lot enregistré et enregistre le résultat sur les
+    messages réservés `members` ({message_id: (reference, message)}).
+    Retourne {statut: nombre}.
+    """
+    from lib.notifications import send_email, send_email_batch
+
+    emails = plan['emails']
+    if len(emails) == 1:
+        results = [send_email(emails[0]['email'], idempotency_key=emails[0]['key'])]
+    else:
+        result = send_email_batch([entry['email'] for entry in emails], idempotency_key=plan['key'])
+        if not result.get('success') and not result.get('retryable'):
+            # Lot refusé en bloc (ex. une adresse invalide) : envoi unitaire pour isoler l'erreur
+            results = [send_email(entry['email'], idempotency_key=entry['key']) for entry in emails]
+        else:
+            results = [result] * len(emails)
+
+    summary = {}
+    for entry, result in zip(emails, results):
+        for message_id in entry['members']:
+            if message_id not in members:
+                # Réservé par un autre passage : il rejouera le même plan
+                continue
+            reference, message = members[message_id]
+            status = _record_result(reference, message, result)
+            summary[status] = summary.get(status, 0) + 1
+    return summary
+
+
+def _send_single(reference, message) -> dict:
+    """Envoi unitaire avec la clé du message (celle utilisée par le trigger)."""
+    from lib.notifications import send_email
+
+    result = send_email(message, idempotency_key=_idempotency_key([reference.id]))
+    return {_record_result(reference, message, result): 1}
+
+
+def drain_outbox(db, limit: int = MAIL_DRAIN_BATCH_SIZE) -> dict:
+    """
+    Envoie les messages dus : notifications regroupées par destinataire, nouvelles
+    tentatives, réservations expirées et messages manqués par le trigger.
+
+    - Les notifications regroupables encore jamais envoyées sont fusionnées en
+      digests, avec celles de leurs destinataires encore dans la fenêtre, puis
+      réparties en lots pour l'endpoint batch ; chaque lot est enregistré avant envoi.
+    - Un message déjà rattaché à un lot rejoue ce lot (mêmes emails, mêmes clés).
+    - Les autres messages partent un par un avec leur propre clé.
+
+    Retourne {statut: nombre}.
+    """
+    from lib.notifications import RESEND_BATCH_MAX_EMAILS
+
+    due = (
+        db.collection(OUTBOX_COLLECTION)
+        .where('nextAttemptAt', '<=', _now())
+        .order_by('nextAttemptAt')
+        .limit(limit)
+        .get()
+    )
+    references = [snapshot.reference for snapshot in due]
+    claimed = []
+    for start in range(0, len(references), CLAIM_CHUNK_SIZE):
+        claimed.extend(_claim_many(db, references[start:start + CLAIM_CHUNK_SIZE]))
+    if not claimed:
+        return {}
+
+    fresh, replays, singles = [], {}, []
+    for reference, message in claimed:
+        if message.get('sendPlan'):
+            replays.setdefault(message['sendPlan'], {})[reference.id] = (reference, message)
+        elif is_coalesced(message) and message.get('to') and not message.get('attempts'):
+            fresh.append((reference, message))
+        else:
+            singles.append((reference, message))
+
+    if fresh:
+        fresh.extend(_claim_waiting_siblings(db, fresh))
+
+    # Lots déjà composés : rejoués tels quels
+    plans = []
+    plan_refs = [db.collection(OUTBOX_PLANS_COLLECTION).document(plan_id) for plan_id in replays]
+    for start in range(0, len(plan_refs), CLAIM_CHUNK_SIZE):
+        for snapshot in db.get_all(plan_refs[start:start + CLAIM_CHUNK_SIZE]):
+            if snapshot.exists:
+                plans.append((snapshot.to_dict() or {}, replays.pop(snapshot.id)))
+    for members in replays.values():
+        # Plan purgé : envoi unitaire
+        singles.extend(members.values())
+
+    outgoing = _coalesce(fresh)
+    chunks = [
+        outgoing[start:start + RESEND_BATCH_MAX_EMAILS]
+        for start in range(0, len(outgoing), RESEND_BATCH_MAX_EMAILS)
+    ]
+
+    def _send_new(chunk):
+        _, plan = _save_plan(db, chunk)
+        members = {reference.id: (reference, message) for _, entries in chunk for reference, message in entries}
+        return _send_plan(plan, members)
+
+    jobs = [(_send_new, chunk, len(chunk)) for chunk in chunks]
+    jobs += [(lambda job: _send_plan(*job), (plan, members), len(members)) for plan, members in plans]
+    jobs += [(lambda job: _send_single(*job), entry, 1) for entry in singles]
+
+    def _run(job):
+        func, arg, size = job
+        try:
+            return func(arg)
+        except Exception as exc:
+            # Réservations laissées en l'état : reprises à leur expiration
+            print(f"❌ Envoi de {size} email(s) de l'outbox impossible: {str(exc)}")
+            return {'error': size}
+
+    summary = {}
+    with ThreadPoolExecutor(max_workers=max(1, MAIL_SEND_CONCURRENCY), thread_name_prefix='mail-outbox') as executor:
+        for job_summary in executor.map(_run, jobs):
+            for status, count in job_summary.items():
+                summary[status] = summary.get(status, 0) + count
+    if len(outgoing) < len(fresh):
+        summary['coalesced'] = len(fresh) - len(outgoing)
+    return summary
@@ -1,27 +1,27 @@
 """
 Notifications par email liées aux demandes de collaboration
+Les fonctions `*_email` construisent les messages ; ils sont mis dans l'outbox
+(lib/mail_outbox.py) par les handlers puis envoyés hors requête via `send_email`
+ou, regroupés par destinataire (`digest_email`), via l'endpoint batch (`send_email_batch`).
 """
 
 import os
-import requests
+from lib import http_client
 
 RESEND_API_URL = 'https://api.resend.com/emails'
+RESEND_BATCH_URL = 'https://api.resend.com/emails/batch'
+# Limite de l'endpoint batch de Resend
+RESEND_BATCH_MAX_EMAILS = 100
 
 
-def _send_notification_email(to_email, subject, title, body_html, cta_url=None, cta_label=None):
-    resend_api_key = os.environ.get('RESEND_API_KEY')
-    sender_email = os.environ.get('RESEND_FROM_EMAIL', 'Collabzz <onboarding@resend.dev>')
-
-    if not resend_api_key or not to_email:
-        return {'success': False, 'error': 'Configuration email non disponible'}
-
+def _render_html(title, body_html, cta_url=None, cta_label=None):
     cta_html = f"""
                 <div style="text-align: center; margin-top: 30px;">
                     <a href="{cta_url}" style="background-color: #E6B067; color: white; padding: 12px 24px; border-radius: 8px; text-decoration: none; font-weight: bold; display: inline-block;">{cta_label}</a>
                 </div>
     """ if cta_url and cta_label else ""
 
-    html_content = f"""
+    return f"""
     <html>
     <body style="font-family: Arial, sans-serif; color: #333; margin: 0; padding: 0;">
         <div style="max-width: 600px; margin: 0 auto; padding: 20px; background-color: #f9f9f9;">
@@ -37,31 +37,139 @@ def _send_notification_email(to_email, subject, title, body_html, cta_url=None,
     </html>
     """
 
+
+def _notification(kind, to_email, subject, title, body_html, cta_url=None, cta_label=None):
+    """Message prêt à être mis dans l'outbox (voir lib/mail_outbox.py)."""
+    return {
+        'kind': kind,
+        'to': to_email,
+        'subject': subject,
+        'title': title,
+        'bodyHtml': body_html,
+        'ctaUrl': cta_url,
+        'ctaLabel': cta_label
+    }
+
+
+def _api_payload(message, sender_email):
+    return {
+        'from': sender_email,
+        'to': [message['to']],
+        'subject': message['subject'],
+        'html': _render_html(
+            message['title'], message['bodyHtml'], message.get('ctaUrl'), message.get('ctaLabel')
+        )
+    }
+
+
+def _post_to_resend(url, payload, idempotency_key=None):
+    """
+    POST vers Resend. Avec une clé d'idempotence, Resend ignore les renvois du
+    même contenu et l'appel peut être retenté sans risque de doublon.
+
+    Retourne {'success', 'retryable', ...} : `retryable` indique une erreur transitoire.
+    """
+    resend_api_key = os.environ.get('RESEND_API_KEY')
+    if not resend_api_key:
+        return {'success': False, 'retryable': False, 'error': 'Configuration email non disponible'}
+
+    headers = {
+        'Authorization': f'Bearer {resend_api_key}',
+        'Content-Type': 'application/json'
+    }
+    if idempotency_key:
+        headers['Idempotency-Key'] = idempotency_key
+
     try:
-        response = requests.post(
-            RESEND_API_URL,
-            headers={
-                'Authorization': f'Bearer {resend_api_key}',
-                'Content-Type': 'application/json'
-            },
-            json={
-                'from': sender_email,
-                'to': [to_email],
-                'subject': subject,
-                'html': html_content
-            },
-            timeout=20
+        response = http_client.post(
+            url,
+            headers=headers,
+            json=payload,
+            timeout=20,
+            idempotent=bool(idempotency_key)
         )
-        response.raise_for_status()
-        return {'success': True, 'status_code': response.status_code}
     except Exception as exc:
         print(f'Erreur envoi email notification: {str(exc)}')
-        return {'success': False, 'error': str(exc)}
+        return {'success': False, 'retryable': True, 'error': str(exc)}
+
+    if response.ok:
+        return {'success': True, 'status_code': response.status_code}
+
+    print(f'Erreur envoi email notification: {response.status_code} {response.text[:200]}')
+    return {
+        'success': False,
+        'retryable': response.status_code == 429 or response.status_code >= 500,
+        'status_code': response.status_code,
+        'error': response.text[:500]
+    }
+
+
+def send_email(message, idempotency_key=None):
+    """Envoie un message construit par l'une des fonctions ci-dessous via Resend."""
+    if not message.get('to'):
+        return {'success': False, 'retryable': False, 'error': 'Destinataire manquant'}
+    sender_email = os.environ.get('RESEND_FROM_EMAIL', 'Collabzz <onboarding@resend.dev>')
+    return _post_to_resend(RESEND_API_URL, _api_payload(message, sender_email), idempotency_key)
+
+
+def send_email_batch(messages, idempotency_key=None):
+    """
+    Envoie jusqu'à RESEND_BATCH_MAX_EMAILS messages en un seul appel (endpoint batch).
+    Le lot est accepté ou refusé en bloc.
+    """
+    if len(messages) > RESEND_BATCH_MAX_EMAILS:
+        raise ValueError(f'Au plus {RESEND_BATCH_MAX_EMAILS} emails par lot')
+    if any(not message.get('to') for message in messages):
+        return {'success': False, 'retryable': False, 'error': 'Destinataire manquant'}
+    sender_email = os.environ.get('RESEND_FROM_EMAIL', 'Collabzz <onboarding@resend.dev>')
+    payload = [_api_payload(message, sender_email) for message in messages]
+    return _post_to_resend(RESEND_BATCH_URL, payload, idempotency_key)
+
+
+def digest_email(messages):
+    """
+    Regroupe plusieurs notifications d'un même destinataire en un seul email,
+    chaque notification devenant une section avec son propre lien.
+    """
+    if len(messages) == 1:
+        return messages[0]
+
+    sections = []
+    for message in messages:
+        link_html = f"""
+            <p><a href="{message['ctaUrl']}" style="color: #E6B067; font-weight: bold;">{message['ctaLabel']}</a></p>
+        """ if message.get('ctaUrl') and message.get('ctaLabel') else ""
+        sections.append(f"""
+        <div style="border-bottom: 1px solid #eee; padding-bottom: 16px; margin-bottom: 16px;">
+            <h2 style="font-size: 16px; margin: 0 0 8px;">{message['title']}</h2>
+            {message['bodyHtml']}
+            {link_html}
+        </div>
+        """)
+
+    kinds = {message.get('kind') for message in messages}
+    if kinds == {'collaboration_request'}:
+        subject = f"{len(messages)} nouvelles demandes de collaboration"
+        title = "📩 Nouvelles demandes de collaboration"
+    elif kinds == {'collaboration_response'}:
+        subject = f"{len(messages)} réponses à vos demandes de collaboration"
+        title = "Réponses à vos demandes de collaboration"
+    else:
+        subject = f"{len(messages)} nouvelles notifications Collabzz"
+        title = "🔔 Vos notifications Collabzz"
+
+    return _notification(
+        'digest',
+        messages[0]['to'],
+        subject=subject,
+        title=title,
+        body_html=''.join(sections)
+    )
 
 
-def send_verification_code_email(to_email, name, code):
+def verification_code_email(to_email, name, code):
     """
-    Envoie le code à 6 chiffres permettant de valider l'adresse email lors de l'inscription.
+    Email contenant le code à 6 chiffres permettant de valider l'adresse email lors de l'inscription.
     """
     subject = f"{code} est votre code de vérification Collabzz"
     title = "Validation de l'adresse email"
@@ -74,17 +182,18 @@ def send_verification_code_email(to_email, name, code):
         <p>Ce code expire dans 15 minutes. Si vous n'avez pas demandé ce code, vous pouvez ignorer cet e-mail.</p>
     """
 
-    return _send_notification_email(
-        to_email=to_email,
+    return _notification(
+        'verification_code',
+        to_email,
         subject=subject,
         title=title,
         body_html=body_html
     )
 
 
-def send_welcome_email(to_email, name, user_type, frontend_base_url):
+def welcome_email(to_email, name, user_type, frontend_base_url):
     """
-    Envoie un email de bienvenue après la création d'un compte influenceur ou marque.
+    Email de bienvenue envoyé après la création d'un compte influenceur ou marque.
     """
     is_brand = user_type == 'brand'
     subject = "Bienvenue sur Collabzz !"
@@ -105,8 +214,9 @@ def send_welcome_email(to_email, name, user_type, frontend_base_url):
         cta_url = f"{frontend_base_url}/my-profile"
         cta_label = "Compléter mon profil"
 
-    return _send_notification_email(
-        to_email=to_email,
+    return _notification(
+        'welcome',
+        to_email,
         subject=subject,
         title=title,
         body_html=body_html,
@@ -115,9 +225,9 @@ def send_welcome_email(to_email, name, user_type, frontend_base_url):
     )
 
 
-def send_new_collaboration_request_email(influencer_email, influencer_name, brand_name, package, amount, frontend_base_url, brand_id):
+def new_collaboration_request_email(influencer_email, influencer_name, brand_name, package, amount, frontend_base_url, brand_id):
     """
-    Prévient l'influenceur par email qu'une marque lui a envoyé une nouvelle demande de collaboration.
+    Email prévenant l'influenceur qu'une marque lui a envoyé une nouvelle demande de collaboration.
     """
     subject = f"{brand_name} souhaite collaborer avec vous !"
     title = "📩 Nouvelle demande de collaboration"
@@ -127,8 +237,9 @@ def send_new_collaboration_request_email(influencer_email, influencer_name, bran
         <p>Rendez-vous dans vos messages pour échanger avec la marque et répondre à cette demande.</p>
     """
 
-    return _send_notification_email(
-        to_email=influencer_email,
+    return _notification(
+        'collaboration_request',
+        influencer_email,
         subject=subject,
         title=title,
         body_html=body_html,
@@ -137,9 +248,9 @@ def send_new_collaboration_request_email(influencer_email, influencer_name, bran
     )
 
 
-def send_collaboration_response_email(brand_email, brand_name, influencer_name, package, accepted, frontend_base_url):
+def collaboration_response_email(brand_email, brand_name, influencer_name, package, accepted, frontend_base_url):
     """
-    Prévient la marque par email quand un influenceur accepte ou refuse sa demande de collaboration.
+    Email prévenant la marque quand un influenceur accepte ou refuse sa demande de collaboration.
     """
     if accepted:
         subject = f"{influencer_name} a accepté votre demande de collaboration !"
@@ -162,8 +273,9 @@ def send_collaboration_response_email(brand_email, brand_name, influencer_name,
         cta_url = f"{frontend_base_url}/talents"
         cta_label = "Découvrir d'autres talents"
 
-    return _send_notification_email(
-        to_email=brand_email,
+    return _notification(
+        'collaboration_response',
+        brand_email,
         subject=subject,
         title=title,
         body_html=body_html,
@@ -0,0 +1,102 @@
+"""
+Lecture des profils marque / influenceur pour les handlers HTTP
+Seuls les champs d'identité (nom, email) sont lus et mis en cache par instance,
+avec un index uid → type ('brand' | 'influencer') qui ramène la recherche d'un
+profil à une lecture (aucune si le cache est chaud).
+
+Le cache ne sert qu'à l'affichage (noms, emails des notifications) : une
+vérification d'autorisation lit Firestore avec `fresh=True`, pour qu'un compte
+supprimé ou changé de type ne passe plus le contrôle.
+"""
+
+import os
+from lib.cache import TTLCache
+
+PROFILE_COLLECTIONS = {
+    'influencer': 'influencers',
+    'brand': 'brands',
+}
+# Champs d'identité utilisés par les handlers (emails, demandes de collaboration)
+PROFILE_FIELDS = ['name', 'email', 'brandName', 'fullName']
+
+PROFILE_CACHE_TTL_SECONDS = int(os.getenv('PROFILE_CACHE_TTL_SECONDS', '300'))
+PROFILE_CACHE_MAX_ENTRIES = int(os.getenv('PROFILE_CACHE_MAX_ENTRIES', '2048'))
+# Le type d'un compte ne change pas : l'index peut vivre plus longtemps
+USER_TYPE_CACHE_TTL_SECONDS = int(os.getenv('USER_TYPE_CACHE_TTL_SECONDS', '86400'))
+
+_profiles = TTLCache(maxsize=PROFILE_CACHE_MAX_ENTRIES, ttl=PROFILE_CACHE_TTL_SECONDS)
+_user_types = TTLCache(maxsize=PROFILE_CACHE_MAX_ENTRIES * 4, ttl=USER_TYPE_CACHE_TTL_SECONDS)
+
+
+def _remember(user_type: str, uid: str, data: dict) -> dict:
+    _profiles.set((user_type, uid), data)
+    _user_types.set(uid, user_type)
+    return data
+
+
+def get_profiles(db, user_type: str, uids, fresh: bool = False) -> dict:
+    """
+    Profils d'un type pour plusieurs uids : {uid: champs d'identité}.
+    Les absents du cache sont lus en un seul get_all ; les profils inexistants sont omis.
+    """
+    uids = list(dict.fromkeys(uids))
+    profiles = {}
+    missing = []
+    for uid in uids:
+        cached = None if fresh else _profiles.get((user_type, uid))
+        if cached is not None:
+            profiles[uid] = cached
+        else:
+            missing.append(uid)
+
+    if missing:
+        collection = db.collection(PROFILE_COLLECTIONS[user_type])
+        refs = [collection.document(uid) for uid in missing]
+        for snapshot in db.get_all(refs, field_paths=PROFILE_FIELDS):
+            if snapshot.exists:
+                profiles[snapshot.id] = _remember(user_type, snapshot.id, snapshot.to_dict() or {})
+    return profiles
+
+
+def get_profile(db, user_type: str, uid: str, fresh: bool = False) -> dict | None:
+    """Champs d'identité d'un profil, ou None s'il n'existe pas."""
+    return get_profiles(db, user_type, [uid], fresh=fresh).get(uid)
+
+
+def lookup_user_profile(db, uid: str, fresh: bool = False) -> tuple[str | None, dict | None]:
+    """
+    Retrouve le type et le profil d'un uid : (user_type, champs) ou (None, None).
+    Type connu : une lecture au plus ; inconnu : les deux collections en un get_all.
+    """
+    user_type = _user_types.get(uid)
+    if user_type:
+        profile = get_profile(db, user_type, uid, fresh=fresh)
+        if profile is not None:
+            return user_type, profile
+
+    refs = [db.collection(collection).document(uid) for collection in PROFILE_COLLECTIONS.values()]
+    snapshots = {snapshot.reference.parent.id: snapshot for snapshot in db.get_all(refs, field_paths=PROFILE_FIELDS)}
+    for user_type, collection in PROFILE_COLLECTIONS.items():
+        snapshot = snapshots.get(collection)
+        if snapshot is not None and snapshot.exists:
+            return user_type, _remember(user_type, uid, snapshot.to_dict() or {})
+    return None, None
+
+
+def identity_changed(before: dict | None, after: dict | None) -> bool:
+    """Vrai si une écriture crée, supprime ou modifie les champs d'identité d'un profil."""
+    if before is None or after is None:
+        return True
+    return any(before.get(field) != after.get(field) for field in PROFILE_FIELDS)
+
+
+def invalidate_profile(uid: str) -> None:
+    """À appeler après une création, suppression ou modification du nom / email d'un profil."""
+    for user_type in PROFILE_COLLECTIONS:
+        _profiles.invalidate((user_type, uid))
+    _user_types.invalidate(uid)
+
+
+def clear_profile_cache() -> None:
+    _profiles.clear()
+    _user_types.clear()
@@ -0,0 +1,289 @@
+"""
+Gouverneur de quotas et de débit par plateforme (YouTube, TikTok, Instagram)
+Les quotas des API sont partagés par tous les utilisateurs de l'application :
+un seau à jetons limite le débit, un backoff adaptatif réagit aux 429 /
+quotaExceeded, et un registre journalier `apiQuotaLedger/{platform}_{YYYYMMDD}`
+suit les unités consommées pour étaler le budget sur la journée.
+"""
+
+import os
+import time
+import asyncio
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+LEDGER_COLLECTION = 'apiQuotaLedger'
+
+# Les quotas YouTube sont remis à zéro à minuit, heure du Pacifique
+QUOTA_RESET_TIMEZONE = ZoneInfo(os.getenv('QUOTA_RESET_TIMEZONE', 'America/Los_Angeles'))
+# Attente maximale pour obtenir un jeton avant d'abandonner (compte reporté)
+QUOTA_MAX_WAIT_SECONDS = float(os.getenv('QUOTA_MAX_WAIT_SECONDS', '30'))
+# Avance autorisée sur le budget journalier lissé (fraction du budget)
+QUOTA_PACING_SLACK = float(os.getenv('QUOTA_PACING_SLACK', '0.1'))
+# Backoff après un 429 / quotaExceeded (doublé à chaque rejet consécutif)
+QUOTA_BACKOFF_SECONDS = float(os.getenv('QUOTA_BACKOFF_SECONDS', '5'))
+QUOTA_MAX_BACKOFF_SECONDS = float(os.getenv('QUOTA_MAX_BACKOFF_SECONDS', '300'))
+
+# Débit (requêtes/s), rafale et budget journalier d'unités (0 = pas de budget)
+QUOTA_CONFIG = {
+    'youtube': {
+        'rate': float(os.getenv('YOUTUBE_QUOTA_RATE', '10')),
+        'burst': int(os.getenv('YOUTUBE_QUOTA_BURST', '20')),
+        'daily_units': int(os.getenv('YOUTUBE_DAILY_UNITS', '10000')),
+    },
+    'tiktok': {
+        'rate': float(os.getenv('TIKTOK_QUOTA_RATE', '8')),
+        'burst': int(os.getenv('TIKTOK_QUOTA_BURST', '16')),
+        'daily_units': int(os.getenv('TIKTOK_DAILY_UNITS', '0')),
+    },
+    'instagram': {
+        'rate': float(os.getenv('INSTAGRAM_QUOTA_RATE', '8')),
+        'burst': int(os.getenv('INSTAGRAM_QUOTA_BURST', '16')),
+        'daily_units': int(os.getenv('INSTAGRAM_DAILY_UNITS', '0')),
+    },
+}
+
+# Codes d'erreur Graph API signalant une limite de débit (app, utilisateur, page)
+GRAPH_RATE_LIMIT_CODES = {4, 17, 32, 613}
+# Raisons d'erreur YouTube liées au quota
+YOUTUBE_QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+YOUTUBE_RATE_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+class QuotaExceededError(Exception):
+    """Quota ou débit indisponible : le compte est reporté au prochain passage."""
+
+
+def _quota_day(now: datetime | None = None) -> str:
+    return (now or datetime.now(QUOTA_RESET_TIMEZONE)).astimezone(QUOTA_RESET_TIMEZONE).strftime('%Y%m%d')
+
+
+def _day_elapsed_fraction() -> float:
+    now = datetime.now(QUOTA_RESET_TIMEZONE)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (now - midnight).total_seconds() / 86400
+
+
+def _next_reset() -> float:
+    """Instant (time.monotonic) de la prochaine remise à zéro du quota journalier."""
+    now = datetime.now(QUOTA_RESET_TIMEZONE)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    return time.monotonic() + (midnight - now).total_seconds()
+
+
+class QuotaGovernor:
+    """
+    Seau à jetons d'une plateforme, avec backoff adaptatif et budget journalier.
+
+    Après un rejet (429, quotaExceeded), les appels sont suspendus pendant le
+    backoff et le débit est divisé par deux ; il remonte progressivement à
+    chaque succès. Le budget journalier est lissé : à une heure donnée, on ne
+    peut consommer que la part de la journée écoulée (plus une marge).
+    """
+
+    def __init__(self, platform: str, rate: float, burst: int, daily_units: int = 0):
+        self.platform = platform
+        self.base_rate = max(rate, 0.1)
+        self.rate = self.base_rate
+        self.burst = max(burst, 1)
+        self.daily_units = daily_units
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._exhausted_until = 0.0
+        self._throttle_count = 0
+        # Unités consommées connues dans le registre, et unités locales non encore écrites
+        self._ledger_day = _quota_day()
+        self._ledger_units = 0
+        self._pending_units = defaultdict(int)
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _check_budget(self, units: int) -> None:
+        if time.monotonic() < self._exhausted_until:
+            raise QuotaExceededError(f'Quota journalier {self.platform} épuisé')
+        if not self.daily_units:
+            return
+
+        day = _quota_day()
+        if day != self._ledger_day:
+            self._ledger_day = day
+            self._ledger_units = 0
+        used = self._ledger_units + self._pending_units[day]
+        allowed = self.daily_units * min(1.0, _day_elapsed_fraction() + QUOTA_PACING_SLACK)
+        if used + units > allowed:
+            raise QuotaExceededError(
+                f'Budget {self.platform} atteint pour l\'instant ({used}/{int(allowed)} unités)'
+            )
+
+    def _reserve(self, units: int) -> float:
+        """Consomme `units` jetons si possible ; sinon retourne le délai d'attente."""
+        with self._lock:
+            self._check_budget(units)
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            needed = min(units, self.burst)
+            if self._tokens >= needed:
+                self._tokens -= needed
+                self._pending_units[_quota_day()] += units
+                return 0.0
+            return (needed - self._tokens) / self.rate
+
+    def acquire(self, units: int = 1, max_wait: float = QUOTA_MAX_WAIT_SECONDS) -> None:
+        """Bloque jusqu'à disposer de `units` jetons (QuotaExceededError au-delà de max_wait)."""
+        waited = 0.0
+        while True:
+            delay = self._reserve(units)
+            if delay <= 0:
+                return
+            if waited + delay > max_wait:
+                raise QuotaExceededError(f'Débit {self.platform} saturé')
+            time.sleep(delay)
+            waited += delay
+
+    def record_usage(self, units: int) -> None:
+        """Comptabilise des unités déjà consommées hors acquire() (ex. renvois automatiques)."""
+        if units <= 0:
+            return
+        with self._lock:
+            self._pending_units[_quota_day()] += units
+
+    async def acquire_async(self, units: int = 1, max_wait: float = QUOTA_MAX_WAIT_SECONDS) -> None:
+        """Variante asynchrone de acquire() (n'occupe pas la boucle pendant l'attente)."""
+        waited = 0.0
+        while True:
+            delay = self._reserve(units)
+            if delay <= 0:
+                return
+            if waited + delay > max_wait:
+                raise QuotaExceededError(f'Débit {self.platform} saturé')
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def on_throttled(self, retry_after: float | None = None) -> None:
+        """Rejet pour limite de débit : pause puis débit réduit de moitié."""
+        with self._lock:
+            self._throttle_count += 1
+            backoff = retry_after or min(
+                QUOTA_BACKOFF_SECONDS * 2 ** (self._throttle_count - 1), QUOTA_MAX_BACKOFF_SECONDS
+            )
+            self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+            self.rate = max(self.base_rate / 16, self.rate / 2)
+            self._tokens = 0.0
+        print(f"🐢 Limite de débit {self.platform} atteinte, pause de {backoff:.1f}s "
+              f"(débit ramené à {self.rate:.2f} req/s)")
+
+    def on_exhausted(self) -> None:
+        """Quota journalier épuisé côté API : plus aucun appel jusqu'à la remise à zéro."""
+        with self._lock:
+            self._exhausted_until = _next_reset()
+        print(f"⛔ Quota journalier {self.platform} épuisé, appels suspendus jusqu'à minuit (PT)")
+
+    def on_success(self) -> None:
+        """Remontée progressive du débit après un rejet."""
+        if self.rate >= self.base_rate:
+            return
+        with self._lock:
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+            if self.rate >= self.base_rate:
+                self._throttle_count = 0
+
+    def flush_ledger(self, db) -> None:
+        """Écrit les unités consommées dans le registre journalier et relit le total."""
+        from firebase_admin import firestore
+
+        with self._lock:
+            pending, self._pending_units = self._pending_units, defaultdict(int)
+
+        collection = db.collection(LEDGER_COLLECTION)
+        for day, units in pending.items():
+            if units:
+                collection.document(f'{self.platform}_{day}').set({
+                    'platform': self.platform,
+                    'day': day,
+                    'units': firestore.Increment(units),
+                    'updatedAt': firestore.SERVER_TIMESTAMP
+                }, merge=True)
+
+        if not self.daily_units:
+            return
+        # Total toutes instances confondues, pour le lissage du budget
+        day = _quota_day()
+        snapshot = collection.document(f'{self.platform}_{day}').get()
+        with self._lock:
+            if day >= self._ledger_day:
+                self._ledger_day = day
+                self._ledger_units = int((snapshot.to_dict() or {}).get('units', 0)) if snapshot.exists else 0
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def get_governor(platform: str) -> QuotaGovernor:
+    """Gouverneur partagé par toute l'instance pour une plateforme."""
+    governor = _governors.get(platform)
+    if governor is None:
+        with _governors_lock:
+            governor = _governors.get(platform)
+            if governor is None:
+                config = QUOTA_CONFIG.get(platform, {'rate': 5, 'burst': 10, 'daily_units': 0})
+                governor = QuotaGovernor(platform, **config)
+                _governors[platform] = governor
+    return governor
+
+
+def flush_quota_ledgers(db) -> None:
+    """Écrit le registre de toutes les plateformes utilisées par l'instance."""
+    for governor in list(_governors.values()):
+        try:
+            governor.flush_ledger(db)
+        except Exception as exc:
+            print(f"Erreur écriture du registre de quota {governor.platform}: {str(exc)}")
+
+
+def retry_after_seconds(headers) -> float | None:
+    """Valeur numérique de l'en-tête Retry-After, si présente."""
+    value = (headers or {}).get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_graph_rate_limited(status_code: int, payload) -> bool:
+    if status_code == 429:
+        return True
+    if status_code < 400 or not isinstance(payload, dict):
+        return False
+    return (payload.get('error') or {}).get('code') in GRAPH_RATE_LIMIT_CODES
+
+
+def youtube_error_reason(exception) -> str | None:
+    """Raison d'une HttpError YouTube (quotaExceeded, rateLimitExceeded, ...)."""
+    details = getattr(exception, 'error_details', None) or []
+    for detail in details:
+        if isinstance(detail, dict) and detail.get('reason'):
+            return detail['reason']
+    status = getattr(getattr(exception, 'resp', None), 'status', None)
+    return 'rateLimitExceeded' if status == 429 else None
+
+
+def is_youtube_quota_error(exception) -> bool:
+    return youtube_error_reason(exception) in YOUTUBE_QUOTA_REASONS | YOUTUBE_RATE_REASONS
+
+
+def observe_youtube_error(exception) -> None:
+    """Applique le backoff ou la suspension selon l'erreur YouTube reçue."""
+    reason = youtube_error_reason(exception)
+    if reason in YOUTUBE_QUOTA_REASONS:
+        get_governor('youtube').on_exhausted()
+    elif reason in YOUTUBE_RATE_REASONS:
+        get_governor('youtube').on_throttled()
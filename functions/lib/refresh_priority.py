@@ -0,0 +1,148 @@
+"""
+Priorisation des rafraîchissements de stats
+Chaque compte connecté reçoit une date de prochain rafraîchissement calculée à
+partir de sa taille (palier d'abonnés), de la volatilité observée de ses stats
+et de la demande (collaborations en cours). Le cron ne traite que les comptes dus,
+les plus en retard en premier.
+
+État stocké côté serveur dans `statsRefreshSchedule/{uid}` :
+    {<platform>: {nextRefreshAt, lastRefreshAt, volatility, followers, errorCount},
+     demandUntil}
+"""
+
+import os
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+
+SCHEDULE_COLLECTION = 'statsRefreshSchedule'
+GET_ALL_CHUNK_SIZE = 100
+
+# Bornes de l'intervalle entre deux rafraîchissements d'un même compte
+REFRESH_MIN_INTERVAL_MINUTES = int(os.getenv('REFRESH_MIN_INTERVAL_MINUTES', '30'))
+REFRESH_MAX_INTERVAL_MINUTES = int(os.getenv('REFRESH_MAX_INTERVAL_MINUTES', '1440'))
+# Intervalle appliqué tant qu'une collaboration est en cours sur le profil
+REFRESH_DEMAND_INTERVAL_MINUTES = int(os.getenv('REFRESH_DEMAND_INTERVAL_MINUTES', '30'))
+# Durée du boost de demande après une nouvelle collaboration
+REFRESH_DEMAND_BOOST_HOURS = int(os.getenv('REFRESH_DEMAND_BOOST_HOURS', '72'))
+
+# Intervalle de base (minutes) par palier d'abonnés, du plus grand au plus petit
+FOLLOWER_TIERS = (
+    (1_000_000, 60),
+    (100_000, 120),
+    (10_000, 360),
+    (0, 720),
+)
+
+# Poids de la dernière observation dans la moyenne mobile de volatilité
+VOLATILITY_ALPHA = 0.3
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def load_schedules(db, user_ids) -> dict:
+    """Charge l'état de planification de plusieurs comptes via get_all (par lots)."""
+    collection = db.collection(SCHEDULE_COLLECTION)
+    user_ids = list(user_ids)
+    schedules = {}
+    for start in range(0, len(user_ids), GET_ALL_CHUNK_SIZE):
+        refs = [collection.document(user_id) for user_id in user_ids[start:start + GET_ALL_CHUNK_SIZE]]
+        for snapshot in db.get_all(refs):
+            if snapshot.exists:
+                schedules[snapshot.id] = snapshot.to_dict() or {}
+    return schedules
+
+
+def _demand_active(schedule: dict, now: datetime) -> bool:
+    demand_until = schedule.get('demandUntil')
+    return bool(demand_until and demand_until > now)
+
+
+def refresh_priority(schedule: dict, platform: str, now: datetime | None = None) -> float | None:
+    """
+    Priorité d'un compte (plus grand = plus urgent), ou None s'il n'est pas dû.
+    Un compte jamais planifié est dû immédiatement.
+    """
+    now = now or _now()
+    state = schedule.get(platform) or {}
+    next_refresh_at = state.get('nextRefreshAt')
+    if _demand_active(schedule, now):
+        last_refresh_at = state.get('lastRefreshAt')
+        demand_due = last_refresh_at + timedelta(minutes=REFRESH_DEMAND_INTERVAL_MINUTES) \
+            if last_refresh_at else now
+        next_refresh_at = min(next_refresh_at, demand_due) if next_refresh_at else demand_due
+    if not next_refresh_at:
+        return float('inf')
+    if next_refresh_at > now:
+        return None
+
+    # Retard rapporté à l'intervalle prévu : un petit compte en retard d'une heure
+    # passe après un gros compte en retard d'une heure
+    last_refresh_at = state.get('lastRefreshAt') or next_refresh_at
+    interval = max((next_refresh_at - last_refresh_at).total_seconds(), 60)
+    return (now - next_refresh_at).total_seconds() / interval
+
+
+def _base_interval(followers: int) -> int:
+    for threshold, minutes in FOLLOWER_TIERS:
+        if followers >= threshold:
+            return minutes
+    return FOLLOWER_TIERS[-1][1]
+
+
+def next_state(state: dict, result: dict, demand: bool = False, now: datetime | None = None) -> dict:
+    """Nouvel état de planification d'un compte après un rafraîchissement."""
+    now = now or _now()
+    state = state or {}
+
+    if not result.get('success'):
+        # Erreur : nouvelle tentative avec backoff exponentiel
+        error_count = int(state.get('errorCount', 0)) + 1
+        minutes = min(REFRESH_MIN_INTERVAL_MINUTES * 2 ** (error_count - 1), REFRESH_MAX_INTERVAL_MINUTES)
+        return {
+            **state,
+            'errorCount': error_count,
+            'lastRefreshAt': now,
+            'nextRefreshAt': now + timedelta(minutes=minutes)
+        }
+
+    followers = result.get('subscribers', result.get('followers'))
+    followers = int(followers) if followers is not None else int(state.get('followers', 0))
+    changed = 1.0 if result.get('changed', True) else 0.0
+    volatility = VOLATILITY_ALPHA * changed + (1 - VOLATILITY_ALPHA) * float(state.get('volatility', 1.0))
+
+    # Des stats qui bougent souvent raccourcissent l'intervalle (x0.5 à x2)
+    minutes = _base_interval(followers) * (2.0 - 1.5 * volatility)
+    if demand:
+        minutes = min(minutes, REFRESH_DEMAND_INTERVAL_MINUTES)
+    minutes = max(REFRESH_MIN_INTERVAL_MINUTES, min(minutes, REFRESH_MAX_INTERVAL_MINUTES))
+
+    return {
+        'errorCount': 0,
+        'followers': followers,
+        'volatility': round(volatility, 4),
+        'lastRefreshAt': now,
+        'nextRefreshAt': now + timedelta(minutes=minutes)
+    }
+
+
+def save_schedules(db, updates: dict, writer=None) -> None:
+    """Écrit les nouveaux états {(platform, user_id): état} (via le writer s'il est fourni)."""
+    from lib.write_buffer import write_set
+
+    collection = db.collection(SCHEDULE_COLLECTION)
+    for (platform, user_id), state in updates.items():
+        write_set(collection.document(user_id), {platform: state}, merge=True, writer=writer)
+
+
+def demand_boost(hours: int = REFRESH_DEMAND_BOOST_HOURS) -> dict:
+    """Champs (à écrire en merge) qui rafraîchissent plus souvent un profil sollicité."""
+    return {
+        'demandUntil': _now() + timedelta(hours=hours),
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    }
+
+
+def schedule_ref(db, user_id: str):
+    return db.collection(SCHEDULE_COLLECTION).document(user_id)
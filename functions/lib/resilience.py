@@ -0,0 +1,141 @@
+"""
+Résilience des appels aux API tierces (TikTok, Graph API, YouTube, Resend)
+Retries avec backoff exponentiel et jitter pour les appels idempotents, et
+disjoncteur par hôte : après plusieurs échecs consécutifs, les appels vers un
+fournisseur en panne échouent immédiatement au lieu d'attendre leur timeout.
+"""
+
+import os
+import time
+import random
+import threading
+
+# Nombre de tentatives supplémentaires pour un appel idempotent
+RETRY_ATTEMPTS = int(os.getenv('HTTP_RETRY_ATTEMPTS', '2'))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv('HTTP_RETRY_BASE_DELAY_SECONDS', '0.5'))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv('HTTP_RETRY_MAX_DELAY_SECONDS', '8'))
+# Codes HTTP considérés comme transitoires
+RETRY_STATUSES = frozenset({500, 502, 503, 504})
+
+# Échecs consécutifs avant ouverture du disjoncteur, puis durée d'ouverture
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', '30'))
+
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+
+
+class CircuitOpenError(Exception):
+    """Fournisseur considéré comme indisponible : appel court-circuité."""
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY_SECONDS,
+                  cap: float = RETRY_MAX_DELAY_SECONDS) -> float:
+    """Délai avant la tentative `attempt` (0 = premier retry), avec jitter complet."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Disjoncteur d'un hôte (fermé → ouvert → semi-ouvert).
+
+    Ouvert après `failure_threshold` échecs consécutifs : les appels lèvent
+    CircuitOpenError pendant `reset_seconds`. Ensuite, un seul appel d'essai
+    est autorisé ; son succès referme le disjoncteur, son échec le rouvre.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now: float) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if now - self._opened_at >= self.reset_seconds:
+            return 'half_open'
+        return 'open'
+
+    def before_call(self) -> None:
+        """Lève CircuitOpenError si l'appel doit être court-circuité."""
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == 'closed':
+                return
+            if state == 'half_open' and not self._probing:
+                self._probing = True
+                return
+        raise CircuitOpenError(f'{self.name} indisponible (disjoncteur ouvert)')
+
+    def cancel_call(self) -> None:
+        """Appel autorisé mais finalement non envoyé : libère l'essai semi-ouvert."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                print(f"🔌 Disjoncteur {self.name} refermé")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            reopen = self._probing
+            self._probing = False
+            if reopen or self._failures >= self.failure_threshold:
+                if self._opened_at is None or reopen:
+                    print(f"⚡ Disjoncteur {self.name} ouvert pour {self.reset_seconds:.0f}s "
+                          f"après {self._failures} échecs")
+                self._opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host: str) -> CircuitBreaker:
+    """Disjoncteur partagé par toute l'instance pour un hôte."""
+    breaker = _breakers.get(host)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(host, CircuitBreaker(host))
+    return breaker
+
+
+def call_with_retries(func, breaker: CircuitBreaker | None = None, retries: int = RETRY_ATTEMPTS,
+                      is_transient=lambda exc: True):
+    """
+    Appelle `func()` avec des retries (backoff + jitter) sur les erreurs transitoires.
+    Chaque tentative passe par le disjoncteur s'il est fourni.
+    """
+    for attempt in range(retries + 1):
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            result = func()
+        except BaseException as exc:
+            if not isinstance(exc, Exception) or not is_transient(exc):
+                if breaker is not None:
+                    breaker.cancel_call()
+                raise
+            if breaker is not None:
+                breaker.record_failure()
+            if attempt >= retries:
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
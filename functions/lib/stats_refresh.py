@@ -0,0 +1,370 @@
+"""
+Moteur de rafraîchissement des statistiques pour le cron Collabzz
+Exécution parallèle bornée par plateforme avec une échéance globale
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from lib.quota import QuotaExceededError
+from lib.resilience import CircuitOpenError
+
+# Erreurs qui reportent un compte au passage suivant au lieu de le compter en erreur
+DEFERRED_ERRORS = (QuotaExceededError, CircuitOpenError)
+
+# Parallélisme par plateforme (nombre d'influenceurs traités en même temps)
+PLATFORM_CONCURRENCY = {
+    'youtube': int(os.getenv('YOUTUBE_REFRESH_CONCURRENCY', '8')),
+    'tiktok': int(os.getenv('TIKTOK_REFRESH_CONCURRENCY', '8')),
+    'instagram': int(os.getenv('INSTAGRAM_REFRESH_CONCURRENCY', '8')),
+}
+DEFAULT_CONCURRENCY = 4
+
+# Échéance globale d'un run, volontairement inférieure au timeout de la fonction
+REFRESH_DEADLINE_SECONDS = int(os.getenv('REFRESH_DEADLINE_SECONDS', '480'))
+
+# Plateformes rafraîchies par le cron
+REFRESH_PLATFORMS = ('youtube', 'tiktok', 'instagram')
+
+# Nombre d'influenceurs traités par page (tokens préchargés en une fois)
+REFRESH_PAGE_SIZE = int(os.getenv('REFRESH_PAGE_SIZE', '100'))
+
+
+def _projection(platforms, with_hash: bool = False) -> list[str]:
+    """Champs projetés lors du scan : uniquement ce dont le rafraîchissement a besoin."""
+    fields = ['connectedPlatforms'] + [f'socialAccounts.{p}.connected' for p in platforms]
+    if with_hash:
+        fields += [f'socialAccounts.{p}.statsHash' for p in platforms]
+    return fields
+
+
+def iter_connected_influencer_pages(db, platforms=REFRESH_PLATFORMS, start_id: str | None = None,
+                                    end_id: str | None = None, after_id: str | None = None,
+                                    page_size: int = REFRESH_PAGE_SIZE):
+    """
+    Parcourt, page par page et par ordre d'ID, les influenceurs ayant au moins
+    une des plateformes connectée, dans la plage d'IDs [start_id, end_id).
+
+    S'appuie sur le tableau `connectedPlatforms` (index simple champ automatique) et
+    projette seulement les indicateurs `socialAccounts.<platform>.connected` et
+    l'empreinte `statsHash` des dernières stats écrites. Chaque page est une requête
+    bornée reprenant après `after_id`, ce qui permet de sauvegarder un curseur.
+
+    Retourne des tuples (entrées, dernier_id_lu) où chaque entrée est
+    (user_id, {plateforme connectée: empreinte stockée}).
+    """
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    collection = db.collection('influencers')
+    document_id = FieldPath.document_id()
+
+    while True:
+        query = (
+            collection
+            .where('connectedPlatforms', 'array_contains_any', list(platforms))
+            .select(_projection(platforms, with_hash=True))
+        )
+        if after_id:
+            query = query.where(document_id, '>', collection.document(after_id))
+        elif start_id:
+            query = query.where(document_id, '>=', collection.document(start_id))
+        if end_id:
+            query = query.where(document_id, '<', collection.document(end_id))
+        snapshots = list(query.order_by(document_id).limit(page_size).stream())
+        if not snapshots:
+            return
+
+        entries = []
+        for snapshot in snapshots:
+            data = snapshot.to_dict() or {}
+            social_accounts = data.get('socialAccounts', {})
+            # Le flag `connected` fait foi : le tableau peut garder une plateforme
+            # déconnectée côté client jusqu'au prochain nettoyage.
+            connected = {
+                p: social_accounts.get(p, {}).get('statsHash')
+                for p in platforms if social_accounts.get(p, {}).get('connected')
+            }
+            if connected:
+                entries.append((snapshot.id, connected))
+
+        after_id = snapshots[-1].id
+        yield entries, after_id
+        if len(snapshots) < page_size:
+            return
+
+
+def backfill_connected_platforms(db, batch_size: int = 400) -> int:
+    """
+    Migration ponctuelle : reconstruit `connectedPlatforms` à partir des flags
+    `socialAccounts.<platform>.connected` pour les profils existants.
+    Retourne le nombre de profils mis à jour.
+    """
+    platforms = ('youtube', 'tiktok', 'instagram')
+    batch = db.batch()
+    pending = 0
+    updated = 0
+
+    for snapshot in db.collection('influencers').select(_projection(platforms)).stream():
+        data = snapshot.to_dict() or {}
+        social_accounts = data.get('socialAccounts', {})
+        connected = [p for p in platforms if social_accounts.get(p, {}).get('connected')]
+        if sorted(data.get('connectedPlatforms') or []) == sorted(connected):
+            continue
+
+        batch.update(snapshot.reference, {'connectedPlatforms': connected})
+        pending += 1
+        updated += 1
+        if pending >= batch_size:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+    return updated
+
+
+class RefreshSummary:
+    """Compteurs thread-safe d'un run, par plateforme."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.platforms = {}
+
+    def _counters(self, platform: str) -> dict:
+        return self.platforms.setdefault(platform, {
+            'success': 0,
+            'error': 0,
+            'skipped': 0,
+            'deferred': 0,
+            'changed': 0,
+            'unchanged': 0
+        })
+
+    def record(self, platform: str, outcome: str) -> None:
+        with self._lock:
+            self._counters(platform)[outcome] += 1
+
+    def reclassify(self, platform: str, from_outcome: str, to_outcome: str) -> None:
+        """Déplace un compte d'une catégorie à l'autre (ex. écriture différée en échec)."""
+        with self._lock:
+            counters = self._counters(platform)
+            if counters[from_outcome] > 0:
+                counters[from_outcome] -= 1
+            counters[to_outcome] += 1
+
+    @property
+    def update_count(self) -> int:
+        return sum(c['success'] for c in self.platforms.values())
+
+    @property
+    def error_count(self) -> int:
+        return sum(c['error'] for c in self.platforms.values())
+
+    @property
+    def skipped_count(self) -> int:
+        return sum(c['skipped'] for c in self.platforms.values())
+
+    @property
+    def deferred_count(self) -> int:
+        return sum(c['deferred'] for c in self.platforms.values())
+
+    @property
+    def changed_count(self) -> int:
+        return sum(c['changed'] for c in self.platforms.values())
+
+    @property
+    def unchanged_count(self) -> int:
+        return sum(c['unchanged'] for c in self.platforms.values())
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'success': self.update_count,
+                'error': self.error_count,
+                'skipped': self.skipped_count,
+                'deferred': self.deferred_count,
+                'changed': self.changed_count,
+                'unchanged': self.unchanged_count,
+                'platforms': {name: dict(c) for name, c in self.platforms.items()}
+            }
+
+
+class StatsRefreshEngine:
+    """
+    Pool de workers pour rafraîchir les stats de nombreux influenceurs en parallèle.
+
+    Chaque plateforme dispose de son propre pool (parallélisme configurable), pour
+    qu'une API lente ne bloque pas les autres. Passé l'échéance globale, les jobs
+    non démarrés sont comptés comme ignorés et repris au run suivant ; il en va de
+    même des comptes reportés faute de quota ou parce que le fournisseur est
+    indisponible (QuotaExceededError, CircuitOpenError).
+
+    Avec un `writer` (DeferredWriter), les handlers mettent leurs écritures en file
+    et `run_page()` les vide en fin de page en réaffectant les échecs aux compteurs.
+
+    Les `batch_handlers` traitent plusieurs comptes d'une même plateforme en un
+    appel (ex. requêtes batch YouTube) : ils reçoivent une liste de
+    (user_id, tokens, previous_hash) et retournent {user_id: résultat}.
+    """
+
+    def __init__(self, handlers: dict, concurrency: dict | None = None,
+                 deadline_seconds: int | None = None, summary: RefreshSummary | None = None,
+                 writer=None, batch_handlers: dict | None = None, batch_size: int | dict = 50):
+        self.handlers = handlers
+        self.batch_handlers = batch_handlers or {}
+        self.batch_size = batch_size
+        self.concurrency = {**PLATFORM_CONCURRENCY, **(concurrency or {})}
+        seconds = REFRESH_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+        self.deadline = time.monotonic() + seconds
+        self.summary = summary or RefreshSummary()
+        self.writer = writer
+        self._executors = {}
+        # Comptes non traités faute de temps (le curseur du shard ne doit pas les dépasser)
+        self._expired_users = set()
+        self._expired_lock = threading.Lock()
+
+    def _executor(self, platform: str) -> ThreadPoolExecutor:
+        if platform not in self._executors:
+            self._executors[platform] = ThreadPoolExecutor(
+                max_workers=max(1, self.concurrency.get(platform, DEFAULT_CONCURRENCY)),
+                thread_name_prefix=f'refresh-{platform}'
+            )
+        return self._executors[platform]
+
+    def _batch_size(self, platform: str) -> int:
+        if isinstance(self.batch_size, dict):
+            return max(1, self.batch_size.get(platform, 50))
+        return max(1, self.batch_size)
+
+    def time_left(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.time_left() <= 0
+
+    def _skip_expired(self, platform: str, user_ids) -> None:
+        with self._expired_lock:
+            for user_id in user_ids:
+                self.summary.record(platform, 'skipped')
+                self._expired_users.add(user_id)
+
+    def take_expired_users(self) -> set:
+        """Comptes ignorés à l'échéance depuis le dernier appel."""
+        with self._expired_lock:
+            users, self._expired_users = self._expired_users, set()
+        return users
+
+    def _run_job(self, platform: str, user_id: str, tokens: dict,
+                 previous_hash: str | None = None) -> dict:
+        if self.expired():
+            self._skip_expired(platform, [user_id])
+            return {}
+
+        try:
+            kwargs = {'previous_hash': previous_hash}
+            if self.writer is not None:
+                kwargs['writer'] = self.writer
+            result = self.handlers[platform](user_id, tokens, **kwargs)
+        except DEFERRED_ERRORS as exc:
+            result = {'success': False, 'skipped': True, 'error': str(exc)}
+        except Exception as exc:
+            result = {'success': False, 'error': str(exc)}
+
+        if not self._record_result(platform, user_id, result):
+            return {}
+        return {(platform, user_id): result}
+
+    def _run_batch(self, platform: str, batch: list) -> dict:
+        if self.expired():
+            self._skip_expired(platform, [user_id for user_id, _, _ in batch])
+            return {}
+
+        try:
+            if self.writer is not None:
+                results = self.batch_handlers[platform](batch, writer=self.writer)
+            else:
+                results = self.batch_handlers[platform](batch)
+        except DEFERRED_ERRORS as exc:
+            results = {}
+            error = {'success': False, 'skipped': True, 'error': str(exc)}
+        except Exception as exc:
+            results = {}
+            error = {'success': False, 'error': str(exc)}
+        else:
+            error = {'success': False, 'error': 'Aucun résultat pour ce compte'}
+
+        outcomes = {}
+        for user_id, _, _ in batch:
+            result = results.get(user_id) or error
+            if self._record_result(platform, user_id, result):
+                outcomes[(platform, user_id)] = result
+        return outcomes
+
+    def _record_result(self, platform: str, user_id: str, result: dict) -> bool:
+        """Comptabilise un résultat ; retourne False pour un compte reporté (quota)."""
+        if result.get('skipped'):
+            self.summary.record(platform, 'skipped')
+            return False
+        if result.get('success'):
+            self.summary.record(platform, 'success')
+            self.summary.record(platform, 'changed' if result.get('changed', True) else 'unchanged')
+            print(f"✅ {platform} mis à jour pour {user_id}: {result.get('subscribers', result.get('followers'))} abonnés")
+        else:
+            self.summary.record(platform, 'error')
+            print(f"❌ Erreur {platform} pour {user_id}: {result.get('error')}")
+        return True
+
+    def submit(self, platform: str, user_id: str, tokens: dict, previous_hash: str | None = None):
+        """Planifie le rafraîchissement d'un compte sur le pool de sa plateforme."""
+        return self._executor(platform).submit(self._run_job, platform, user_id, tokens, previous_hash)
+
+    def run_page(self, jobs) -> dict:
+        """
+        Traite une page de jobs (platform, user_id, tokens, previous_hash) et attend
+        leur fin, puis vide les écritures différées de la page.
+        Retourne {(platform, user_id): résultat} (jobs ignorés à l'échéance exclus).
+        """
+        futures = []
+        batched = defaultdict(list)
+        for platform, user_id, tokens, previous_hash in jobs:
+            if platform in self.batch_handlers:
+                batched[platform].append((user_id, tokens, previous_hash))
+            else:
+                futures.append(self.submit(platform, user_id, tokens, previous_hash))
+
+        for platform, batch_jobs in batched.items():
+            size = self._batch_size(platform)
+            for start in range(0, len(batch_jobs), size):
+                futures.append(self._executor(platform).submit(
+                    self._run_batch, platform, batch_jobs[start:start + size]
+                ))
+
+        wait_futures(futures)
+        outcomes = {}
+        for future in futures:
+            outcomes.update(future.result())
+        if self.writer is None:
+            return outcomes
+
+        failed_tags = {failure['tag'] for failure in self.writer.flush() if failure['tag']}
+        for platform, user_id in failed_tags:
+            result = outcomes.get((platform, user_id))
+            if result and result.get('success'):
+                self.summary.reclassify(platform, 'success', 'error')
+                outcomes[(platform, user_id)] = {'success': False, 'error': 'Écriture Firestore en échec'}
+        return outcomes
+
+    def wait(self) -> dict:
+        """
+        Attend la fin de tous les jobs planifiés et retourne le résumé du run.
+        Les jobs encore en file à l'échéance se terminent immédiatement (ignorés).
+        """
+        for executor in self._executors.values():
+            executor.shutdown(wait=True)
+        self._executors = {}
+        if self.writer is not None:
+            self.writer.close()
+        return self.summary.to_dict()
@@ -0,0 +1,300 @@
+"""
+Planification du rafraîchissement des stats par shards
+Chaque run découpe `influencers` en plages d'IDs traitées par des tâches
+indépendantes (Cloud Tasks), avec un curseur sauvegardé après chaque page
+dans `statsRefreshRuns/{runId}` pour reprendre après un timeout ou un crash.
+"""
+
+import os
+import string
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+
+from lib.stats_refresh import (
+    StatsRefreshEngine,
+    iter_connected_influencer_pages,
+    REFRESH_PAGE_SIZE,
+)
+
+RUNS_COLLECTION = 'statsRefreshRuns'
+SHARD_TASK_FUNCTION = 'refresh_stats_shard'
+
+# Nombre de shards (tâches parallèles) par run
+STATS_REFRESH_SHARDS = int(os.getenv('STATS_REFRESH_SHARDS', '8'))
+# Un run plus récent que ce délai et encore en cours empêche d'en lancer un nouveau
+STATS_REFRESH_RUN_TTL_MINUTES = int(os.getenv('STATS_REFRESH_RUN_TTL_MINUTES', '60'))
+
+# Les IDs (uid Firebase / IDs auto) sont alphanumériques : on répartit les plages
+# sur le premier caractère, dans l'ordre de tri de Firestore.
+_ID_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+
+def shard_bounds(shard_count: int = STATS_REFRESH_SHARDS) -> list[tuple[str | None, str | None]]:
+    """Plages d'IDs [start, end) couvrant toute la collection (None = non borné)."""
+    shard_count = max(1, min(shard_count, len(_ID_ALPHABET)))
+    bounds = []
+    for index in range(shard_count):
+        start = _ID_ALPHABET[index * len(_ID_ALPHABET) // shard_count] if index > 0 else None
+        end = (
+            _ID_ALPHABET[(index + 1) * len(_ID_ALPHABET) // shard_count]
+            if index < shard_count - 1 else None
+        )
+        bounds.append((start, end))
+    return bounds
+
+
+def build_engine(db) -> StatsRefreshEngine:
+    """Moteur de rafraîchissement configuré pour le cron (batch YouTube, asyncio, BulkWriter)."""
+    from lib.youtube import update_youtube_stats, update_youtube_stats_batch, \
+        YOUTUBE_BATCH_REFRESH, YOUTUBE_BATCH_SIZE
+    from lib.tiktok import update_tiktok_stats
+    from lib.instagram import update_instagram_stats
+    from lib.async_refresh import update_tiktok_stats_many, update_instagram_stats_many, ASYNC_REFRESH
+    from lib.write_buffer import DeferredWriter
+
+    # Les appels YouTube d'une page sont regroupés en requêtes batch,
+    # les comptes TikTok/Instagram d'une page passent par le pipeline asyncio
+    batch_handlers = {}
+    if YOUTUBE_BATCH_REFRESH:
+        batch_handlers['youtube'] = update_youtube_stats_batch
+    if ASYNC_REFRESH:
+        batch_handlers['tiktok'] = update_tiktok_stats_many
+        batch_handlers['instagram'] = update_instagram_stats_many
+
+    # Les écritures de chaque page sont regroupées dans un BulkWriter
+    return StatsRefreshEngine({
+        'youtube': update_youtube_stats,
+        'tiktok': update_tiktok_stats,
+        'instagram': update_instagram_stats,
+    }, writer=DeferredWriter(db), batch_handlers=batch_handlers, batch_size={
+        'youtube': YOUTUBE_BATCH_SIZE,
+        'tiktok': REFRESH_PAGE_SIZE,
+        'instagram': REFRESH_PAGE_SIZE,
+    })
+
+
+def process_page(engine: StatsRefreshEngine, entries, db=None) -> set:
+    """
+    Rafraîchit les comptes dus d'une page (les plus en retard d'abord) :
+    précharge leurs tokens, renouvelle ceux qui doivent l'être, puis replanifie
+    chaque compte traité selon le résultat obtenu. Toutes les écritures de la
+    page (stats et planification) sont vidées au retour.
+
+    Retourne les user_ids non atteints avant l'échéance (non replanifiés).
+    """
+    from lib.token_store import get_tokens_for_users
+    from lib.instagram import token_needs_renewal, ensure_fresh_instagram_tokens
+    from lib.refresh_priority import load_schedules, refresh_priority, next_state, save_schedules
+    from lib.quota import flush_quota_ledgers
+
+    db = db or firestore.client()
+    now = datetime.now(timezone.utc)
+    schedules = load_schedules(db, [user_id for user_id, _ in entries])
+
+    due = []
+    for user_id, platforms in entries:
+        schedule = schedules.get(user_id, {})
+        for platform, previous_hash in platforms.items():
+            priority = refresh_priority(schedule, platform, now)
+            if priority is None:
+                engine.summary.record(platform, 'deferred')
+                continue
+            due.append((priority, platform, user_id, previous_hash))
+    if not due:
+        return set()
+
+    due.sort(key=lambda job: job[0], reverse=True)
+    tokens_by_user = get_tokens_for_users(list({user_id for _, _, user_id, _ in due}))
+
+    jobs = []
+    for _, platform, user_id, previous_hash in due:
+        platform_tokens = tokens_by_user.get(user_id, {}).get(platform, {})
+        if not platform_tokens:
+            continue
+
+        # Filet de sécurité si refresh_expiring_tokens n'a pas encore renouvelé le token
+        if platform == 'instagram' and token_needs_renewal(platform_tokens):
+            try:
+                platform_tokens = ensure_fresh_instagram_tokens(user_id, platform_tokens)
+                print(f"🔑 Token Instagram renouvelé pour {user_id}")
+            except Exception as exc:
+                print(f"❌ Renouvellement du token Instagram impossible pour {user_id}: {str(exc)}")
+
+        jobs.append((platform, user_id, platform_tokens, previous_hash))
+
+    outcomes = engine.run_page(jobs)
+    flush_quota_ledgers(db)
+    # Les comptes ignorés à l'échéance sont absents de `outcomes` : leur planification reste inchangée
+    unreached = engine.take_expired_users()
+
+    updates = {}
+    for (platform, user_id), result in outcomes.items():
+        schedule = schedules.get(user_id, {})
+        demand = bool(schedule.get('demandUntil') and schedule['demandUntil'] > now)
+        updates[(platform, user_id)] = next_state(schedule.get(platform), result, demand=demand, now=now)
+    # Vidées avant que l'appelant n'avance le curseur : un crash ne peut pas laisser
+    # derrière le curseur des comptes dont la planification n'a pas été écrite
+    save_schedules(db, updates, writer=engine.writer)
+    if engine.writer is not None:
+        for failure in engine.writer.flush():
+            # Planification inchangée : le compte sera simplement de nouveau dû au prochain run
+            print(f"⚠️ Planification non enregistrée ({failure['path']}): {failure['error']}")
+    return unreached
+
+
+def _enqueue_shard(run_id: str, shard_id: str, segment: int) -> None:
+    """Planifie l'exécution (ou la reprise) d'un shard dans la file de tâches."""
+    from firebase_admin import functions as admin_functions
+
+    queue = admin_functions.task_queue(SHARD_TASK_FUNCTION)
+    queue.enqueue(
+        {'runId': run_id, 'shard': shard_id},
+        admin_functions.TaskOptions(task_id=f'{run_id}-{shard_id}-{segment}')
+    )
+
+
+def _run_in_progress(db) -> str | None:
+    """ID du dernier run s'il est encore en cours et suffisamment récent."""
+    latest = list(
+        db.collection(RUNS_COLLECTION)
+        .order_by('createdAt', direction=firestore.Query.DESCENDING)
+        .limit(1)
+        .stream()
+    )
+    if not latest:
+        return None
+    data = latest[0].to_dict() or {}
+    created_at = data.get('createdAt')
+    if data.get('status') != 'running' or not created_at:
+        return None
+    if datetime.now(timezone.utc) - created_at > timedelta(minutes=STATS_REFRESH_RUN_TTL_MINUTES):
+        return None
+    return latest[0].id
+
+
+def start_refresh_run(db) -> str | None:
+    """
+    Crée le checkpoint d'un nouveau run et planifie une tâche par shard.
+    Retourne l'ID du run, ou None si un run précédent est encore en cours.
+    """
+    running = _run_in_progress(db)
+    if running:
+        print(f"⏳ Run {running} encore en cours, pas de nouveau run")
+        return None
+
+    now = datetime.now(timezone.utc)
+    run_id = now.strftime('%Y%m%dT%H%M%S')
+    shards = {
+        str(index): {
+            'start': start,
+            'end': end,
+            'cursor': None,
+            'segment': 0,
+            'processed': 0,
+            'status': 'pending'
+        }
+        for index, (start, end) in enumerate(shard_bounds())
+    }
+    db.collection(RUNS_COLLECTION).document(run_id).set({
+        'status': 'running',
+        'shards': shards,
+        'createdAt': now,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    })
+
+    for shard_id in shards:
+        _enqueue_shard(run_id, shard_id, 0)
+    return run_id
+
+
+def _record_summary(run_ref, shard_id: str, summary: dict) -> None:
+    updates = {f'shards.{shard_id}.updatedAt': firestore.SERVER_TIMESTAMP}
+    for platform, counters in summary['platforms'].items():
+        for outcome, count in counters.items():
+            if count:
+                updates[f'summary.{platform}.{outcome}'] = firestore.Increment(count)
+    run_ref.update(updates)
+
+
+def run_refresh_shard(db, run_id: str, shard_id: str) -> dict:
+    """
+    Traite un shard à partir de son dernier curseur sauvegardé.
+
+    Le curseur est enregistré après chaque page (une fois ses écritures vidées),
+    sans dépasser le premier compte laissé de côté par l'échéance.
+    Si l'échéance est atteinte avant la fin du shard, une tâche de reprise est
+    planifiée ; en cas de crash, la nouvelle tentative de la tâche repart du curseur.
+    """
+    run_ref = db.collection(RUNS_COLLECTION).document(run_id)
+    run_snap = run_ref.get()
+    if not run_snap.exists:
+        print(f"Run {run_id} introuvable")
+        return {}
+
+    shard = (run_snap.to_dict() or {}).get('shards', {}).get(shard_id)
+    if not shard or shard.get('status') == 'done':
+        return {}
+
+    run_ref.update({
+        f'shards.{shard_id}.status': 'running',
+        f'shards.{shard_id}.updatedAt': firestore.SERVER_TIMESTAMP
+    })
+
+    engine = build_engine(db)
+    cursor = shard.get('cursor')
+    finished = True
+
+    pages = iter_connected_influencer_pages(
+        db, start_id=shard.get('start'), end_id=shard.get('end'), after_id=cursor
+    )
+    for entries, last_id in pages:
+        if engine.expired():
+            finished = False
+            break
+
+        unreached = process_page(engine, entries, db)
+        if unreached:
+            # Échéance atteinte en cours de page : le curseur s'arrête avant le
+            # premier compte non traité, la reprise repartira de celui-ci
+            processed = next(index for index, (user_id, _) in enumerate(entries) if user_id in unreached)
+            if processed:
+                run_ref.update({
+                    f'shards.{shard_id}.cursor': entries[processed - 1][0],
+                    f'shards.{shard_id}.processed': firestore.Increment(processed),
+                    f'shards.{shard_id}.updatedAt': firestore.SERVER_TIMESTAMP
+                })
+            finished = False
+            break
+
+        run_ref.update({
+            f'shards.{shard_id}.cursor': last_id,
+            f'shards.{shard_id}.processed': firestore.Increment(len(entries)),
+            f'shards.{shard_id}.updatedAt': firestore.SERVER_TIMESTAMP
+        })
+        if engine.expired():
+            finished = False
+            break
+
+    summary = engine.wait()
+    _record_summary(run_ref, shard_id, summary)
+
+    if not finished:
+        segment = int(shard.get('segment', 0)) + 1
+        run_ref.update({
+            f'shards.{shard_id}.status': 'paused',
+            f'shards.{shard_id}.segment': segment
+        })
+        _enqueue_shard(run_id, shard_id, segment)
+        print(f"⏱️ Shard {shard_id} du run {run_id} interrompu, reprise planifiée")
+        return summary
+
+    run_ref.update({f'shards.{shard_id}.status': 'done'})
+    shards = (run_ref.get().to_dict() or {}).get('shards', {})
+    if all(s.get('status') == 'done' for s in shards.values()):
+        run_ref.update({'status': 'done', 'completedAt': firestore.SERVER_TIMESTAMP})
+
+    print(f"✨ Shard {shard_id} du run {run_id} terminé: {summary['success']} succès "
+          f"({summary['changed']} modifiés, {summary['unchanged']} inchangés), "
+          f"{summary['error']} erreurs, {summary['skipped']} ignorés, "
+          f"{summary['deferred']} pas encore dus")
+    return summary
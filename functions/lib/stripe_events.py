@@ -0,0 +1,156 @@
+"""
+Traitement des événements Stripe (webhook)
+Le webhook vérifie la signature, enregistre l'événement brut dans
+`stripeEvents/{eventId}` puis répond immédiatement ; une tâche
+`process_stripe_event` l'applique ensuite hors requête.
+
+Chaque événement est appliqué une seule fois : le registre est lu dans la même
+transaction que la session de paiement, et la mise à jour des collaborations,
+de la session et du registre est validée en un seul commit. Une livraison en
+double ne coûte alors qu'une lecture.
+
+Ordre par session : la transaction sur `paymentSessions/{id}` sérialise les
+événements d'une même session, et un événement plus ancien que le dernier
+appliqué (`lastStripeEventCreated`) est ignoré.
+"""
+
+import json
+from firebase_admin import firestore
+
+STRIPE_EVENTS_COLLECTION = 'stripeEvents'
+PAYMENT_SESSIONS_COLLECTION = 'paymentSessions'
+COLLABORATIONS_COLLECTION = 'collaborations'
+PROCESS_TASK_FUNCTION = 'process_stripe_event'
+
+
+def _session_updates(event_type: str, event_data: dict) -> tuple[dict, dict] | None:
+    """
+    Champs à écrire (collaborations, session) pour un type d'événement,
+    ou None si l'événement ne concerne pas les sessions de paiement.
+    """
+    if event_type == 'checkout.session.completed':
+        session_id = event_data.get('id')
+        payment_intent_id = event_data.get('payment_intent')
+        return {
+            'status': 'pending',
+            'paymentStatus': 'funds_held',
+            'stripeCheckoutSessionId': session_id,
+            'stripePaymentIntentId': payment_intent_id,
+            'paymentHeldAt': firestore.SERVER_TIMESTAMP,
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        }, {
+            'status': 'paid',
+            'stripePaymentIntentId': payment_intent_id,
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        }
+
+    if event_type == 'checkout.session.expired':
+        return {
+            'paymentStatus': 'not_requested',
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        }, {
+            'status': 'expired',
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        }
+
+    return None
+
+
+def _event_ref(db, event_id: str):
+    return db.collection(STRIPE_EVENTS_COLLECTION).document(event_id)
+
+
+def apply_stripe_event(db, event: dict) -> str:
+    """
+    Applique un événement Stripe de façon idempotente.
+    Retourne 'applied', 'duplicate' (déjà traité) ou 'superseded' (plus ancien
+    que le dernier événement appliqué à la session).
+    """
+    event_id = event.get('id')
+    event_type = event.get('type')
+    event_created = event.get('created') or 0
+    event_data = event.get('data', {}).get('object', {})
+    if not event_id:
+        raise ValueError('Événement Stripe sans identifiant')
+
+    event_ref = _event_ref(db, event_id)
+    updates = _session_updates(event_type, event_data)
+    session_id = event_data.get('id') if updates else None
+    session_ref = db.collection(PAYMENT_SESSIONS_COLLECTION).document(session_id) if session_id else None
+
+    @firestore.transactional
+    def _transaction(transaction):
+        event_snap = event_ref.get(transaction=transaction)
+        if event_snap.exists and (event_snap.to_dict() or {}).get('status') == 'processed':
+            return 'duplicate'
+
+        outcome = 'applied'
+        session_snap = session_ref.get(transaction=transaction) if session_ref is not None else None
+        if session_snap is not None and session_snap.exists:
+            session_data = session_snap.to_dict() or {}
+            last_created = session_data.get('lastStripeEventCreated') or 0
+            if event_created < last_created:
+                outcome = 'superseded'
+            else:
+                collab_updates, session_update = updates
+                collections = db.collection(COLLABORATIONS_COLLECTION)
+                for collab_id in session_data.get('collaborationIds', []):
+                    transaction.update(collections.document(collab_id), collab_updates)
+                transaction.update(session_ref, {**session_update, 'lastStripeEventCreated': event_created})
+
+        transaction.set(event_ref, {
+            'type': event_type,
+            'sessionId': session_id,
+            'stripeCreated': event_created,
+            'status': 'processed',
+            'outcome': outcome,
+            'processedAt': firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        return outcome
+
+    return _transaction(db.transaction())
+
+
+def record_stripe_event(db, event: dict, payload: bytes) -> bool:
+    """
+    Enregistre l'événement brut reçu par le webhook.
+    Retourne False s'il a déjà été traité (livraison en double).
+    """
+    from google.api_core.exceptions import AlreadyExists
+
+    event_data = event.get('data', {}).get('object', {})
+    event_ref = _event_ref(db, event['id'])
+    try:
+        event_ref.create({
+            'type': event.get('type'),
+            'sessionId': event_data.get('id') if str(event.get('type', '')).startswith('checkout.session.') else None,
+            'stripeCreated': event.get('created'),
+            'payload': payload.decode('utf-8'),
+            'status': 'received',
+            'receivedAt': firestore.SERVER_TIMESTAMP
+        })
+        return True
+    except AlreadyExists:
+        # Relivraison : à retraiter seulement si l'événement n'a pas abouti
+        snapshot = event_ref.get(field_paths=['status'])
+        return (snapshot.to_dict() or {}).get('status') != 'processed'
+
+
+def enqueue_stripe_event(event_id: str) -> None:
+    """Planifie le traitement d'un événement enregistré dans la file de tâches."""
+    from firebase_admin import functions as admin_functions
+
+    admin_functions.task_queue(PROCESS_TASK_FUNCTION).enqueue({'eventId': event_id})
+
+
+def process_stored_event(db, event_id: str) -> str | None:
+    """Applique un événement enregistré par le webhook ; None s'il est introuvable."""
+    snapshot = _event_ref(db, event_id).get()
+    if not snapshot.exists:
+        print(f"Événement Stripe {event_id} introuvable")
+        return None
+
+    stored = snapshot.to_dict() or {}
+    if stored.get('status') == 'processed':
+        return 'duplicate'
+    return apply_stripe_event(db, json.loads(stored['payload']))
@@ -5,11 +5,15 @@ OAuth + récupération des statistiques utilisateur
 
 import os
 import requests
-from urllib.parse import urlencode
+from lib import http_client
+from urllib.parse import urlencode, urlsplit, parse_qs
 from datetime import datetime, timedelta
 from typing import Optional
 from firebase_admin import firestore
 from lib.token_store import save_tokens
+from lib.token_refresh import refresh_tokens_once
+from lib.write_buffer import write_update
+from lib.change_detection import stats_fingerprint, heartbeat_update
 
 # ========================
 # CONFIGURATION
@@ -26,11 +30,29 @@ TIKTOK_VIDEO_LIST_URL = "https://open.tiktokapis.com/v2/video/list/"
 TIKTOK_USER_BASIC_FIELDS = "open_id,union_id,display_name,avatar_url"
 TIKTOK_USER_STATS_FIELDS = "follower_count,following_count,likes_count,video_count"
 TIKTOK_USER_FIELDS = f"{TIKTOK_USER_BASIC_FIELDS},{TIKTOK_USER_STATS_FIELDS}"
+TIKTOK_VIDEO_FIELDS = "id,title,cover_image_url,share_url,create_time,view_count,like_count"
+
+# Les URLs d'images TikTok sont signées et expirent (`x-expires`) : l'empreinte
+# retient l'échéance à la journée près, pour réécrire l'URL avant qu'elle ne meure
+# sans réécrire le profil à chaque nouvelle signature.
+SIGNED_URL_EXPIRY_BUCKET_SECONDS = 86400
+
+
+def _signed_url_version(url: str) -> str:
+    """Partie stable d'une URL signée, suivie de son échéance arrondie à la journée."""
+    if not url:
+        return ""
+    parts = urlsplit(url)
+    base = f"{parts.scheme}://{parts.netloc}{parts.path}"
+    expires = parse_qs(parts.query).get("x-expires", [""])[0]
+    if not expires.isdigit():
+        return base
+    return f"{base}#{int(expires) // SIGNED_URL_EXPIRY_BUCKET_SECONDS}"
 
 
 def _fetch_user_info(access_token: str, fields: str) -> dict:
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(
+    response = http_client.get(
         TIKTOK_USER_INFO_URL,
         headers=headers,
         params={"fields": fields},
@@ -70,12 +92,13 @@ def _fetch_tiktok_video_insights(
     }
 
     try:
-        response = requests.post(
+        response = http_client.post(
             TIKTOK_VIDEO_LIST_URL,
             headers=headers,
-            params={"fields": "id,title,cover_image_url,share_url,create_time,view_count,like_count"},
+            params={"fields": TIKTOK_VIDEO_FIELDS},
             json={"max_count": max_count},
-            timeout=20
+            timeout=20,
+            idempotent=True
         )
         response.raise_for_status()
     except requests.HTTPError as exc:
@@ -86,7 +109,13 @@ def _fetch_tiktok_video_insights(
     except requests.RequestException:
         return None, None, 0, False, []
 
-    payload = response.json() or {}
+    return _parse_video_insights(response.json() or {}, recent_limit)
+
+
+def _parse_video_insights(
+    payload: dict,
+    recent_limit: int = 6
+) -> tuple[Optional[int], Optional[int], int, bool, list[dict]]:
     videos = (payload.get("data") or {}).get("videos") or []
 
     view_values = [_to_int(video.get("view_count")) for video in videos]
@@ -154,7 +183,7 @@ def tiktok_callback(code: str, user_id: str) -> dict:
         "redirect_uri": TIKTOK_REDIRECT_URI
     }
 
-    token_res = requests.post(
+    token_res = http_client.post(
         TIKTOK_TOKEN_URL,
         data=token_payload,
         headers={"Content-Type": "application/x-www-form-urlencoded"}
@@ -207,7 +236,8 @@ def tiktok_callback(code: str, user_id: str) -> dict:
             "statsAccess": has_stats_access,
             "videoListAccess": has_video_list_access,
             "lastUpdated": firestore.SERVER_TIMESTAMP
-        }
+        },
+        "connectedPlatforms": firestore.ArrayUnion(["tiktok"])
     })
 
     expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
@@ -239,69 +269,115 @@ def tiktok_callback(code: str, user_id: str) -> dict:
 # UPDATE STATS (CRON)
 # ========================
 
-def update_tiktok_stats(user_id: str, tokens: dict) -> dict:
-    access_token = tokens["accessToken"]
-    refresh_token = tokens["refreshToken"]
-    expires_at = tokens["expiresAt"]
-
-    # Rafraîchir le token si nécessaire
-    if datetime.utcnow() >= expires_at.replace(tzinfo=None):
-        refresh_payload = {
-            "client_key": TIKTOK_CLIENT_KEY,
-            "client_secret": TIKTOK_CLIENT_SECRET,
-            "grant_type": "refresh_token",
-            "refresh_token": refresh_token
-        }
-
-        refresh_res = requests.post(
-            TIKTOK_TOKEN_URL,
-            data=refresh_payload,
-            headers={"Content-Type": "application/x-www-form-urlencoded"}
-        )
-        refresh_res.raise_for_status()
-        refreshed = refresh_res.json()
+def _token_expired(tokens: dict, margin: timedelta = timedelta()) -> bool:
+    """Vrai si l'access token est expiré (ou expire dans `margin`)."""
+    return datetime.utcnow() + margin >= tokens["expiresAt"].replace(tzinfo=None)
 
-        access_token = refreshed["access_token"]
-        refresh_token = refreshed["refresh_token"]
-        expires_at = datetime.utcnow() + timedelta(
-            seconds=refreshed["expires_in"]
-        )
 
-        save_tokens(user_id, "tiktok", {
-            "accessToken": access_token,
-            "refreshToken": refresh_token,
-            "expiresAt": expires_at,
-            "updatedAt": firestore.SERVER_TIMESTAMP
-        })
+def _refresh_request_payload(refresh_token: str) -> dict:
+    return {
+        "client_key": TIKTOK_CLIENT_KEY,
+        "client_secret": TIKTOK_CLIENT_SECRET,
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token
+    }
+
+
+def _request_token_refresh(tokens: dict) -> dict:
+    """
+    Échange le refresh token contre de nouveaux tokens (format oauthTokens).
+    La map retournée remplace celle stockée : les autres champs (createdAt, ...) sont conservés.
+    """
+    refresh_res = http_client.post(
+        TIKTOK_TOKEN_URL,
+        data=_refresh_request_payload(tokens["refreshToken"]),
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    refresh_res.raise_for_status()
+    refreshed = refresh_res.json()
+
+    return {
+        **{key: value for key, value in tokens.items() if key != "refreshLease"},
+        "accessToken": refreshed["access_token"],
+        "refreshToken": refreshed.get("refresh_token", tokens["refreshToken"]),
+        "expiresAt": datetime.utcnow() + timedelta(seconds=refreshed["expires_in"]),
+        "updatedAt": firestore.SERVER_TIMESTAMP
+    }
 
-    # Récupération profil/stats avec fallback
-    user, has_stats_access = _get_tiktok_user_with_fallback(access_token)
-    total_views, avg_views, sampled_videos, has_video_list_access, recent_videos = _fetch_tiktok_video_insights(access_token)
+
+def ensure_fresh_tiktok_tokens(user_id: str, tokens: dict, margin: timedelta = timedelta()) -> dict:
+    """
+    Retourne des tokens TikTok valides, rafraîchis s'ils expirent dans `margin`.
+    Un seul rafraîchissement a lieu par utilisateur (single-flight + bail Firestore) :
+    TikTok fait tourner le refresh token, deux rafraîchissements simultanés
+    invalideraient l'un des deux.
+    """
+    return refresh_tokens_once(
+        user_id, "tiktok", tokens,
+        lambda current: _token_expired(current, margin),
+        _request_token_refresh
+    )
+
+
+def _persist_tiktok_stats(user_id: str, user: dict, has_stats_access: bool, insights: tuple,
+                          writer=None, previous_hash: Optional[str] = None) -> dict:
+    """Écrit les stats TikTok (si elles ont changé) et retourne le résultat du rafraîchissement."""
+    total_views, avg_views, sampled_videos, has_video_list_access, recent_videos = insights
+
+    stats = {
+        "username": user.get("display_name") or "",
+        "avatarUrl": user.get("avatar_url") or "",
+        "followers": int(user.get("follower_count", 0) or 0),
+        "following": int(user.get("following_count", 0) or 0),
+        "likes": int(user.get("likes_count", 0) or 0),
+        "videoCount": int(user.get("video_count", 0) or 0),
+        "views": total_views,
+        "avgViews": avg_views,
+        "sampledVideos": sampled_videos,
+        "statsAccess": has_stats_access,
+        "videoListAccess": has_video_list_access
+    }
+    # URLs signées (avatar, couvertures) : partie stable + échéance à la journée
+    stats_hash = stats_fingerprint(
+        {**stats, "avatarUrl": _signed_url_version(stats["avatarUrl"])},
+        [f'{video["id"]}:{_signed_url_version(video.get("thumbnail") or "")}' for video in recent_videos]
+    )
+    changed = stats_hash != previous_hash
 
     db = firestore.client()
-    db.collection("influencers").document(user_id).update({
-        "tiktokVideos": recent_videos,
-        "socialAccounts.tiktok.username": user.get("display_name") or "",
-        "socialAccounts.tiktok.avatarUrl": user.get("avatar_url") or "",
-        "socialAccounts.tiktok.followers": int(user.get("follower_count", 0) or 0),
-        "socialAccounts.tiktok.following": int(user.get("following_count", 0) or 0),
-        "socialAccounts.tiktok.likes": int(user.get("likes_count", 0) or 0),
-        "socialAccounts.tiktok.videoCount": int(user.get("video_count", 0) or 0),
-        "socialAccounts.tiktok.views": total_views,
-        "socialAccounts.tiktok.avgViews": avg_views,
-        "socialAccounts.tiktok.sampledVideos": sampled_videos,
-        "socialAccounts.tiktok.recentVideos": recent_videos,
-        "socialAccounts.tiktok.statsAccess": has_stats_access,
-        "socialAccounts.tiktok.videoListAccess": has_video_list_access,
-        "socialAccounts.tiktok.lastUpdated": firestore.SERVER_TIMESTAMP
-    })
+    user_ref = db.collection("influencers").document(user_id)
+    if changed:
+        write_update(user_ref, {
+            "tiktokVideos": recent_videos,
+            **{f"socialAccounts.tiktok.{key}": value for key, value in stats.items()},
+            "socialAccounts.tiktok.recentVideos": recent_videos,
+            "socialAccounts.tiktok.statsHash": stats_hash,
+            "socialAccounts.tiktok.lastUpdated": firestore.SERVER_TIMESTAMP
+        }, writer=writer, tag=("tiktok", user_id))
+    elif heartbeat_update("tiktok"):
+        write_update(user_ref, heartbeat_update("tiktok"), writer=writer, tag=("tiktok", user_id))
 
     return {
         "success": True,
-        "followers": int(user.get("follower_count", 0) or 0),
+        "changed": changed,
+        "followers": stats["followers"],
         "statsAccess": has_stats_access,
         "videoListAccess": has_video_list_access,
         "avgViews": avg_views,
         "sampledVideos": sampled_videos,
         "recentVideos": recent_videos
     }
+
+
+def update_tiktok_stats(user_id: str, tokens: dict, writer=None, previous_hash: Optional[str] = None) -> dict:
+    # Rafraîchir le token si nécessaire (une seule fois par utilisateur)
+    access_token = ensure_fresh_tiktok_tokens(user_id, tokens)["accessToken"]
+
+    # Récupération profil/stats avec fallback
+    user, has_stats_access = _get_tiktok_user_with_fallback(access_token)
+    insights = _fetch_tiktok_video_insights(access_token)
+
+    return _persist_tiktok_stats(
+        user_id, user, has_stats_access, insights,
+        writer=writer, previous_hash=previous_hash
+    )
@@ -0,0 +1,262 @@
+"""
+Rafraîchissement coordonné des tokens OAuth
+Un seul rafraîchissement par utilisateur et plateforme, même si le cron et un
+endpoint (ex. force_tiktok_update) le déclenchent en même temps :
+- single-flight en mémoire pour les appels concurrents d'une même instance ;
+- bail (lease) posé par transaction Firestore sur `oauthTokens/{uid}` entre instances.
+Les appelants qui n'ont pas le bail réutilisent le token écrit par son détenteur.
+"""
+
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+
+from lib.token_store import TOKENS_COLLECTION, replace_platform_tokens, iter_expiring_tokens
+
+# Durée du bail : au-delà, un rafraîchissement interrompu peut être repris
+TOKEN_REFRESH_LEASE_SECONDS = int(os.getenv('TOKEN_REFRESH_LEASE_SECONDS', '30'))
+# Attente maximale du token rafraîchi par un autre détenteur du bail
+TOKEN_REFRESH_WAIT_SECONDS = float(os.getenv('TOKEN_REFRESH_WAIT_SECONDS', '20'))
+TOKEN_REFRESH_POLL_SECONDS = 0.5
+
+# Job proactif : fenêtre d'anticipation par plateforme (les access tokens YouTube
+# vivent 1 h, TikTok 24 h, les long-lived tokens Instagram 60 jours)
+PROACTIVE_REFRESH_WINDOWS = {
+    'youtube': timedelta(minutes=int(os.getenv('YOUTUBE_TOKEN_REFRESH_WINDOW_MINUTES', '15'))),
+    'tiktok': timedelta(minutes=int(os.getenv('TIKTOK_TOKEN_REFRESH_WINDOW_MINUTES', '120'))),
+    'instagram': timedelta(days=int(os.getenv('INSTAGRAM_RENEWAL_WINDOW_DAYS', '10'))),
+}
+# Renouvelés sans attendre le prochain rafraîchissement des stats : un long-lived
+# token Instagram expiré ne peut plus être renouvelé
+SCHEDULE_EXEMPT_PLATFORMS = ('instagram',)
+TOKEN_REFRESH_BATCH_SIZE = int(os.getenv('TOKEN_REFRESH_BATCH_SIZE', '100'))
+TOKEN_REFRESH_CONCURRENCY = int(os.getenv('TOKEN_REFRESH_CONCURRENCY', '8'))
+TOKEN_REFRESH_DEADLINE_SECONDS = int(os.getenv('TOKEN_REFRESH_DEADLINE_SECONDS', '240'))
+
+
+class TokenRefreshError(Exception):
+    """Le token n'a pas pu être rafraîchi (ni obtenu d'un autre rafraîchissement)."""
+
+
+class SingleFlight:
+    """Regroupe les appels concurrents d'une même clé : un seul exécute `func`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as exc:
+            call['error'] = exc
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['event'].set()
+
+
+_single_flight = SingleFlight()
+# Identifiant de cette instance, porté par les bails qu'elle pose
+_HOLDER_PREFIX = uuid.uuid4().hex
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _acquire_lease(db, user_id: str, platform: str, holder: str, is_expired) -> tuple[bool, dict]:
+    """
+    Pose le bail de rafraîchissement si le token est encore expiré et qu'aucun
+    bail valide n'est détenu par un autre. Retourne (bail obtenu, tokens actuels),
+    ou (False, {}) si aucun token n'est enregistré pour la plateforme.
+    """
+    doc_ref = db.collection(TOKENS_COLLECTION).document(user_id)
+
+    @firestore.transactional
+    def _transaction(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        current = ((snapshot.to_dict() or {}) if snapshot.exists else {}).get(platform) or {}
+        if not current:
+            # Compte déconnecté entre-temps : rien à rafraîchir (ni à recréer)
+            return False, {}
+        if not is_expired(current):
+            return False, current
+
+        lease = current.get('refreshLease') or {}
+        lease_expires_at = lease.get('expiresAt')
+        if lease.get('holder') not in (None, holder) and lease_expires_at and lease_expires_at > _now():
+            return False, current
+
+        transaction.update(doc_ref, {
+            f'{platform}.refreshLease': {
+                'holder': holder,
+                'expiresAt': _now() + timedelta(seconds=TOKEN_REFRESH_LEASE_SECONDS)
+            }
+        })
+        return True, current
+
+    return _transaction(db.transaction())
+
+
+def _release_lease(db, user_id: str, platform: str) -> None:
+    try:
+        db.collection(TOKENS_COLLECTION).document(user_id).update({
+            f'{platform}.refreshLease': firestore.DELETE_FIELD
+        })
+    except Exception as exc:
+        print(f"Libération du bail {platform} impossible pour {user_id}: {str(exc)}")
+
+
+def _refresh_with_lease(user_id: str, platform: str, tokens: dict, is_expired, refresh) -> dict:
+    db = firestore.client()
+    holder = f'{_HOLDER_PREFIX}:{threading.get_ident()}'
+    deadline = time.monotonic() + TOKEN_REFRESH_WAIT_SECONDS
+
+    while True:
+        acquired, current = _acquire_lease(db, user_id, platform, holder, is_expired)
+        if current and not is_expired(current):
+            # Déjà rafraîchi par un autre appelant
+            return current
+
+        if not acquired and not current:
+            raise TokenRefreshError(f'Aucun token {platform} enregistré pour {user_id}')
+
+        if acquired:
+            # Toujours partir du refresh token stocké : l'ancien peut avoir été invalidé
+            stored = {key: value for key, value in {**tokens, **current}.items() if key != 'refreshLease'}
+            try:
+                refreshed = refresh(stored)
+            except Exception:
+                _release_lease(db, user_id, platform)
+                raise
+            # Remplace la map de la plateforme, ce qui retire aussi le bail
+            replace_platform_tokens(user_id, platform, refreshed)
+            return refreshed
+
+        if time.monotonic() >= deadline:
+            raise TokenRefreshError(f'Rafraîchissement {platform} en cours ailleurs pour {user_id}')
+        time.sleep(TOKEN_REFRESH_POLL_SECONDS)
+
+
+def refresh_tokens_once(user_id: str, platform: str, tokens: dict, is_expired, refresh) -> dict:
+    """
+    Retourne des tokens valides pour (user_id, platform) en garantissant un seul
+    rafraîchissement à la fois.
+
+    Args:
+        tokens: Tokens connus de l'appelant (éventuellement périmés)
+        is_expired: Fonction tokens -> bool
+        refresh: Fonction tokens -> nouveaux tokens (appel à l'API du fournisseur)
+    """
+    if not is_expired(tokens):
+        return tokens
+    return _single_flight.do(
+        (platform, user_id),
+        lambda: _refresh_with_lease(user_id, platform, tokens, is_expired, refresh)
+    )
+
+
+def _proactive_refreshers() -> dict:
+    from lib.youtube import ensure_fresh_youtube_tokens
+    from lib.tiktok import ensure_fresh_tiktok_tokens
+    from lib.instagram import ensure_fresh_instagram_tokens
+
+    return {
+        'youtube': ensure_fresh_youtube_tokens,
+        'tiktok': ensure_fresh_tiktok_tokens,
+        'instagram': ensure_fresh_instagram_tokens,
+    }
+
+
+def _due_within(db, platform: str, jobs: list, horizon: datetime) -> list:
+    """Garde les comptes dont le prochain rafraîchissement des stats tombe avant `horizon`."""
+    from lib.refresh_priority import load_schedules, refresh_priority
+
+    schedules = load_schedules(db, [user_id for user_id, _ in jobs])
+    return [
+        (user_id, tokens) for user_id, tokens in jobs
+        if refresh_priority(schedules.get(user_id, {}), platform, horizon) is not None
+    ]
+
+
+def refresh_expiring_tokens(platforms=None, deadline_seconds: int = TOKEN_REFRESH_DEADLINE_SECONDS) -> dict:
+    """
+    Rafraîchit par lots les tokens encore valides qui expirent dans la fenêtre de
+    leur plateforme (requête sur `<platform>.expiresAt`), pour que le cron des
+    stats démarre presque toujours avec un access token valide.
+
+    Seuls les comptes dont le rafraîchissement des stats est prévu dans la fenêtre
+    (`statsRefreshSchedule`) sont traités : les autres seront rafraîchis à la
+    volée lors de leur prochain passage. Les long-lived tokens Instagram font
+    exception : une fois expirés ils ne peuvent plus être renouvelés.
+    Les tokens déjà expirés restent rafraîchis à la volée par le cron.
+
+    Retourne {platform: {'refreshed': n, 'skipped': n, 'error': n}}.
+    """
+    refreshers = _proactive_refreshers()
+    deadline = time.monotonic() + deadline_seconds
+    db = firestore.client()
+    summary = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, TOKEN_REFRESH_CONCURRENCY),
+                            thread_name_prefix='token-refresh') as executor:
+        for platform in platforms or PROACTIVE_REFRESH_WINDOWS:
+            counters = summary.setdefault(platform, {'refreshed': 0, 'skipped': 0, 'error': 0})
+            window = PROACTIVE_REFRESH_WINDOWS[platform]
+            ensure_fresh = refreshers[platform]
+            now = _now()
+
+            def _refresh_one(job):
+                user_id, tokens = job
+                try:
+                    ensure_fresh(user_id, tokens, margin=window)
+                    return True
+                except Exception as exc:
+                    print(f"❌ Rafraîchissement proactif {platform} impossible pour {user_id}: {str(exc)}")
+                    return False
+
+            def _refresh_batch(batch):
+                due = batch if platform in SCHEDULE_EXEMPT_PLATFORMS else _due_within(db, platform, batch, now + window)
+                counters['skipped'] += len(batch) - len(due)
+                for ok in executor.map(_refresh_one, due):
+                    counters['refreshed' if ok else 'error'] += 1
+
+            batch = []
+            expiring = iter_expiring_tokens(platform, now, now + window, page_size=TOKEN_REFRESH_BATCH_SIZE)
+            for job in expiring:
+                batch.append(job)
+                if len(batch) < TOKEN_REFRESH_BATCH_SIZE:
+                    continue
+                _refresh_batch(batch)
+                batch = []
+                if time.monotonic() >= deadline:
+                    break
+            else:
+                if batch:
+                    _refresh_batch(batch)
+
+            if time.monotonic() >= deadline:
+                print("⏱️ Échéance atteinte, rafraîchissement proactif des tokens interrompu")
+                break
+
+    return summary
@@ -6,18 +6,24 @@ from firebase_admin import firestore
 
 TOKENS_COLLECTION = 'oauthTokens'
 
+# Nombre de documents lus par appel get_all
+GET_ALL_CHUNK_SIZE = 100
 
-def save_tokens(user_id: str, platform: str, token_payload: dict) -> None:
+
+def save_tokens(user_id: str, platform: str, token_payload: dict, writer=None) -> None:
     """
     Persist tokens for a given user/platform combination.
     Tokens are stored in the oauthTokens collection and are not exposed to clients.
+    When a DeferredWriter is given, the write is queued instead of sent right away.
     """
+    from lib.write_buffer import write_set
+
     db = firestore.client()
     doc_ref = db.collection(TOKENS_COLLECTION).document(user_id)
-    doc_ref.set({
+    write_set(doc_ref, {
         platform: token_payload,
         'updatedAt': firestore.SERVER_TIMESTAMP
-    }, merge=True)
+    }, merge=True, writer=writer, tag=(platform, user_id))
 
 
 def get_user_tokens(user_id: str) -> dict:
@@ -29,6 +35,64 @@ def get_user_tokens(user_id: str) -> dict:
     return snapshot.to_dict() or {}
 
 
+def get_tokens_for_users(user_ids) -> dict:
+    """
+    Fetch tokens for many users with batched reads (db.get_all in chunks).
+    Returns a mapping user_id -> tokens dict ({} when nothing is stored).
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    tokens_by_user = {user_id: {} for user_id in user_ids}
+    if not user_ids:
+        return tokens_by_user
+
+    db = firestore.client()
+    collection = db.collection(TOKENS_COLLECTION)
+    for start in range(0, len(user_ids), GET_ALL_CHUNK_SIZE):
+        refs = [collection.document(user_id) for user_id in user_ids[start:start + GET_ALL_CHUNK_SIZE]]
+        for snapshot in db.get_all(refs):
+            if snapshot.exists:
+                tokens_by_user[snapshot.id] = snapshot.to_dict() or {}
+    return tokens_by_user
+
+
+def replace_platform_tokens(user_id: str, platform: str, token_payload: dict) -> None:
+    """
+    Replace the whole token map of a platform (unlike save_tokens, which merges).
+    Transient fields such as a refresh lease are dropped along the way.
+    """
+    db = firestore.client()
+    db.collection(TOKENS_COLLECTION).document(user_id).update({
+        platform: token_payload,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    })
+
+
+def iter_expiring_tokens(platform: str, not_before, not_after, page_size: int = 100):
+    """
+    Yield (user_id, platform tokens) whose `<platform>.expiresAt` falls within
+    [not_before, not_after], soonest first. Relies on the automatic single-field
+    index on the nested `expiresAt` field; pages are read with a cursor.
+    """
+    db = firestore.client()
+    field = f'{platform}.expiresAt'
+    query = (
+        db.collection(TOKENS_COLLECTION)
+        .where(field, '>=', not_before)
+        .where(field, '<=', not_after)
+        .order_by(field)
+        .limit(page_size)
+    )
+    last_snapshot = None
+    while True:
+        page_query = query.start_after(last_snapshot) if last_snapshot is not None else query
+        snapshots = list(page_query.stream())
+        for snapshot in snapshots:
+            yield snapshot.id, (snapshot.to_dict() or {}).get(platform) or {}
+        if len(snapshots) < page_size:
+            return
+        last_snapshot = snapshots[-1]
+
+
 def delete_tokens(user_id: str, platform: str) -> None:
     """Remove tokens for a given platform."""
     db = firestore.client()
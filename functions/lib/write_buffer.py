@@ -0,0 +1,132 @@
+"""
+Écritures Firestore différées pour les rafraîchissements de stats
+Les mises à jour sont mises en file dans un BulkWriter (contrôle de débit intégré)
+puis vidées en fin de page, avec remontée des échecs document par document.
+"""
+
+import os
+import threading
+from collections import defaultdict, deque
+from firebase_admin import firestore
+
+# Débit maximal d'écriture du BulkWriter (la montée en charge suit la règle 500/50/5)
+MAX_WRITES_PER_SECOND = int(os.getenv('REFRESH_MAX_WRITES_PER_SECOND', '500'))
+# Nombre de tentatives par écriture avant de la considérer en échec
+MAX_WRITE_ATTEMPTS = int(os.getenv('REFRESH_MAX_WRITE_ATTEMPTS', '5'))
+# Limite Firestore du nombre d'écritures par WriteBatch
+MAX_BATCH_WRITES = 500
+
+
+class DeferredWriter:
+    """
+    Tampon d'écritures adossé à un BulkWriter Firestore.
+
+    Chaque écriture porte un `tag` (par ex. ('youtube', user_id)) qui permet de
+    rattacher un échec au compte concerné lors du `flush()`.
+    """
+
+    def __init__(self, db=None):
+        from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+
+        self._db = db or firestore.client()
+        self._writer = self._db.bulk_writer(options=BulkWriterOptions(
+            initial_ops_per_second=min(500, MAX_WRITES_PER_SECOND),
+            max_ops_per_second=MAX_WRITES_PER_SECOND
+        ))
+        self._writer.on_write_result(self._on_write_result)
+        self._writer.on_write_error(self._on_write_error)
+        self._lock = threading.Lock()
+        # Verrou distinct pour l'accès au BulkWriter : ses callbacks utilisent `_lock`
+        self._write_lock = threading.Lock()
+        # Tags en attente par chemin de document, dans l'ordre d'envoi
+        self._pending_tags = defaultdict(deque)
+        self._failures = []
+
+    def _enqueue_tag(self, reference, tag) -> None:
+        with self._lock:
+            self._pending_tags[reference.path].append(tag)
+
+    def _pop_tag(self, reference):
+        with self._lock:
+            pending = self._pending_tags.get(reference.path)
+            if not pending:
+                return None
+            tag = pending.popleft()
+            if not pending:
+                del self._pending_tags[reference.path]
+            return tag
+
+    def _on_write_result(self, reference, result, bulk_writer) -> None:
+        self._pop_tag(reference)
+
+    def _on_write_error(self, error, bulk_writer) -> bool:
+        attempts = getattr(error, 'attempts', MAX_WRITE_ATTEMPTS)
+        if attempts < MAX_WRITE_ATTEMPTS:
+            return True
+
+        reference = error.operation.reference
+        tag = self._pop_tag(reference)
+        with self._lock:
+            self._failures.append({
+                'tag': tag,
+                'path': reference.path,
+                'error': f'{error.code}: {error.message}'
+            })
+        print(f"❌ Écriture différée en échec pour {reference.path}: {error.message}")
+        return False
+
+    def update(self, reference, data: dict, tag=None) -> None:
+        self._enqueue_tag(reference, tag)
+        with self._write_lock:
+            self._writer.update(reference, data)
+
+    def set(self, reference, data: dict, merge: bool = False, tag=None) -> None:
+        self._enqueue_tag(reference, tag)
+        with self._write_lock:
+            self._writer.set(reference, data, merge=merge)
+
+    def flush(self) -> list[dict]:
+        """
+        Envoie toutes les écritures en file et attend leur résultat.
+        Retourne (et réinitialise) la liste des échecs définitifs.
+        """
+        self._writer.flush()
+        with self._lock:
+            failures, self._failures = self._failures, []
+        return failures
+
+    def close(self) -> list[dict]:
+        failures = self.flush()
+        self._writer.close()
+        return failures
+
+
+def write_update(reference, data: dict, writer: DeferredWriter | None = None, tag=None) -> None:
+    """Met à jour un document immédiatement, ou via le tampon différé s'il est fourni."""
+    if writer is not None:
+        writer.update(reference, data, tag=tag)
+    else:
+        reference.update(data)
+
+
+def write_set(reference, data: dict, merge: bool = False,
+              writer: DeferredWriter | None = None, tag=None) -> None:
+    """Écrit un document immédiatement, ou via le tampon différé s'il est fourni."""
+    if writer is not None:
+        writer.set(reference, data, merge=merge, tag=tag)
+    else:
+        reference.set(data, merge=merge)
+
+
+def commit_sets(db, operations, chunk_size: int = MAX_BATCH_WRITES) -> int:
+    """
+    Écrit une liste de (référence, données, merge) en WriteBatch de `chunk_size`.
+    Chaque lot est atomique ; retourne le nombre d'écritures envoyées.
+    """
+    operations = list(operations)
+    for start in range(0, len(operations), chunk_size):
+        batch = db.batch()
+        for reference, data, merge in operations[start:start + chunk_size]:
+            batch.set(reference, data, merge=merge)
+        batch.commit()
+    return len(operations)
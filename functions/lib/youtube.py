@@ -4,12 +4,22 @@ Gestion de l'OAuth et récupération des statistiques
 """
 
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
+import google_auth_httplib2
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from firebase_admin import firestore
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from lib.token_store import save_tokens
+from lib.token_refresh import refresh_tokens_once
+from lib.write_buffer import write_update
+from lib.change_detection import stats_fingerprint, heartbeat_update
+from lib.quota import QuotaExceededError, get_governor, observe_youtube_error, is_youtube_quota_error
+from lib.resilience import CircuitOpenError, RETRY_STATUSES, call_with_retries, get_breaker
 
 # Configuration YouTube OAuth
 YOUTUBE_CLIENT_ID = os.getenv('YOUTUBE_CLIENT_ID')
@@ -18,6 +28,50 @@ YOUTUBE_REDIRECT_URI = os.getenv('YOUTUBE_REDIRECT_URI')
 
 SCOPES = ['https://www.googleapis.com/auth/youtube.readonly']
 
+YOUTUBE_HTTP_TIMEOUT = int(os.getenv('YOUTUBE_HTTP_TIMEOUT', '20'))
+# Hôte de l'API (disjoncteur partagé par les appels simples et batch)
+YOUTUBE_API_HOST = 'www.googleapis.com'
+
+# Mode batch du cron : nombre de sous-requêtes regroupées par aller-retour HTTP
+YOUTUBE_BATCH_REFRESH = os.getenv('YOUTUBE_BATCH_REFRESH', 'true').lower() == 'true'
+YOUTUBE_BATCH_SIZE = int(os.getenv('YOUTUBE_BATCH_SIZE', '50'))
+# Un access token qui expire dans ce délai est renouvelé (sous bail) avant les appels du cron,
+# plutôt que par le rafraîchissement implicite de google-auth sur 401
+YOUTUBE_TOKEN_MARGIN = timedelta(seconds=int(os.getenv('YOUTUBE_TOKEN_MARGIN_SECONDS', '300')))
+
+# Client YouTube construit une seule fois par instance (réutilisé entre invocations)
+_youtube_service = None
+_youtube_service_lock = threading.Lock()
+
+
+def get_youtube_service():
+    """
+    Retourne le client YouTube Data API v3 mis en cache au niveau du module.
+
+    Le client est construit depuis le document de découverte embarqué dans
+    google-api-python-client (aucun appel réseau, pas de cache fichier) et sans
+    credentials : chaque requête reçoit un `http` autorisé via `_authorized_http`.
+    """
+    global _youtube_service
+    if _youtube_service is None:
+        with _youtube_service_lock:
+            if _youtube_service is None:
+                _youtube_service = build(
+                    'youtube', 'v3',
+                    http=httplib2.Http(timeout=YOUTUBE_HTTP_TIMEOUT),
+                    static_discovery=True,
+                    cache_discovery=False
+                )
+    return _youtube_service
+
+
+def _authorized_http(credentials: Credentials):
+    """Transport HTTP portant les credentials d'un utilisateur (rafraîchis sur 401)."""
+    return google_auth_httplib2.AuthorizedHttp(
+        credentials,
+        http=httplib2.Http(timeout=YOUTUBE_HTTP_TIMEOUT)
+    )
+
 
 def get_oauth_flow():
     """Créer le flow OAuth pour YouTube"""
@@ -74,9 +128,10 @@ def youtube_callback(code: str, user_id: str):
         credentials = flow.credentials
         print("[YouTube Callback] Tokens récupérés avec succès")
         
-        # Créer le client YouTube
-        youtube = build('youtube', 'v3', credentials=credentials)
-        print("[YouTube Callback] Client YouTube créé")
+        # Client YouTube partagé, requêtes signées avec les credentials de l'utilisateur
+        youtube = get_youtube_service()
+        http = _authorized_http(credentials)
+        print("[YouTube Callback] Client YouTube prêt")
         
         # Récupérer les infos du canal
         request = youtube.channels().list(
@@ -84,7 +139,7 @@ def youtube_callback(code: str, user_id: str):
             mine=True
         )
         print("[YouTube Callback] Exécution de la requête channels().list()...")
-        response = request.execute()
+        response = request.execute(http=http)
         print(f"[YouTube Callback] Réponse reçue: {response}")
         
         # Vérifier que la réponse contient des items
@@ -110,7 +165,7 @@ def youtube_callback(code: str, user_id: str):
             playlistId=uploads_playlist_id,
             maxResults=6
         )
-        videos_response = videos_request.execute()
+        videos_response = videos_request.execute(http=http)
         
         # Récupérer les stats de chaque vidéo
         video_ids = [item['contentDetails']['videoId'] for item in videos_response['items']]
@@ -119,7 +174,7 @@ def youtube_callback(code: str, user_id: str):
             part='statistics,snippet',
             id=','.join(video_ids)
         )
-        videos_stats_response = videos_stats_request.execute()
+        videos_stats_response = videos_stats_request.execute(http=http)
         
         # Formater les vidéos
         recent_videos = []
@@ -149,7 +204,8 @@ def youtube_callback(code: str, user_id: str):
                 'viewCount': view_count,
                 'lastUpdated': firestore.SERVER_TIMESTAMP,
                 'recentVideos': recent_videos
-            }
+            },
+            'connectedPlatforms': firestore.ArrayUnion(['youtube'])
         })
 
         save_tokens(user_id, 'youtube', {
@@ -159,6 +215,7 @@ def youtube_callback(code: str, user_id: str):
             'clientId': credentials.client_id,
             'clientSecret': credentials.client_secret,
             'scopes': list(credentials.scopes),
+            'expiresAt': credentials.expiry,
             'createdAt': firestore.SERVER_TIMESTAMP
         })
         
@@ -178,106 +235,379 @@ def youtube_callback(code: str, user_id: str):
         raise
 
 
-def update_youtube_stats(user_id: str, tokens: dict) -> dict:
+def _is_transient(exc: Exception) -> bool:
+    """Erreur passagère de l'API YouTube (5xx, timeout, connexion) justifiant un retry."""
+    if isinstance(exc, HttpError):
+        return exc.resp.status in RETRY_STATUSES
+    return isinstance(exc, (OSError, httplib2.HttpLib2Error))
+
+
+def _execute(request, http):
+    """
+    Exécute une requête YouTube (1 unité par tentative) sous le contrôle du
+    gouverneur de quota, avec retries et disjoncteur sur l'hôte de l'API.
+    """
+    governor = get_governor('youtube')
+
+    def _attempt():
+        # Chaque tentative (retries compris) consomme une unité
+        governor.acquire()
+        return request.execute(http=http)
+
+    try:
+        response = call_with_retries(
+            _attempt,
+            breaker=get_breaker(YOUTUBE_API_HOST),
+            is_transient=_is_transient
+        )
+    except HttpError as exc:
+        observe_youtube_error(exc)
+        raise
+    governor.on_success()
+    return response
+
+
+def _youtube_credentials(tokens: dict) -> Credentials:
+    """Recrée les credentials Google depuis les tokens sauvegardés."""
+    expires_at = tokens.get('expiresAt')
+    return Credentials(
+        token=tokens.get('accessToken'),
+        refresh_token=tokens.get('refreshToken'),
+        token_uri=tokens.get('tokenUri'),
+        client_id=tokens.get('clientId'),
+        client_secret=tokens.get('clientSecret'),
+        scopes=tokens.get('scopes'),
+        # google-auth attend une date UTC naïve
+        expiry=expires_at.replace(tzinfo=None) if expires_at else None
+    )
+
+
+def _token_expired(tokens: dict, margin: timedelta = timedelta()) -> bool:
+    """Vrai si l'access token expire dans `margin` (inconnu = laissé à google-auth)."""
+    expires_at = tokens.get('expiresAt')
+    return bool(expires_at) and datetime.utcnow() + margin >= expires_at.replace(tzinfo=None)
+
+
+def _request_token_refresh(tokens: dict) -> dict:
+    """Rafraîchit l'access token Google et retourne les tokens à sauvegarder."""
+    credentials = _youtube_credentials(tokens)
+    credentials.refresh(google_auth_httplib2.Request(httplib2.Http(timeout=YOUTUBE_HTTP_TIMEOUT)))
+    return {
+        **tokens,
+        'accessToken': credentials.token,
+        'expiresAt': credentials.expiry,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    }
+
+
+def ensure_fresh_youtube_tokens(user_id: str, tokens: dict, margin: timedelta = timedelta()) -> dict:
+    """Retourne des tokens YouTube valides, rafraîchis (une seule fois) s'ils expirent dans `margin`."""
+    return refresh_tokens_once(
+        user_id, 'youtube', tokens,
+        lambda current: _token_expired(current, margin),
+        _request_token_refresh
+    )
+
+
+def _channels_request(youtube):
+    return youtube.channels().list(
+        part='snippet,statistics,contentDetails',
+        mine=True
+    )
+
+
+def _playlist_items_request(youtube, channel: dict):
+    # Les 6 dernières vidéos de la playlist "uploads"
+    uploads_playlist_id = channel['contentDetails']['relatedPlaylists']['uploads']
+    return youtube.playlistItems().list(
+        part='snippet,contentDetails',
+        playlistId=uploads_playlist_id,
+        maxResults=6
+    )
+
+
+def _videos_request(youtube, playlist_response: dict):
+    video_ids = [item['contentDetails']['videoId'] for item in playlist_response.get('items', [])]
+    if not video_ids:
+        return None
+    return youtube.videos().list(
+        part='statistics,snippet',
+        id=','.join(video_ids)
+    )
+
+
+def _format_recent_videos(videos_stats_response: dict) -> list[dict]:
+    recent_videos = []
+    for video in videos_stats_response.get('items', []):
+        recent_videos.append({
+            'id': video['id'],
+            'title': video['snippet']['title'],
+            'thumbnail': video['snippet']['thumbnails']['medium']['url'],
+            'published_at': video['snippet']['publishedAt'],
+            'views': int(video['statistics'].get('viewCount', 0)),
+            'likes': int(video['statistics'].get('likeCount', 0)),
+            'comments': int(video['statistics'].get('commentCount', 0))
+        })
+    return recent_videos
+
+
+def _persist_youtube_stats(user_id: str, tokens: dict, credentials: Credentials, channel: dict,
+                           recent_videos: list[dict], writer=None,
+                           previous_hash: str | None = None) -> dict:
+    """Écrit les stats d'un canal (si elles ont changé) et le token s'il a été rafraîchi."""
+    stats = channel['statistics']
+    subscribers = int(stats.get('subscriberCount', 0))
+    video_count = int(stats.get('videoCount', 0))
+    view_count = int(stats.get('viewCount', 0))
+
+    # Mettre à jour Firestore uniquement si les stats ont changé
+    db = firestore.client()
+    user_ref = db.collection('influencers').document(user_id)
+
+    stats_hash = stats_fingerprint(
+        {'subscribers': subscribers, 'videoCount': video_count, 'viewCount': view_count},
+        [video['id'] for video in recent_videos]
+    )
+    changed = stats_hash != previous_hash
+    if changed:
+        write_update(user_ref, {
+            'socialAccounts.youtube.subscribers': subscribers,
+            'socialAccounts.youtube.videoCount': video_count,
+            'socialAccounts.youtube.viewCount': view_count,
+            'socialAccounts.youtube.lastUpdated': firestore.SERVER_TIMESTAMP,
+            'socialAccounts.youtube.recentVideos': recent_videos,
+            'socialAccounts.youtube.statsHash': stats_hash
+        }, writer=writer, tag=('youtube', user_id))
+    elif heartbeat_update('youtube'):
+        write_update(user_ref, heartbeat_update('youtube'), writer=writer, tag=('youtube', user_id))
+
+    # Mettre à jour le token si rafraîchi
+    if credentials.token != tokens.get('accessToken'):
+        save_tokens(user_id, 'youtube', {
+            **tokens,
+            'accessToken': credentials.token,
+            'expiresAt': credentials.expiry,
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        }, writer=writer)
+
+    return {
+        'success': True,
+        'changed': changed,
+        'subscribers': subscribers,
+        'videoCount': len(recent_videos)
+    }
+
+
+def update_youtube_stats(user_id: str, tokens: dict, writer=None, previous_hash: str | None = None) -> dict:
     """
     Met à jour les statistiques YouTube (appelé quotidiennement)
     
     Args:
         user_id: ID de l'utilisateur Firebase
         tokens: Dictionnaire avec les tokens YouTube
+        writer: DeferredWriter optionnel pour différer les écritures Firestore
+        previous_hash: Empreinte stockée des stats, pour ignorer les écritures sans changement
         
     Returns:
         Résultat de la mise à jour
     """
     try:
-        # Recréer les credentials depuis les tokens sauvegardés
-        credentials = Credentials(
-            token=tokens.get('accessToken'),
-            refresh_token=tokens.get('refreshToken'),
-            token_uri=tokens.get('tokenUri'),
-            client_id=tokens.get('clientId'),
-            client_secret=tokens.get('clientSecret'),
-            scopes=tokens.get('scopes')
-        )
+        tokens = ensure_fresh_youtube_tokens(user_id, tokens, margin=YOUTUBE_TOKEN_MARGIN)
+        credentials = _youtube_credentials(tokens)
         
-        # Créer le client YouTube API
-        youtube = build('youtube', 'v3', credentials=credentials)
+        # Client YouTube partagé, requêtes signées avec les credentials de l'utilisateur
+        youtube = get_youtube_service()
+        http = _authorized_http(credentials)
         
         # Récupérer les infos du canal
-        request = youtube.channels().list(
-            part='snippet,statistics,contentDetails',
-            mine=True
-        )
-        response = request.execute()
+        response = _execute(_channels_request(youtube), http)
         
         if not response['items']:
             return {'success': False, 'error': 'Canal non trouvé'}
         
         channel = response['items'][0]
-        stats = channel['statistics']
-        
-        subscribers = int(stats.get('subscriberCount', 0))
-        video_count = int(stats.get('videoCount', 0))
-        view_count = int(stats.get('viewCount', 0))
         
-        # Récupérer les 6 dernières vidéos
-        uploads_playlist_id = channel['contentDetails']['relatedPlaylists']['uploads']
-        
-        videos_request = youtube.playlistItems().list(
-            part='snippet,contentDetails',
-            playlistId=uploads_playlist_id,
-            maxResults=6
-        )
-        videos_response = videos_request.execute()
-        
-        # Stats des vidéos
-        video_ids = [item['contentDetails']['videoId'] for item in videos_response['items']]
+        # Récupérer les 6 dernières vidéos puis leurs stats
+        videos_response = _execute(_playlist_items_request(youtube, channel), http)
+        videos_stats_request = _videos_request(youtube, videos_response)
+        videos_stats_response = _execute(videos_stats_request, http) if videos_stats_request else {}
         
-        videos_stats_request = youtube.videos().list(
-            part='statistics,snippet',
-            id=','.join(video_ids)
+        return _persist_youtube_stats(
+            user_id, tokens, credentials, channel,
+            _format_recent_videos(videos_stats_response),
+            writer=writer, previous_hash=previous_hash
         )
-        videos_stats_response = videos_stats_request.execute()
-        
-        # Formater les vidéos
-        recent_videos = []
-        for video in videos_stats_response['items']:
-            recent_videos.append({
-                'id': video['id'],
-                'title': video['snippet']['title'],
-                'thumbnail': video['snippet']['thumbnails']['medium']['url'],
-                'published_at': video['snippet']['publishedAt'],
-                'views': int(video['statistics'].get('viewCount', 0)),
-                'likes': int(video['statistics'].get('likeCount', 0)),
-                'comments': int(video['statistics'].get('commentCount', 0))
-            })
-        
-        # Mettre à jour Firestore
-        db = firestore.client()
-        user_ref = db.collection('influencers').document(user_id)
-        
-        user_ref.update({
-            'socialAccounts.youtube.subscribers': subscribers,
-            'socialAccounts.youtube.videoCount': video_count,
-            'socialAccounts.youtube.viewCount': view_count,
-            'socialAccounts.youtube.lastUpdated': firestore.SERVER_TIMESTAMP,
-            'socialAccounts.youtube.recentVideos': recent_videos
-        })
-        
-        # Mettre à jour le token si rafraîchi
-        if credentials.token != tokens.get('accessToken'):
-            save_tokens(user_id, 'youtube', {
-                **tokens,
-                'accessToken': credentials.token,
-                'updatedAt': firestore.SERVER_TIMESTAMP
-            })
-        
-        return {
-            'success': True,
-            'subscribers': subscribers,
-            'videoCount': len(recent_videos)
-        }
         
+    except (QuotaExceededError, CircuitOpenError):
+        # Compte reporté : ce n'est pas une erreur du compte
+        raise
     except Exception as e:
+        if is_youtube_quota_error(e):
+            return {'success': False, 'skipped': True, 'error': str(e)}
         print(f"Erreur mise à jour YouTube pour {user_id}: {str(e)}")
         return {'success': False, 'error': str(e)}
+
+
+def _execute_batched(youtube, requests_by_user: dict, users: dict) -> dict:
+    """
+    Exécute une requête par utilisateur en regroupant les appels dans des
+    requêtes batch HTTP (YOUTUBE_BATCH_SIZE sous-requêtes par aller-retour).
+    Chaque sous-requête est signée avec les credentials de son utilisateur et
+    consomme une unité de quota (QuotaExceededError si le budget est atteint).
+    Les sous-requêtes renvoyées par la librairie après un 401 (credentials
+    rafraîchis) sont comptées en plus.
+    Retourne {user_id: (réponse, exception)}.
+    """
+    outcomes = {}
+    governor = get_governor('youtube')
+    breaker = get_breaker(YOUTUBE_API_HOST)
+
+    def _callback(request_id, response, exception):
+        if isinstance(exception, HttpError):
+            observe_youtube_error(exception)
+        outcomes[request_id] = (response, exception)
+
+    items = list(requests_by_user.items())
+    for start in range(0, len(items), YOUTUBE_BATCH_SIZE):
+        chunk = items[start:start + YOUTUBE_BATCH_SIZE]
+        governor.acquire(len(chunk))
+        # Un token qui change pendant execute() signale un 401 suivi d'un renvoi
+        tokens_before = {user_id: users[user_id]['credentials'].token for user_id, _ in chunk}
+        breaker.before_call()
+        try:
+            batch = youtube.new_batch_http_request(callback=_callback)
+            for user_id, request in chunk:
+                request.http = users[user_id]['http']
+                batch.add(request, request_id=user_id)
+            try:
+                batch.execute(http=httplib2.Http(timeout=YOUTUBE_HTTP_TIMEOUT))
+            finally:
+                governor.record_usage(sum(
+                    1 for user_id, token in tokens_before.items()
+                    if users[user_id]['credentials'].token != token
+                ))
+        except BaseException as exc:
+            if _is_transient(exc):
+                breaker.record_failure()
+            elif isinstance(exc, HttpError):
+                # L'API a répondu : l'hôte est disponible
+                breaker.record_success()
+            else:
+                # Lot non construit ou issue inconnue : libère l'essai semi-ouvert
+                breaker.cancel_call()
+            if not isinstance(exc, Exception):
+                raise
+            for user_id, _ in chunk:
+                outcomes.setdefault(user_id, (None, exc))
+        else:
+            breaker.record_success()
+            governor.on_success()
+    return outcomes
+
+
+def update_youtube_stats_batch(jobs, writer=None) -> dict:
+    """
+    Met à jour les statistiques YouTube de nombreux canaux en mode batch.
+
+    Les trois étapes (canal, playlist "uploads", stats des vidéos) sont exécutées
+    étape par étape pour tous les utilisateurs : chaque étape regroupe jusqu'à
+    YOUTUBE_BATCH_SIZE appels par aller-retour HTTP au lieu d'un appel par canal.
+
+    Args:
+        jobs: Liste de tuples (user_id, tokens, previous_hash)
+        writer: DeferredWriter optionnel pour différer les écritures Firestore
+
+    Returns:
+        Dictionnaire {user_id: résultat}, au même format que update_youtube_stats
+    """
+    youtube = get_youtube_service()
+    results = {}
+    users = {}
+
+    def _fail(user_id, error):
+        if is_youtube_quota_error(error):
+            # Rejet de quota : compte reporté, pas en erreur
+            results[user_id] = {'success': False, 'skipped': True, 'error': str(error)}
+            return
+        print(f"Erreur mise à jour YouTube pour {user_id}: {str(error)}")
+        results[user_id] = {'success': False, 'error': str(error)}
+
+    # Tokens proches de l'expiration renouvelés avant le lot, sous single-flight et
+    # bail (comme en mode simple) : un seul rafraîchissement par compte, écrit en base
+    jobs = list(jobs)
+    expiring = [job for job in jobs if _token_expired(job[1], YOUTUBE_TOKEN_MARGIN)]
+    fresh_tokens = {}
+    if expiring:
+        def _refresh(job):
+            user_id, tokens, _ = job
+            try:
+                return user_id, ensure_fresh_youtube_tokens(user_id, tokens, margin=YOUTUBE_TOKEN_MARGIN)
+            except Exception as exc:
+                return user_id, exc
+
+        with ThreadPoolExecutor(max_workers=min(8, len(expiring))) as executor:
+            fresh_tokens = dict(executor.map(_refresh, expiring))
+
+    for user_id, tokens, previous_hash in jobs:
+        tokens = fresh_tokens.get(user_id, tokens)
+        if isinstance(tokens, Exception):
+            _fail(user_id, tokens)
+            continue
+        credentials = _youtube_credentials(tokens)
+        users[user_id] = {
+            'tokens': tokens,
+            'previous_hash': previous_hash,
+            'credentials': credentials,
+            'http': _authorized_http(credentials)
+        }
+
+    # Étape 1 : infos des canaux
+    channels = {}
+    outcomes = _execute_batched(youtube, {
+        user_id: _channels_request(youtube) for user_id in users
+    }, users)
+    for user_id, (response, exception) in outcomes.items():
+        if exception is not None:
+            _fail(user_id, exception)
+        elif not (response or {}).get('items'):
+            results[user_id] = {'success': False, 'error': 'Canal non trouvé'}
+        else:
+            channels[user_id] = response['items'][0]
+
+    # Étape 2 : dernières vidéos de chaque canal
+    playlist_requests = {}
+    for user_id, channel in channels.items():
+        try:
+            playlist_requests[user_id] = _playlist_items_request(youtube, channel)
+        except KeyError as exc:
+            _fail(user_id, exc)
+    video_requests = {}
+    for user_id, (response, exception) in _execute_batched(youtube, playlist_requests, users).items():
+        if exception is not None:
+            _fail(user_id, exception)
+            continue
+        request = _videos_request(youtube, response or {})
+        if request is not None:
+            video_requests[user_id] = request
+
+    # Étape 3 : stats des vidéos
+    video_outcomes = _execute_batched(youtube, video_requests, users)
+
+    for user_id, channel in channels.items():
+        if user_id in results:
+            continue
+        response, exception = video_outcomes.get(user_id, ({}, None))
+        if exception is not None:
+            _fail(user_id, exception)
+            continue
+        user = users[user_id]
+        try:
+            results[user_id] = _persist_youtube_stats(
+                user_id, user['tokens'], user['credentials'], channel,
+                _format_recent_videos(response or {}),
+                writer=writer, previous_hash=user['previous_hash']
+            )
+        except Exception as exc:
+            _fail(user_id, exc)
+
+    return results
@@ -12,8 +12,8 @@ import json
 import secrets
 from datetime import datetime, timedelta, timezone
 import stripe
-from firebase_functions import https_fn, scheduler_fn
-from firebase_functions.options import set_global_options
+from firebase_functions import https_fn, scheduler_fn, tasks_fn, firestore_fn
+from firebase_functions.options import set_global_options, RetryConfig, RateLimits
 from firebase_admin import initialize_app, auth as firebase_auth
 from dotenv import load_dotenv
 
@@ -48,11 +48,26 @@ STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
 FRONTEND_BASE_URL = os.getenv('FRONTEND_BASE_URL', 'http://localhost:5173').rstrip('/')
 ADMIN_EMAIL = os.getenv('ADMIN_EMAIL', 'bechagraamine@gmail.com')
 
+STRIPE_TIMEOUT_SECONDS = int(os.getenv('STRIPE_TIMEOUT_SECONDS', '30'))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', '2'))
+
 if STRIPE_SECRET_KEY:
+    from lib.http_client import get_session
+
     stripe.api_key = STRIPE_SECRET_KEY
+    # Configuration globale du SDK posée une fois à l'import, avant toute requête :
+    # appels via la session HTTP partagée (connexions réutilisées entre invocations),
+    # Stripe retentant lui-même les erreurs réseau
+    stripe.default_http_client = stripe.RequestsClient(timeout=STRIPE_TIMEOUT_SECONDS, session=get_session())
+    stripe.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
 
 STATE_TTL_SECONDS = int(os.getenv('STATE_TTL_SECONDS', '600'))
 
+# Cache des ID tokens vérifiés (durée bornée par l'expiration du token)
+ID_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv('ID_TOKEN_CACHE_MAX_ENTRIES', '1024'))
+ID_TOKEN_CACHE_MAX_SECONDS = int(os.getenv('ID_TOKEN_CACHE_MAX_SECONDS', '3600'))
+_verified_tokens = None
+
 
 class AuthorizationError(Exception):
     """Erreur personnalisée pour les problèmes d'authentification."""
@@ -104,50 +119,66 @@ def _extract_id_token(req: https_fn.Request) -> str | None:
     return req.args.get('idToken')
 
 
-def authenticate_user(req: https_fn.Request, expected_user_id: str) -> str:
+def _id_token_cache():
+    """Cache des ID tokens déjà vérifiés (créé au premier appel, partagé par l'instance)."""
+    global _verified_tokens
+    if _verified_tokens is None:
+        from lib.cache import TTLCache
+        _verified_tokens = TTLCache(maxsize=ID_TOKEN_CACHE_MAX_ENTRIES, ttl=ID_TOKEN_CACHE_MAX_SECONDS)
+    return _verified_tokens
+
+
+def _verify_request_token(req: https_fn.Request) -> dict:
+    """
+    Vérifie l'ID token Firebase de la requête et retourne ses claims.
+
+    Les claims sont mémorisés sur la requête (une seule vérification par requête)
+    et dans un cache LRU indexé par l'empreinte SHA-256 du token, jusqu'à son `exp` :
+    un token déjà vérifié sur cette instance évite le contrôle de signature RS256.
+    """
+    cached_claims = getattr(req, '_verified_claims', None)
+    if cached_claims is not None:
+        return cached_claims
+
     id_token = _extract_id_token(req)
     if not id_token:
         raise AuthorizationError('Missing idToken parameter', status=401)
-    try:
-        decoded = firebase_auth.verify_id_token(id_token)
-    except Exception as exc:
-        raise AuthorizationError('Invalid ID token', status=401) from exc
 
-    uid = decoded.get('uid')
+    cache = _id_token_cache()
+    token_key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    decoded = cache.get(token_key)
+    if decoded is None or decoded.get('exp', 0) <= time.time():
+        try:
+            decoded = firebase_auth.verify_id_token(id_token)
+        except Exception as exc:
+            cache.invalidate(token_key)
+            raise AuthorizationError('Invalid ID token', status=401) from exc
+        ttl = min(ID_TOKEN_CACHE_MAX_SECONDS, decoded.get('exp', 0) - time.time())
+        if ttl > 0:
+            cache.set(token_key, decoded, ttl=ttl)
+
+    if not decoded.get('uid'):
+        raise AuthorizationError('Invalid authenticated user', status=401)
+    setattr(req, '_verified_claims', decoded)
+    return decoded
+
+
+def authenticate_user(req: https_fn.Request, expected_user_id: str) -> str:
+    uid = _verify_request_token(req)['uid']
     if uid != expected_user_id:
         raise AuthorizationError('Authenticated user mismatch', status=403)
     return uid
 
 
 def _get_authenticated_uid(req: https_fn.Request) -> str:
-    id_token = _extract_id_token(req)
-    if not id_token:
-        raise AuthorizationError('Missing idToken parameter', status=401)
-    try:
-        decoded = firebase_auth.verify_id_token(id_token)
-    except Exception as exc:
-        raise AuthorizationError('Invalid ID token', status=401) from exc
-    uid = decoded.get('uid')
-    if not uid:
-        raise AuthorizationError('Invalid authenticated user', status=401)
-    return uid
+    return _verify_request_token(req)['uid']
 
 
 def _require_admin(req: https_fn.Request) -> str:
-    id_token = _extract_id_token(req)
-    if not id_token:
-        raise AuthorizationError('Missing idToken parameter', status=401)
-    try:
-        decoded = firebase_auth.verify_id_token(id_token)
-    except Exception as exc:
-        raise AuthorizationError('Invalid ID token', status=401) from exc
-
-    uid = decoded.get('uid')
-    if not uid:
-        raise AuthorizationError('Invalid authenticated user', status=401)
+    decoded = _verify_request_token(req)
     if decoded.get('email') != ADMIN_EMAIL:
         raise AuthorizationError('Réservé aux administrateurs', status=403)
-    return uid
+    return decoded['uid']
 
 
 def _json_response(payload: dict, status: int = 200) -> https_fn.Response:
@@ -526,43 +557,59 @@ def create_collaboration_request_handler(req: https_fn.Request) -> https_fn.Resp
         if not isinstance(items, list) or len(items) == 0:
             return _json_response({'error': 'Panier vide'}, status=400)
 
+        from lib.profiles import get_profile, get_profiles
+
         db_client = firestore.client()
-        brand_ref = db_client.collection('brands').document(uid)
-        brand_snap = brand_ref.get()
-        if not brand_snap.exists:
+        # Contrôle d'autorisation : lecture directe, hors cache
+        brand_data = get_profile(db_client, 'brand', uid, fresh=True)
+        if brand_data is None:
             return _json_response({'error': 'Seules les marques peuvent envoyer des demandes'}, status=403)
 
-        brand_data = brand_snap.to_dict() or {}
         brand_name = brand_data.get('brandName', 'Marque')
         brand_email = brand_data.get('email', '')
 
+        from lib.refresh_priority import demand_boost, schedule_ref
+        from lib.write_buffer import commit_sets
+        from lib.conversations import ensure_conversations
+        from lib.mail_outbox import outbox_entry, outbox_ref
+        from lib.notifications import new_collaboration_request_email
+
         collaborations_ref = db_client.collection('collaborations')
-        conversations_ref = db_client.collection('conversations')
 
-        request_ids = []
+        # Profils des influenceurs du panier, en une lecture groupée (ou depuis le cache)
+        influencers = get_profiles(
+            db_client, 'influencer',
+            [item.get('influencerId') for item in items if item.get('influencerId')]
+        )
 
+        cart_lines = []
         for item in items:
             influencer_id = item.get('influencerId')
-            package_name = item.get('package', 'Collaboration')
             quantity = int(item.get('quantity', 1))
             unit_price = float(item.get('price', 0))
-
             if not influencer_id or quantity <= 0 or unit_price <= 0:
                 continue
-
-            influencer_ref = db_client.collection('influencers').document(influencer_id)
-            influencer_snap = influencer_ref.get()
-            if not influencer_snap.exists:
+            if influencer_id not in influencers:
                 continue
+            cart_lines.append((influencer_id, item.get('package', 'Collaboration'), quantity, unit_price))
 
-            influencer_data = influencer_snap.to_dict() or {}
+        if len(cart_lines) == 0:
+            return _json_response({'error': 'Impossible de créer la demande pour ce panier'}, status=400)
+
+        influencer_ids = list(dict.fromkeys(line[0] for line in cart_lines))
+        new_conversations = {}
+
+        operations = []
+        request_ids = []
+        for influencer_id, package_name, quantity, unit_price in cart_lines:
+            influencer_data = influencers[influencer_id]
             influencer_name = influencer_data.get('name', 'Influenceur')
             influencer_email = influencer_data.get('email', '')
 
             # Crée une demande par quantité pour faciliter le suivi individuel.
             for _ in range(quantity):
                 collab_ref = collaborations_ref.document()
-                collab_ref.set({
+                operations.append((collab_ref, {
                     'brandId': uid,
                     'brandName': brand_name,
                     'brandEmail': brand_email,
@@ -580,11 +627,11 @@ def create_collaboration_request_handler(req: https_fn.Request) -> https_fn.Resp
                     'influencerApproved': False,
                     'createdAt': firestore.SERVER_TIMESTAMP,
                     'updatedAt': firestore.SERVER_TIMESTAMP
-                })
+                }, False))
                 request_ids.append(collab_ref.id)
 
-            from lib.notifications import send_new_collaboration_request_email
-            send_new_collaboration_request_email(
+            # Email à l'influenceur, écrit dans l'outbox avec les demandes
+            operations.append((outbox_ref(db_client), outbox_entry(new_collaboration_request_email(
                 influencer_email=influencer_email,
                 influencer_name=influencer_name,
                 brand_name=brand_name,
@@ -592,26 +639,30 @@ def create_collaboration_request_handler(req: https_fn.Request) -> https_fn.Resp
                 amount=unit_price,
                 frontend_base_url=FRONTEND_BASE_URL,
                 brand_id=uid
-            )
+            )), False))
+
+            # Conversation unique brand <-> influencer, créée si absente après le commit
+            new_conversations.setdefault(influencer_id, {
+                'brandId': uid,
+                'brandName': brand_name,
+                'brandEmail': brand_email,
+                'influencerId': influencer_id,
+                'influencerName': influencer_name,
+                'influencerEmail': influencer_email,
+                'lastMessage': f'Nouvelle demande de collaboration: {package_name}',
+                'lastMessageAt': firestore.SERVER_TIMESTAMP,
+                'lastMessageBy': uid,
+                'createdAt': firestore.SERVER_TIMESTAMP
+            })
 
-            # Conversation unique brand <-> influencer
-            existing_conv = conversations_ref.where('brandId', '==', uid).where('influencerId', '==', influencer_id).limit(1).get()
-            if len(existing_conv) == 0:
-                conversations_ref.add({
-                    'brandId': uid,
-                    'brandName': brand_name,
-                    'brandEmail': brand_email,
-                    'influencerId': influencer_id,
-                    'influencerName': influencer_name,
-                    'influencerEmail': influencer_email,
-                    'lastMessage': f'Nouvelle demande de collaboration: {package_name}',
-                    'lastMessageAt': firestore.SERVER_TIMESTAMP,
-                    'lastMessageBy': uid,
-                    'createdAt': firestore.SERVER_TIMESTAMP
-                })
+        # Profils sollicités : leurs stats sont rafraîchies plus souvent
+        for influencer_id in influencer_ids:
+            operations.append((schedule_ref(db_client, influencer_id), demand_boost(), True))
 
-        if len(request_ids) == 0:
-            return _json_response({'error': 'Impossible de créer la demande pour ce panier'}, status=400)
+        # Toutes les écritures en WriteBatch (500 max par lot)
+        commit_sets(db_client, operations)
+        # Conversations à ID déterministe : un get_all puis create() des absentes
+        ensure_conversations(db_client, uid, new_conversations)
 
         return _json_response({
             'success': True,
@@ -628,7 +679,7 @@ def create_collaboration_request_handler(req: https_fn.Request) -> https_fn.Resp
 def respond_to_collaboration_request_handler(req: https_fn.Request) -> https_fn.Response:
     """
     L'influenceur accepte ou refuse une demande de collaboration en attente.
-    Envoie un email à la marque pour l'informer de la réponse.
+    Prévient la marque par email (via l'outbox) de la réponse.
     """
     options_response = _handle_options(req)
     if options_response:
@@ -661,23 +712,27 @@ def respond_to_collaboration_request_handler(req: https_fn.Request) -> https_fn.
         if collab.get('status') != 'pending_acceptance':
             return _json_response({'error': 'Cette demande n\'est plus en attente'}, status=400)
 
+        from lib.mail_outbox import enqueue_email
+        from lib.notifications import collaboration_response_email
+
+        # Réponse et email à la marque écrits dans le même lot
         new_status = 'accepted_awaiting_payment' if accept else 'declined'
-        collab_ref.update({
+        batch = db_client.batch()
+        batch.update(collab_ref, {
             'status': new_status,
             'influencerAccepted': bool(accept),
             'respondedAt': firestore.SERVER_TIMESTAMP,
             'updatedAt': firestore.SERVER_TIMESTAMP
         })
-
-        from lib.notifications import send_collaboration_response_email
-        send_collaboration_response_email(
+        enqueue_email(db_client, collaboration_response_email(
             brand_email=collab.get('brandEmail', ''),
             brand_name=collab.get('brandName', 'Marque'),
             influencer_name=collab.get('influencerName', 'Influenceur'),
             package=collab.get('package', 'Collaboration'),
             accepted=bool(accept),
             frontend_base_url=FRONTEND_BASE_URL
-        )
+        ), batch=batch)
+        batch.commit()
 
         return _json_response({
             'success': True,
@@ -695,14 +750,16 @@ def _lookup_user_profile(db_client, uid):
     Retrouve le profil (influenceur ou marque) associé à un uid.
     Retourne (user_type, name, email) ou (None, None, None) si introuvable.
     """
-    influencer_snap = db_client.collection('influencers').document(uid).get()
-    if influencer_snap.exists:
-        data = influencer_snap.to_dict() or {}
-        return 'influencer', data.get('name', ''), data.get('email', '')
+    from lib.profiles import lookup_user_profile
+
+    user_type, data = lookup_user_profile(db_client, uid)
+    if user_type and not data.get('email'):
+        # Profil mis en cache avant d'être complété : relire une fois depuis Firestore
+        user_type, data = lookup_user_profile(db_client, uid, fresh=True)
 
-    brand_snap = db_client.collection('brands').document(uid).get()
-    if brand_snap.exists:
-        data = brand_snap.to_dict() or {}
+    if user_type == 'influencer':
+        return 'influencer', data.get('name', ''), data.get('email', '')
+    if user_type == 'brand':
         name = data.get('brandName', '') or data.get('fullName', '')
         return 'brand', name, data.get('email', '')
 
@@ -712,7 +769,7 @@ def _lookup_user_profile(db_client, uid):
 @https_fn.on_request()
 def send_welcome_email_handler(req: https_fn.Request) -> https_fn.Response:
     """
-    Envoie l'email de bienvenue juste après la création du compte (influenceur ou marque).
+    Met dans l'outbox l'email de bienvenue juste après la création du compte (influenceur ou marque).
     """
     options_response = _handle_options(req)
     if options_response:
@@ -731,13 +788,14 @@ def send_welcome_email_handler(req: https_fn.Request) -> https_fn.Response:
         if not email:
             return _json_response({'error': 'Email introuvable pour ce compte'}, status=400)
 
-        from lib.notifications import send_welcome_email
-        send_welcome_email(
+        from lib.mail_outbox import enqueue_email
+        from lib.notifications import welcome_email
+        enqueue_email(db_client, welcome_email(
             to_email=email,
             name=name or ('Marque' if user_type == 'brand' else 'Influenceur'),
             user_type=user_type,
             frontend_base_url=FRONTEND_BASE_URL
-        )
+        ))
 
         return _json_response({'success': True})
     except AuthorizationError as auth_err:
@@ -754,7 +812,7 @@ VERIFICATION_CODE_MAX_ATTEMPTS = 5
 @https_fn.on_request()
 def send_verification_code_handler(req: https_fn.Request) -> https_fn.Response:
     """
-    Génère et envoie par email un code à 6 chiffres pour valider l'adresse email du compte.
+    Génère un code à 6 chiffres pour valider l'adresse email du compte et l'envoie par email (via l'outbox).
     Peut aussi être appelé pour renvoyer un nouveau code.
     """
     options_response = _handle_options(req)
@@ -774,21 +832,25 @@ def send_verification_code_handler(req: https_fn.Request) -> https_fn.Response:
         if not email:
             return _json_response({'error': 'Email introuvable pour ce compte'}, status=400)
 
+        from lib.mail_outbox import enqueue_email
+        from lib.notifications import verification_code_email
+
+        # Code et email écrits dans le même lot : pas d'email sans code enregistré
         code = f'{secrets.randbelow(1000000):06d}'
-        db_client.collection('emailVerificationCodes').document(uid).set({
+        batch = db_client.batch()
+        batch.set(db_client.collection('emailVerificationCodes').document(uid), {
             'code': code,
             'email': email,
             'attempts': 0,
             'expiresAt': datetime.now(timezone.utc) + timedelta(minutes=VERIFICATION_CODE_TTL_MINUTES),
             'createdAt': firestore.SERVER_TIMESTAMP
         })
-
-        from lib.notifications import send_verification_code_email
-        send_verification_code_email(
+        enqueue_email(db_client, verification_code_email(
             to_email=email,
             name=name or ('Marque' if user_type == 'brand' else 'Influenceur'),
             code=code
-        )
+        ), batch=batch)
+        batch.commit()
 
         return _json_response({'success': True})
     except AuthorizationError as auth_err:
@@ -874,19 +936,33 @@ def create_checkout_session_handler(req: https_fn.Request) -> https_fn.Response:
         if not isinstance(collaboration_ids, list) or len(collaboration_ids) == 0:
             return _json_response({'error': 'Aucune collaboration à payer'}, status=400)
 
+        from google.api_core.exceptions import AlreadyExists
+        from lib.profiles import get_profile
+
         db_client = firestore.client()
-        brand_snap = db_client.collection('brands').document(uid).get()
-        if not brand_snap.exists:
+        if get_profile(db_client, 'brand', uid, fresh=True) is None:
             return _json_response({'error': 'Seules les marques peuvent payer'}, status=403)
 
+        # Lecture groupée des collaborations (get_all par lots de 100), dans un ordre
+        # stable pour que les paramètres Stripe d'un même panier soient identiques
+        requested_ids = [str(collab_id) for collab_id in collaboration_ids if collab_id]
+        collaboration_ids = sorted(set(requested_ids))
+        collaborations_ref = db_client.collection('collaborations')
+        snapshots = {}
+        for start in range(0, len(collaboration_ids), 100):
+            refs = [collaborations_ref.document(collab_id) for collab_id in collaboration_ids[start:start + 100]]
+            for snapshot in db_client.get_all(refs):
+                if snapshot.exists:
+                    snapshots[snapshot.id] = snapshot
+
         line_items = []
         valid_collaboration_ids = []
-        first_influencer_id = None
+        influencer_ids = {}
+        key_parts = [uid]
 
         for collaboration_id in collaboration_ids:
-            collab_ref = db_client.collection('collaborations').document(collaboration_id)
-            collab_snap = collab_ref.get()
-            if not collab_snap.exists:
+            collab_snap = snapshots.get(collaboration_id)
+            if collab_snap is None:
                 continue
 
             collab_data = collab_snap.to_dict() or {}
@@ -899,9 +975,7 @@ def create_checkout_session_handler(req: https_fn.Request) -> https_fn.Response:
             if unit_price <= 0:
                 continue
 
-            if first_influencer_id is None:
-                first_influencer_id = collab_data.get('influencerId')
-
+            influencer_ids[collaboration_id] = collab_data.get('influencerId')
             line_items.append({
                 'price_data': {
                     'currency': 'eur',
@@ -913,10 +987,22 @@ def create_checkout_session_handler(req: https_fn.Request) -> https_fn.Response:
                 'quantity': 1
             })
             valid_collaboration_ids.append(collaboration_id)
+            key_parts.append(f'{collaboration_id}@{collab_snap.update_time.isoformat()}')
 
         if len(line_items) == 0:
             return _json_response({'error': 'Aucune collaboration acceptée à payer'}, status=400)
 
+        # Retour après paiement : première collaboration dans l'ordre envoyé par le client
+        first_influencer_id = next(
+            (influencer_ids[collab_id] for collab_id in requested_ids if influencer_ids.get(collab_id)),
+            None
+        )
+
+        # Clé d'idempotence dérivée des collaborations et de leur dernière modification :
+        # un checkout relancé réutilise la même session, tandis qu'une session expirée
+        # (collaborations mises à jour par le webhook) en produit une nouvelle
+        idempotency_key = 'checkout-' + hashlib.sha256('|'.join(key_parts).encode('utf-8')).hexdigest()
+
         success_url = f'{FRONTEND_BASE_URL}/messages?payment=success'
         if first_influencer_id:
             success_url += f'&influencerId={first_influencer_id}'
@@ -929,17 +1015,23 @@ def create_checkout_session_handler(req: https_fn.Request) -> https_fn.Response:
             cancel_url=f'{FRONTEND_BASE_URL}/my-profile?payment=cancelled',
             metadata={
                 'brandId': uid
-            }
+            },
+            idempotency_key=idempotency_key
         )
 
-        db_client.collection('paymentSessions').document(checkout_session.id).set({
-            'brandId': uid,
-            'collaborationIds': valid_collaboration_ids,
-            'checkoutSessionId': checkout_session.id,
-            'status': 'created',
-            'createdAt': firestore.SERVER_TIMESTAMP,
-            'updatedAt': firestore.SERVER_TIMESTAMP
-        })
+        # Session réutilisée (même clé d'idempotence) : le document existe déjà et
+        # garde sa date de création comme le statut posé par le webhook
+        try:
+            db_client.collection('paymentSessions').document(checkout_session.id).create({
+                'brandId': uid,
+                'collaborationIds': valid_collaboration_ids,
+                'checkoutSessionId': checkout_session.id,
+                'status': 'created',
+                'createdAt': firestore.SERVER_TIMESTAMP,
+                'updatedAt': firestore.SERVER_TIMESTAMP
+            })
+        except AlreadyExists:
+            print(f'Session de paiement {checkout_session.id} réutilisée')
 
         return _json_response({
             'success': True,
@@ -957,7 +1049,9 @@ def create_checkout_session_handler(req: https_fn.Request) -> https_fn.Response:
 @https_fn.on_request()
 def stripe_webhook_handler(req: https_fn.Request) -> https_fn.Response:
     """
-    Webhook Stripe: confirme les paiements et passe les collaborations en fonds en attente.
+    Webhook Stripe: vérifie la signature, enregistre l'événement et répond aussitôt.
+    La confirmation des paiements (collaborations en fonds en attente) est faite
+    par la tâche `process_stripe_event`.
     """
     if req.method != 'POST':
         return https_fn.Response('Méthode non autorisée', status=405)
@@ -973,63 +1067,43 @@ def stripe_webhook_handler(req: https_fn.Request) -> https_fn.Response:
             event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
         else:
             event = json.loads(payload)
+    except Exception as exc:
+        print(f'Signature webhook Stripe invalide: {str(exc)}')
+        return https_fn.Response(f'Webhook error: {str(exc)}', status=400)
 
-        event_type = event.get('type')
-        event_data = event.get('data', {}).get('object', {})
-
-        db_client = firestore.client()
-
-        if event_type == 'checkout.session.completed':
-            session_id = event_data.get('id')
-            payment_intent_id = event_data.get('payment_intent')
-
-            session_ref = db_client.collection('paymentSessions').document(session_id)
-            session_snap = session_ref.get()
-            if session_snap.exists:
-                session_data = session_snap.to_dict() or {}
-                collab_ids = session_data.get('collaborationIds', [])
-
-                for collab_id in collab_ids:
-                    collab_ref = db_client.collection('collaborations').document(collab_id)
-                    collab_ref.update({
-                        'status': 'pending',
-                        'paymentStatus': 'funds_held',
-                        'stripeCheckoutSessionId': session_id,
-                        'stripePaymentIntentId': payment_intent_id,
-                        'paymentHeldAt': firestore.SERVER_TIMESTAMP,
-                        'updatedAt': firestore.SERVER_TIMESTAMP
-                    })
-
-                session_ref.update({
-                    'status': 'paid',
-                    'stripePaymentIntentId': payment_intent_id,
-                    'updatedAt': firestore.SERVER_TIMESTAMP
-                })
-
-        if event_type == 'checkout.session.expired':
-            session_id = event_data.get('id')
-            session_ref = db_client.collection('paymentSessions').document(session_id)
-            session_snap = session_ref.get()
-            if session_snap.exists:
-                session_data = session_snap.to_dict() or {}
-                collab_ids = session_data.get('collaborationIds', [])
-
-                for collab_id in collab_ids:
-                    collab_ref = db_client.collection('collaborations').document(collab_id)
-                    collab_ref.update({
-                        'paymentStatus': 'not_requested',
-                        'updatedAt': firestore.SERVER_TIMESTAMP
-                    })
-
-                session_ref.update({
-                    'status': 'expired',
-                    'updatedAt': firestore.SERVER_TIMESTAMP
-                })
+    try:
+        from lib.stripe_events import record_stripe_event, enqueue_stripe_event
 
+        # Accusé de réception rapide : l'événement est traité par la tâche process_stripe_event
+        if record_stripe_event(firestore.client(), event, payload):
+            enqueue_stripe_event(event['id'])
+        else:
+            print(f"Événement Stripe {event.get('id')} déjà traité")
         return https_fn.Response('ok', status=200)
     except Exception as exc:
         print(f'Erreur stripe_webhook_handler: {str(exc)}')
-        return https_fn.Response(f'Webhook error: {str(exc)}', status=400)
+        # Événement non enregistré ou non planifié : Stripe le relivrera
+        return https_fn.Response(f'Webhook error: {str(exc)}', status=500)
+
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=10, min_backoff_seconds=10),
+    rate_limits=RateLimits(max_concurrent_dispatches=20)
+)
+def process_stripe_event(req: tasks_fn.CallableRequest) -> None:
+    """
+    Tâche d'application d'un événement Stripe enregistré par le webhook.
+    Une exception fait retenter la tâche ; l'application reste idempotente.
+    """
+    event_id = (req.data or {}).get('eventId')
+    if not event_id:
+        print(f"Tâche process_stripe_event invalide: {req.data}")
+        return
+
+    from lib.stripe_events import process_stored_event
+
+    outcome = process_stored_event(firestore.client(), event_id)
+    print(f"💳 Événement Stripe {event_id}: {outcome}")
 
 
 @https_fn.on_request()
@@ -1196,57 +1270,168 @@ def mark_collaboration_paid_handler(req: https_fn.Request) -> https_fn.Response:
 @scheduler_fn.on_schedule(schedule="*/30 * * * *", timezone="Europe/Paris")
 def daily_stats_update(event: scheduler_fn.ScheduledEvent) -> None:
     """
-    Mise à jour quotidienne des statistiques YouTube et TikTok
-    S'exécute tous les jours à 2h du matin (heure de Paris)
+    Mise à jour périodique des statistiques YouTube, TikTok et Instagram (toutes les 30 minutes)
+    Crée un run découpé en shards, chacun traité par une tâche `refresh_stats_shard`.
     """
     print("🚀 Début de la mise à jour quotidienne des stats")
-    
-    db = firestore.client()
-    
-    # Récupérer tous les influenceurs avec au moins un compte connecté
-    influencers = db.collection('influencers').stream()
-    
-    update_count = 0
-    error_count = 0
-    
-    from lib.token_store import get_user_tokens
-    from lib.youtube import update_youtube_stats
-    from lib.tiktok import update_tiktok_stats
 
-    for influencer in influencers:
-        user_id = influencer.id
-        data = influencer.to_dict()
-        
-        social_accounts = data.get('socialAccounts', {})
-        user_tokens = get_user_tokens(user_id)
-        
-        # Mettre à jour YouTube si connecté
-        if social_accounts.get('youtube', {}).get('connected'):
-            youtube_tokens = user_tokens.get('youtube', {})
-            if youtube_tokens:
-                print(f"📺 Mise à jour YouTube pour {user_id}")
-                result = update_youtube_stats(user_id, youtube_tokens)
-                if result.get('success'):
-                    update_count += 1
-                    print(f"✅ YouTube mis à jour: {result.get('subscribers')} abonnés")
-                else:
-                    error_count += 1
-                    print(f"❌ Erreur YouTube: {result.get('error')}")
-        
-        # Mettre à jour TikTok si connecté
-        if social_accounts.get('tiktok', {}).get('connected'):
-            tiktok_tokens = user_tokens.get('tiktok', {})
-            if tiktok_tokens:
-                print(f"🎵 Mise à jour TikTok pour {user_id}")
-                result = update_tiktok_stats(user_id, tiktok_tokens)
-                if result.get('success'):
-                    update_count += 1
-                    print(f"✅ TikTok mis à jour: {result.get('followers')} abonnés")
-                else:
-                    error_count += 1
-                    print(f"❌ Erreur TikTok: {result.get('error')}")
-    
-    print(f"✨ Mise à jour terminée: {update_count} succès, {error_count} erreurs")
+    from lib.stats_scheduler import start_refresh_run
+
+    run_id = start_refresh_run(firestore.client())
+    if run_id:
+        print(f"📋 Run {run_id} planifié")
+
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=30),
+    rate_limits=RateLimits(max_concurrent_dispatches=10),
+    timeout_sec=540
+)
+def refresh_stats_shard(req: tasks_fn.CallableRequest) -> None:
+    """
+    Tâche de rafraîchissement d'un shard d'influenceurs.
+    Reprend au dernier curseur sauvegardé dans `statsRefreshRuns/{runId}`.
+    """
+    data = req.data or {}
+    run_id = data.get('runId')
+    shard_id = data.get('shard')
+    if not run_id or shard_id is None:
+        print(f"Tâche refresh_stats_shard invalide: {data}")
+        return
+
+    from lib.stats_scheduler import run_refresh_shard
+
+    run_refresh_shard(firestore.client(), run_id, str(shard_id))
+
+
+@scheduler_fn.on_schedule(schedule="*/10 * * * *", timezone="Europe/Paris", timeout_sec=300)
+def refresh_expiring_tokens(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Rafraîchit à l'avance les tokens OAuth (YouTube, TikTok, Instagram) qui expirent
+    bientôt et dont les stats seront rafraîchies d'ici là, pour retirer ce
+    rafraîchissement du chemin critique du cron des stats.
+    """
+    from lib.token_refresh import refresh_expiring_tokens as refresh_tokens
+
+    summary = refresh_tokens()
+    for platform, counters in summary.items():
+        if counters['refreshed'] or counters['error']:
+            print(f"🔑 Tokens {platform}: {counters['refreshed']} rafraîchis, {counters['error']} erreurs, "
+                  f"{counters['skipped']} laissés au rafraîchissement à la volée")
+
+
+# ============================================
+# PROFILS - Invalidation du cache
+# ============================================
+
+def _invalidate_cached_profile(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    from lib.profiles import identity_changed, invalidate_profile
+
+    change = event.data
+    before = change.before.to_dict() if change.before is not None and change.before.exists else None
+    after = change.after.to_dict() if change.after is not None and change.after.exists else None
+    # Les mises à jour de stats (profils influenceurs) ne touchent pas l'identité
+    if identity_changed(before, after):
+        invalidate_profile(event.params['uid'])
+
+
+@firestore_fn.on_document_written(document='brands/{uid}')
+def invalidate_brand_profile(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """Retire du cache de l'instance un profil marque créé, modifié ou supprimé."""
+    _invalidate_cached_profile(event)
+
+
+@firestore_fn.on_document_written(document='influencers/{uid}')
+def invalidate_influencer_profile(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """Retire du cache de l'instance un profil influenceur créé, modifié ou supprimé."""
+    _invalidate_cached_profile(event)
+
+
+# ============================================
+# OUTBOX EMAILS - Envoi hors requête
+# ============================================
+
+@firestore_fn.on_document_created(document='mailOutbox/{messageId}')
+def send_outbox_email(event: firestore_fn.Event[firestore_fn.DocumentSnapshot | None]) -> None:
+    """
+    Envoie un email urgent dès son écriture dans l'outbox par un handler.
+    Les notifications regroupables sont laissées au balayage `drain_mail_outbox`.
+    """
+    if event.data is None:
+        return
+
+    from lib.mail_outbox import deliver, is_coalesced
+
+    if is_coalesced(event.data.to_dict() or {}):
+        return
+    deliver(firestore.client(), event.data.reference)
+
+
+@scheduler_fn.on_schedule(schedule="* * * * *", timezone="Europe/Paris", timeout_sec=300)
+def drain_mail_outbox(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Envoie les emails dus de l'outbox chaque minute : notifications regroupées en
+    digest par destinataire et envoyées par lots (endpoint batch de Resend),
+    nouvelles tentatives après une erreur transitoire, envois interrompus ou
+    manqués par le trigger.
+    """
+    from lib.mail_outbox import drain_outbox
+
+    summary = drain_outbox(firestore.client())
+    if summary:
+        print(f"📬 Outbox emails: {summary}")
+
+
+@https_fn.on_request(timeout_sec=540)
+def backfill_connected_platforms_handler(req: https_fn.Request) -> https_fn.Response:
+    """
+    Réservé à l'admin: migration ponctuelle qui remplit `connectedPlatforms`
+    sur les profils existants pour le scan filtré du cron.
+    """
+    options_response = _handle_options(req)
+    if options_response:
+        return options_response
+
+    if req.method != 'POST':
+        return _json_response({'error': 'Méthode non autorisée'}, status=405)
+
+    try:
+        _require_admin(req)
+        from lib.stats_refresh import backfill_connected_platforms
+
+        updated = backfill_connected_platforms(firestore.client())
+        return _json_response({'success': True, 'updated': updated})
+    except AuthorizationError as auth_err:
+        return _json_response({'error': str(auth_err)}, status=auth_err.status)
+    except Exception as exc:
+        print(f'Erreur backfill_connected_platforms_handler: {str(exc)}')
+        return _json_response({'error': str(exc)}, status=500)
+
+
+@https_fn.on_request(timeout_sec=540)
+def migrate_conversation_ids_handler(req: https_fn.Request) -> https_fn.Response:
+    """
+    Réservé à l'admin: migration ponctuelle des conversations vers l'ID
+    déterministe `{brandId}_{influencerId}` (doublons fusionnés, messages copiés).
+    """
+    options_response = _handle_options(req)
+    if options_response:
+        return options_response
+
+    if req.method != 'POST':
+        return _json_response({'error': 'Méthode non autorisée'}, status=405)
+
+    try:
+        _require_admin(req)
+        from lib.conversations import migrate_conversation_ids
+
+        summary = migrate_conversation_ids(firestore.client())
+        return _json_response({'success': summary['failed'] == 0, **summary})
+    except AuthorizationError as auth_err:
+        return _json_response({'error': str(auth_err)}, status=auth_err.status)
+    except Exception as exc:
+        print(f'Erreur migrate_conversation_ids_handler: {str(exc)}')
+        return _json_response({'error': str(exc)}, status=500)
 
 
 # ============================================
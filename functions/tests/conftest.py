@@ -0,0 +1,73 @@
+"""
+Fixtures communes des tests unitaires (lancés depuis `functions/` : python -m pytest)
+L'horloge factice remplace time.monotonic / time.sleep et datetime.now dans les
+modules à logique temporelle : les tests n'attendent jamais réellement.
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PACIFIC = ZoneInfo('America/Los_Angeles')
+
+
+class FakeClock:
+    """Horloge monotone et murale avancées ensemble, à la main ou par sleep()."""
+
+    def __init__(self, wall: datetime):
+        self.mono = 1000.0
+        self.wall = wall
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.mono
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.advance(seconds)
+
+    def advance(self, seconds: float) -> None:
+        self.mono += seconds
+        self.wall += timedelta(seconds=seconds)
+
+    def set_wall(self, wall: datetime) -> None:
+        """Place l'horloge murale à `wall` en avançant l'horloge monotone d'autant."""
+        self.advance((wall - self.wall).total_seconds())
+
+    def patch(self, monkeypatch, module) -> None:
+        clock = self
+
+        class _FakeDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.wall.astimezone(tz) if tz else clock.wall.replace(tzinfo=None)
+
+        monkeypatch.setattr(module, 'time', SimpleNamespace(monotonic=self.monotonic, sleep=self.sleep))
+        if hasattr(module, 'datetime'):
+            monkeypatch.setattr(module, 'datetime', _FakeDatetime)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    from lib import quota, resilience
+
+    fake = FakeClock(datetime(2026, 10, 18, 12, 0, tzinfo=PACIFIC))
+    for module in (quota, resilience):
+        fake.patch(monkeypatch, module)
+    return fake
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Firestore en mémoire ; les transactions s'appliquent immédiatement."""
+    from firebase_admin import firestore
+    from tests.fake_firestore import FakeFirestore, transactional
+
+    monkeypatch.setattr(firestore, 'transactional', transactional)
+    return FakeFirestore()
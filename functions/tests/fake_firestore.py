@@ -0,0 +1,212 @@
+"""
+Firestore en mémoire pour les tests unitaires
+Couvre le sous-ensemble de l'API utilisé par lib/ : documents (get, set, update,
+create, delete), requêtes simples (where ==, <=, in ; order_by ; limit),
+get_all, WriteBatch et transactions appliquées immédiatement (sans concurrence).
+Les sentinelles SERVER_TIMESTAMP, DELETE_FIELD et Increment sont résolues à l'écriture.
+"""
+
+import copy
+import itertools
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1 import transforms
+
+
+def transactional(func):
+    """Remplace firestore.transactional : la fonction reçoit directement la transaction."""
+    return lambda transaction, *args, **kwargs: func(transaction, *args, **kwargs)
+
+
+def _resolve(value, previous=None):
+    if value is transforms.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, transforms.Increment):
+        return (previous or 0) + value.value
+    return copy.deepcopy(value)
+
+
+def _apply(target: dict, path: list[str], value) -> None:
+    for key in path[:-1]:
+        target = target.setdefault(key, {})
+    if value is transforms.DELETE_FIELD:
+        target.pop(path[-1], None)
+    else:
+        target[path[-1]] = _resolve(value, target.get(path[-1]))
+
+
+def _merge(target: dict, data: dict) -> None:
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            _apply(target, [key], value)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocument:
+    def __init__(self, db, collection: str, document_id: str):
+        self._db = db
+        self.id = document_id
+        self.path = f'{collection}/{document_id}'
+        self.parent = SimpleNamespace(id=collection)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocument) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def get(self, transaction=None, field_paths=None):
+        return FakeSnapshot(self, copy.deepcopy(self._db.docs.get(self.path)))
+
+    def set(self, data: dict, merge: bool = False):
+        if merge and self.path in self._db.docs:
+            _merge(self._db.docs[self.path], data)
+        else:
+            document = {}
+            _merge(document, data)
+            self._db.docs[self.path] = document
+
+    def create(self, data: dict):
+        if self.path in self._db.docs:
+            raise AlreadyExists(self.path)
+        self.set(data)
+
+    def update(self, data: dict):
+        if self.path not in self._db.docs:
+            raise NotFound(self.path)
+        for field, value in data.items():
+            _apply(self._db.docs[self.path], field.split('.'), value)
+
+    def delete(self):
+        self._db.docs.pop(self.path, None)
+
+    def collection(self, name: str):
+        return FakeCollection(self._db, f'{self.path}/{name}')
+
+
+class FakeQuery:
+    def __init__(self, db, collection: str, filters=(), order=None, limit=None):
+        self._db = db
+        self._collection = collection
+        self._filters = list(filters)
+        self._order = order
+        self._limit = limit
+
+    def where(self, field, op, value):
+        return FakeQuery(self._db, self._collection, self._filters + [(field, op, value)], self._order, self._limit)
+
+    def order_by(self, field, direction=None):
+        return FakeQuery(self._db, self._collection, self._filters, field, self._limit)
+
+    def limit(self, count: int):
+        return FakeQuery(self._db, self._collection, self._filters, self._order, count)
+
+    @staticmethod
+    def _matches(data: dict, field, op, value) -> bool:
+        if field not in data:
+            return False
+        current = data[field]
+        if op == '==':
+            return current == value
+        if op == '<=':
+            return current <= value
+        if op == '>=':
+            return current >= value
+        if op == 'in':
+            return current in value
+        raise NotImplementedError(op)
+
+    def get(self):
+        prefix = f'{self._collection}/'
+        snapshots = [
+            FakeSnapshot(FakeDocument(self._db, self._collection, path[len(prefix):]), copy.deepcopy(data))
+            for path, data in sorted(self._db.docs.items())
+            if path.startswith(prefix) and '/' not in path[len(prefix):]
+            and all(self._matches(data, *condition) for condition in self._filters)
+        ]
+        if self._order:
+            snapshots = [s for s in snapshots if self._order in s._data]
+            snapshots.sort(key=lambda snapshot: snapshot._data[self._order])
+        return snapshots[:self._limit] if self._limit is not None else snapshots
+
+    def stream(self):
+        return iter(self.get())
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name: str):
+        super().__init__(db, name)
+        self.id = name.rsplit('/', 1)[-1]
+
+    def document(self, document_id: str | None = None):
+        if document_id is None:
+            document_id = f'auto{next(self._db._ids):04d}'
+        return FakeDocument(self._db, self._collection, document_id)
+
+
+class FakeBatch:
+    def __init__(self):
+        self._operations = []
+
+    def set(self, reference, data, merge: bool = False):
+        self._operations.append(lambda: reference.set(data, merge=merge))
+
+    def update(self, reference, data):
+        self._operations.append(lambda: reference.update(data))
+
+    def commit(self):
+        for operation in self._operations:
+            operation()
+
+
+class FakeTransaction:
+    def get_all(self, references):
+        return [reference.get() for reference in references]
+
+    def set(self, reference, data, merge: bool = False):
+        reference.set(data, merge=merge)
+
+    def update(self, reference, data):
+        reference.update(data)
+
+    def create(self, reference, data):
+        reference.create(data)
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.docs = {}
+        self._ids = itertools.count()
+
+    def collection(self, name: str):
+        return FakeCollection(self, name)
+
+    def document(self, path: str):
+        collection, document_id = path.rsplit('/', 1)
+        return FakeDocument(self, collection, document_id)
+
+    def get_all(self, references, field_paths=None):
+        return [reference.get() for reference in references]
+
+    def batch(self):
+        return FakeBatch()
+
+    def transaction(self):
+        return FakeTransaction()
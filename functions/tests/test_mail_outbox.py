@@ -0,0 +1,170 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from lib import mail_outbox, notifications
+from lib.mail_outbox import MAIL_COALESCE_WINDOW_SECONDS, deliver, drain_outbox, enqueue_email
+
+
+class FakeResend:
+    """
+    Resend factice : un envoi est délivré une seule fois par clé d'idempotence,
+    et le prochain appel peut échouer après la livraison (timeout ambigu).
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.delivered = {}
+        self.fail_after_delivery = 0
+
+    def post(self, url, payload, idempotency_key=None):
+        self.calls.append((url, payload, idempotency_key))
+        if idempotency_key not in self.delivered:
+            self.delivered[idempotency_key] = payload if isinstance(payload, list) else [payload]
+        if self.fail_after_delivery:
+            self.fail_after_delivery -= 1
+            return {'success': False, 'retryable': True, 'error': 'Read timed out'}
+        return {'success': True, 'status_code': 200}
+
+    def emails_to(self, recipient: str) -> list[dict]:
+        return [
+            email for emails in self.delivered.values() for email in emails
+            if recipient in email['to']
+        ]
+
+
+@pytest.fixture
+def resend(monkeypatch):
+    fake = FakeResend()
+    monkeypatch.setattr(notifications, '_post_to_resend', fake.post)
+    return fake
+
+
+@pytest.fixture
+def now(monkeypatch):
+    current = [datetime(2026, 10, 18, 12, 0, tzinfo=timezone.utc)]
+    monkeypatch.setattr(mail_outbox, '_now', lambda: current[0])
+
+    class _Clock:
+        def advance(self, seconds: float) -> None:
+            current[0] += timedelta(seconds=seconds)
+
+    return _Clock()
+
+
+def _request(to: str, brand: str) -> dict:
+    return notifications._notification(
+        'collaboration_request', to, f'{brand} souhaite collaborer avec vous !',
+        '📩 Nouvelle demande de collaboration', f'<p>{brand}</p>', 'https://collabzz.test/messages', 'Voir'
+    )
+
+
+def _status(db, reference) -> dict:
+    return reference.get().to_dict()
+
+
+def test_notifications_wait_for_the_coalescing_window(db, resend, now):
+    enqueue_email(db, _request('ana@example.com', 'Brand A'))
+
+    now.advance(MAIL_COALESCE_WINDOW_SECONDS - 1)
+    assert drain_outbox(db) == {}
+    assert resend.calls == []
+
+
+def test_urgent_email_is_sent_once_by_trigger_and_drain(db, resend, now):
+    message = notifications._notification('verification_code', 'ana@example.com', 'Code', 'Code', '<p>123456</p>')
+    reference = enqueue_email(db, message)
+
+    assert deliver(db, reference) == 'sent'
+    assert deliver(db, reference) is None
+    assert drain_outbox(db) == {}
+    assert len(resend.calls) == 1
+
+
+def test_burst_to_one_recipient_becomes_a_single_digest(db, resend, now):
+    first = enqueue_email(db, _request('ana@example.com', 'Brand A'))
+    now.advance(50)
+    second = enqueue_email(db, _request('ana@example.com', 'Brand B'))
+    other = enqueue_email(db, _request('bob@example.com', 'Brand C'))
+
+    # La fenêtre d'ana se ferme avec sa première notification
+    now.advance(MAIL_COALESCE_WINDOW_SECONDS - 50)
+    summary = drain_outbox(db)
+
+    assert summary == {'sent': 2, 'coalesced': 1}
+    assert len(resend.calls) == 1
+    digest = resend.emails_to('ana@example.com')
+    assert len(digest) == 1
+    assert digest[0]['subject'] == '2 nouvelles demandes de collaboration'
+    assert 'Brand A' in digest[0]['html'] and 'Brand B' in digest[0]['html']
+    for reference in (first, second):
+        assert _status(db, reference)['status'] == 'sent'
+    # La notification de bob, créée plus tard, attend sa propre fenêtre
+    assert _status(db, other)['status'] == 'pending'
+
+    now.advance(MAIL_COALESCE_WINDOW_SECONDS)
+    drain_outbox(db)
+    assert _status(db, other)['status'] == 'sent'
+    assert len(resend.emails_to('bob@example.com')) == 1
+
+
+def test_recipients_due_together_share_one_batch_call(db, resend, now):
+    enqueue_email(db, _request('ana@example.com', 'Brand A'))
+    enqueue_email(db, _request('ana@example.com', 'Brand B'))
+    enqueue_email(db, _request('bob@example.com', 'Brand C'))
+
+    now.advance(MAIL_COALESCE_WINDOW_SECONDS)
+    assert drain_outbox(db) == {'sent': 3, 'coalesced': 1}
+
+    assert len(resend.calls) == 1
+    url, payload, key = resend.calls[0]
+    assert url == notifications.RESEND_BATCH_URL
+    assert len(payload) == 2
+    assert key.startswith('mailOutbox/batch/')
+
+
+def test_ambiguous_batch_failure_replays_the_same_plan_without_double_send(db, resend, now):
+    first = enqueue_email(db, _request('ana@example.com', 'Brand A'))
+    second = enqueue_email(db, _request('ana@example.com', 'Brand B'))
+    other = enqueue_email(db, _request('bob@example.com', 'Brand C'))
+
+    now.advance(MAIL_COALESCE_WINDOW_SECONDS)
+    resend.fail_after_delivery = 1
+    assert drain_outbox(db) == {'pending': 3, 'coalesced': 1}
+    plan_id = _status(db, first)['sendPlan']
+    assert _status(db, second)['sendPlan'] == plan_id == _status(db, other)['sendPlan']
+
+    # Une nouvelle notification pour ana arrive avant la nouvelle tentative
+    late = enqueue_email(db, _request('ana@example.com', 'Brand D'))
+    now.advance(max(mail_outbox.MAIL_RETRY_BASE_SECONDS, MAIL_COALESCE_WINDOW_SECONDS))
+    assert drain_outbox(db) == {'sent': 4}
+
+    batch_keys = [key for url, _, key in resend.calls if url == notifications.RESEND_BATCH_URL]
+    assert len(batch_keys) == 2 and batch_keys[0] == batch_keys[1]
+    replayed = [payload for url, payload, _ in resend.calls if url == notifications.RESEND_BATCH_URL]
+    assert replayed[0] == replayed[1]
+
+    # Livrés une seule fois : le digest initial (sans Brand D), puis Brand D seule
+    ana = resend.emails_to('ana@example.com')
+    assert len(ana) == 2
+    assert 'Brand D' not in ana[0]['html'] and 'Brand D' in ana[1]['html']
+    assert len(resend.emails_to('bob@example.com')) == 1
+    for reference in (first, second, other, late):
+        assert _status(db, reference)['status'] == 'sent'
+
+
+def test_replay_from_a_partial_claim_records_only_its_members(db, resend, now):
+    first = enqueue_email(db, _request('ana@example.com', 'Brand A'))
+    other = enqueue_email(db, _request('bob@example.com', 'Brand C'))
+    now.advance(MAIL_COALESCE_WINDOW_SECONDS)
+    resend.fail_after_delivery = 1
+    drain_outbox(db)
+
+    # Le message de bob est encore réservé par un autre passage
+    other.update({'status': 'sending', 'nextAttemptAt': mail_outbox._now() + timedelta(hours=1)})
+    now.advance(mail_outbox.MAIL_RETRY_BASE_SECONDS)
+    assert drain_outbox(db) == {'sent': 1}
+
+    assert _status(db, first)['status'] == 'sent'
+    assert _status(db, other)['status'] == 'sending'
+    assert len(resend.emails_to('bob@example.com')) == 1
@@ -0,0 +1,128 @@
+from datetime import datetime
+
+import pytest
+
+from lib.quota import QUOTA_BACKOFF_SECONDS, QuotaExceededError, QuotaGovernor
+from tests.conftest import PACIFIC
+
+
+def test_burst_then_refill_at_rate(clock):
+    governor = QuotaGovernor('test', rate=2, burst=4)
+
+    for _ in range(4):
+        governor.acquire()
+    assert clock.sleeps == []
+
+    # Seau vide : un jeton revient toutes les 0,5 s
+    governor.acquire()
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+    clock.advance(10)
+    for _ in range(4):
+        governor.acquire()
+    # Le seau ne dépasse jamais la rafale
+    assert len(clock.sleeps) == 1
+
+
+def test_acquire_rejects_beyond_max_wait_without_sleeping(clock):
+    governor = QuotaGovernor('test', rate=1, burst=1)
+    governor.acquire()
+
+    with pytest.raises(QuotaExceededError):
+        governor.acquire(max_wait=0.5)
+    assert clock.sleeps == []
+
+    governor.acquire(max_wait=1)
+    assert clock.sleeps == [pytest.approx(1)]
+
+
+def test_throttle_pauses_halves_rate_and_recovers(clock):
+    governor = QuotaGovernor('test', rate=10, burst=10)
+    governor.on_throttled()
+
+    assert governor.rate == pytest.approx(5)
+    with pytest.raises(QuotaExceededError):
+        governor.acquire(max_wait=QUOTA_BACKOFF_SECONDS / 2)
+    governor.acquire(max_wait=QUOTA_BACKOFF_SECONDS + 1)
+    assert sum(clock.sleeps) >= QUOTA_BACKOFF_SECONDS
+
+    # Deuxième rejet consécutif : backoff doublé, débit encore divisé par deux
+    start = clock.mono
+    governor.on_throttled()
+    assert governor.rate == pytest.approx(2.5)
+    governor.acquire(max_wait=4 * QUOTA_BACKOFF_SECONDS)
+    assert clock.mono - start >= 2 * QUOTA_BACKOFF_SECONDS
+
+    # Remontée progressive (+5 % du débit de base par succès), bornée au débit de base
+    governor.on_success()
+    assert governor.rate == pytest.approx(3)
+    for _ in range(50):
+        governor.on_success()
+    assert governor.rate == pytest.approx(10)
+
+    # Compteur de rejets remis à zéro : le prochain backoff repart du minimum
+    start = clock.mono
+    governor.on_throttled()
+    governor.acquire(max_wait=4 * QUOTA_BACKOFF_SECONDS)
+    assert clock.mono - start == pytest.approx(QUOTA_BACKOFF_SECONDS)
+
+
+def test_throttle_rate_never_drops_below_a_sixteenth(clock):
+    governor = QuotaGovernor('test', rate=16, burst=1)
+    for _ in range(10):
+        governor.on_throttled()
+    assert governor.rate == pytest.approx(1)
+
+
+def test_daily_budget_is_paced_over_the_day(clock):
+    clock.set_wall(datetime(2026, 10, 19, 6, 0, tzinfo=PACIFIC))
+    governor = QuotaGovernor('test', rate=1000, burst=1000, daily_units=1000)
+
+    # 06:00 : 25 % de la journée + 10 % de marge = 350 unités
+    governor.acquire(300)
+    with pytest.raises(QuotaExceededError):
+        governor.acquire(100)
+    governor.acquire(50)
+
+    clock.advance(6 * 3600)
+    # 12:00 : 600 unités autorisées
+    governor.acquire(250)
+    with pytest.raises(QuotaExceededError):
+        governor.acquire(1)
+
+
+def test_record_usage_counts_against_the_budget(clock):
+    clock.set_wall(datetime(2026, 10, 19, 6, 0, tzinfo=PACIFIC))
+    governor = QuotaGovernor('test', rate=1000, burst=1000, daily_units=1000)
+
+    governor.acquire(300)
+    governor.record_usage(50)
+    with pytest.raises(QuotaExceededError):
+        governor.acquire(1)
+
+
+def test_budget_resets_at_the_quota_day_rollover(clock):
+    clock.set_wall(datetime(2026, 10, 18, 23, 0, tzinfo=PACIFIC))
+    governor = QuotaGovernor('test', rate=1000, burst=1000, daily_units=1000)
+    governor._ledger_units = 200  # Unités des autres instances lues dans le registre
+
+    governor.acquire(800)
+    with pytest.raises(QuotaExceededError):
+        governor.acquire(1)
+
+    # 01:00 le lendemain (heure du Pacifique) : nouveau budget, lissé depuis minuit
+    clock.advance(2 * 3600)
+    governor.acquire(100)
+    with pytest.raises(QuotaExceededError):
+        governor.acquire(50)
+
+
+def test_exhausted_blocks_until_reset(clock):
+    clock.set_wall(datetime(2026, 10, 18, 22, 0, tzinfo=PACIFIC))
+    governor = QuotaGovernor('test', rate=10, burst=10)
+    governor.on_exhausted()
+
+    with pytest.raises(QuotaExceededError):
+        governor.acquire()
+    clock.advance(2 * 3600)
+    governor.acquire()
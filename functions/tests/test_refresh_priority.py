@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from lib.refresh_priority import (
+    REFRESH_DEMAND_INTERVAL_MINUTES,
+    REFRESH_MAX_INTERVAL_MINUTES,
+    REFRESH_MIN_INTERVAL_MINUTES,
+    next_state,
+    refresh_priority,
+)
+
+NOW = datetime(2026, 10, 18, 12, 0, tzinfo=timezone.utc)
+
+
+def _minutes_until_next(state: dict) -> float:
+    return (state['nextRefreshAt'] - NOW).total_seconds() / 60
+
+
+def test_never_scheduled_account_is_due_first():
+    assert refresh_priority({}, 'youtube', NOW) == float('inf')
+    # Planifié sur une autre plateforme seulement
+    other = {'tiktok': {'nextRefreshAt': NOW + timedelta(hours=1)}}
+    assert refresh_priority(other, 'youtube', NOW) == float('inf')
+
+
+def test_account_not_yet_due_is_skipped():
+    schedule = {'youtube': {'lastRefreshAt': NOW - timedelta(hours=1), 'nextRefreshAt': NOW + timedelta(minutes=1)}}
+    assert refresh_priority(schedule, 'youtube', NOW) is None
+
+
+def test_lateness_is_relative_to_the_planned_interval():
+    small = {'youtube': {'lastRefreshAt': NOW - timedelta(hours=13), 'nextRefreshAt': NOW - timedelta(hours=1)}}
+    large = {'youtube': {'lastRefreshAt': NOW - timedelta(hours=2), 'nextRefreshAt': NOW - timedelta(hours=1)}}
+    exactly_due = {'youtube': {'lastRefreshAt': NOW - timedelta(hours=1), 'nextRefreshAt': NOW}}
+
+    assert refresh_priority(exactly_due, 'youtube', NOW) == 0
+    assert refresh_priority(large, 'youtube', NOW) > refresh_priority(small, 'youtube', NOW) > 0
+
+
+def test_active_demand_brings_the_next_refresh_forward():
+    state = {
+        'lastRefreshAt': NOW - timedelta(minutes=REFRESH_DEMAND_INTERVAL_MINUTES + 1),
+        'nextRefreshAt': NOW + timedelta(hours=6)
+    }
+    assert refresh_priority({'youtube': state}, 'youtube', NOW) is None
+
+    boosted = {'youtube': state, 'demandUntil': NOW + timedelta(hours=1)}
+    assert refresh_priority(boosted, 'youtube', NOW) > 0
+
+    expired = {'youtube': state, 'demandUntil': NOW - timedelta(seconds=1)}
+    assert refresh_priority(expired, 'youtube', NOW) is None
+
+
+def test_active_demand_respects_the_demand_interval():
+    state = {'lastRefreshAt': NOW - timedelta(minutes=5), 'nextRefreshAt': NOW + timedelta(hours=6)}
+    boosted = {'youtube': state, 'demandUntil': NOW + timedelta(hours=1)}
+    assert refresh_priority(boosted, 'youtube', NOW) is None
+
+
+def test_active_demand_on_a_never_refreshed_account_is_due():
+    boosted = {'demandUntil': NOW + timedelta(hours=1)}
+    assert refresh_priority(boosted, 'youtube', NOW) is not None
+
+
+def test_error_backoff_doubles_and_is_capped():
+    state = {}
+    delays = []
+    for _ in range(12):
+        state = next_state(state, {'success': False, 'error': 'boom'}, now=NOW)
+        delays.append(_minutes_until_next(state))
+
+    assert delays[0] == REFRESH_MIN_INTERVAL_MINUTES
+    assert delays[1] == 2 * REFRESH_MIN_INTERVAL_MINUTES
+    assert all(later >= earlier for earlier, later in zip(delays, delays[1:]))
+    assert delays[-1] == REFRESH_MAX_INTERVAL_MINUTES
+    assert state['errorCount'] == 12
+
+
+def test_success_clears_the_error_count():
+    state = next_state({}, {'success': False}, now=NOW)
+    state = next_state(state, {'success': True, 'followers': 10}, now=NOW)
+    assert state['errorCount'] == 0
+
+
+@pytest.mark.parametrize('changed, bound', [(True, 1.0), (False, 0.0)])
+def test_volatility_ewma_stays_within_bounds(changed, bound):
+    state = {}
+    for _ in range(100):
+        state = next_state(state, {'success': True, 'followers': 5000, 'changed': changed}, now=NOW)
+        assert 0.0 <= state['volatility'] <= 1.0
+        assert REFRESH_MIN_INTERVAL_MINUTES <= _minutes_until_next(state) <= REFRESH_MAX_INTERVAL_MINUTES
+    assert state['volatility'] == pytest.approx(bound, abs=1e-3)
+
+
+def test_volatile_accounts_are_refreshed_more_often():
+    steady = volatile = {}
+    for _ in range(20):
+        steady = next_state(steady, {'success': True, 'followers': 5000, 'changed': False}, now=NOW)
+        volatile = next_state(volatile, {'success': True, 'followers': 5000, 'changed': True}, now=NOW)
+    assert _minutes_until_next(volatile) < _minutes_until_next(steady)
+
+
+def test_larger_accounts_are_refreshed_more_often():
+    small = next_state({}, {'success': True, 'followers': 100}, now=NOW)
+    large = next_state({}, {'success': True, 'subscribers': 2_000_000}, now=NOW)
+    assert _minutes_until_next(large) < _minutes_until_next(small)
+
+
+def test_demand_caps_the_interval():
+    state = next_state({}, {'success': True, 'followers': 10, 'changed': False}, demand=True, now=NOW)
+    assert _minutes_until_next(state) == max(REFRESH_MIN_INTERVAL_MINUTES, REFRESH_DEMAND_INTERVAL_MINUTES)
+
+
+def test_unknown_follower_count_keeps_the_previous_one():
+    state = next_state({'followers': 250_000}, {'success': True}, now=NOW)
+    assert state['followers'] == 250_000
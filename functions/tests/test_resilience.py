@@ -0,0 +1,175 @@
+import pytest
+import requests
+
+from lib import http_client, resilience
+from lib.resilience import CircuitBreaker, CircuitOpenError, RETRY_ATTEMPTS, call_with_retries
+
+
+class TransientError(Exception):
+    pass
+
+
+def _is_transient(exc) -> bool:
+    return isinstance(exc, TransientError)
+
+
+def _failing(calls: list, error: BaseException):
+    def _call():
+        calls.append(1)
+        raise error
+    return _call
+
+
+def test_breaker_opens_after_threshold_consecutive_failures(clock):
+    breaker = CircuitBreaker('api.test', failure_threshold=3, reset_seconds=10)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    # Un succès remet le compteur à zéro : 2 échecs consécutifs seulement
+    assert breaker.state == 'closed'
+    breaker.before_call()
+
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_half_open_allows_a_single_probe(clock):
+    breaker = CircuitBreaker('api.test', failure_threshold=1, reset_seconds=10)
+    breaker.record_failure()
+
+    clock.advance(9.9)
+    assert breaker.state == 'open'
+    clock.advance(0.1)
+    assert breaker.state == 'half_open'
+
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_failed_probe_reopens_for_a_full_period(clock):
+    breaker = CircuitBreaker('api.test', failure_threshold=5, reset_seconds=10)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.advance(10)
+
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    clock.advance(9)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock.advance(1)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.before_call()
+    breaker.before_call()
+
+
+def test_cancelled_probe_frees_the_half_open_slot(clock):
+    breaker = CircuitBreaker('api.test', failure_threshold=1, reset_seconds=10)
+    breaker.record_failure()
+    clock.advance(10)
+
+    breaker.before_call()
+    breaker.cancel_call()
+    assert breaker.state == 'half_open'
+    breaker.before_call()
+
+
+def test_transient_errors_are_retried_then_raised(clock):
+    breaker = CircuitBreaker('api.test', failure_threshold=100)
+    calls = []
+
+    with pytest.raises(TransientError):
+        call_with_retries(_failing(calls, TransientError()), breaker=breaker,
+                          retries=2, is_transient=_is_transient)
+    assert len(calls) == 3
+    assert breaker._failures == 3
+    assert len(clock.sleeps) == 2
+
+
+def test_non_transient_error_is_not_retried_and_releases_the_probe(clock):
+    breaker = CircuitBreaker('api.test', failure_threshold=1, reset_seconds=10)
+    breaker.record_failure()
+    clock.advance(10)
+    calls = []
+
+    with pytest.raises(ValueError):
+        call_with_retries(_failing(calls, ValueError()), breaker=breaker,
+                          retries=2, is_transient=_is_transient)
+    assert len(calls) == 1
+    # Issue inconnue : ni succès ni échec, l'essai suivant reste possible
+    assert breaker.state == 'half_open'
+    breaker.before_call()
+
+
+def test_interrupt_releases_the_probe(clock):
+    breaker = CircuitBreaker('api.test', failure_threshold=1, reset_seconds=10)
+    breaker.record_failure()
+    clock.advance(10)
+
+    with pytest.raises(KeyboardInterrupt):
+        call_with_retries(_failing([], KeyboardInterrupt()), breaker=breaker, is_transient=_is_transient)
+    breaker.before_call()
+
+
+def test_retry_succeeds_after_a_transient_failure(clock):
+    breaker = CircuitBreaker('api.test', failure_threshold=2)
+    outcomes = [TransientError(), 'ok']
+
+    def _call():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert call_with_retries(_call, breaker=breaker, retries=2, is_transient=_is_transient) == 'ok'
+    assert breaker._failures == 0
+
+
+class _TimeoutSession:
+    def __init__(self):
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(method)
+        raise requests.Timeout('timeout')
+
+
+@pytest.fixture
+def timeout_session(monkeypatch, clock):
+    session = _TimeoutSession()
+    monkeypatch.setattr(http_client, 'get_session', lambda: session)
+    monkeypatch.setattr(http_client, 'backoff_delay', lambda attempt: 0)
+    monkeypatch.setattr(resilience, '_breakers', {})
+    return session
+
+
+def test_idempotent_requests_are_retried(timeout_session):
+    with pytest.raises(requests.Timeout):
+        http_client.get('https://api.test/resource')
+    assert len(timeout_session.calls) == RETRY_ATTEMPTS + 1
+
+
+def test_non_idempotent_requests_are_sent_once(timeout_session):
+    with pytest.raises(requests.Timeout):
+        http_client.post('https://api.test/resource')
+    assert len(timeout_session.calls) == 1
+
+
+def test_idempotency_can_be_overridden(timeout_session):
+    with pytest.raises(requests.Timeout):
+        http_client.get('https://api.test/oauth', idempotent=False)
+    assert len(timeout_session.calls) == 1
+
+    with pytest.raises(requests.Timeout):
+        http_client.post('https://api.test/search', idempotent=True)
+    assert len(timeout_session.calls) == 1 + RETRY_ATTEMPTS + 1
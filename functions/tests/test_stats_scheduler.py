@@ -0,0 +1,53 @@
+import string
+
+import pytest
+
+from lib.stats_scheduler import shard_bounds
+
+ID_CHARACTERS = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+
+def _owners(bounds, user_id: str) -> list[int]:
+    return [
+        index for index, (start, end) in enumerate(bounds)
+        if (start is None or user_id >= start) and (end is None or user_id < end)
+    ]
+
+
+@pytest.mark.parametrize('shard_count', [1, 2, 3, 7, 8, 16, 61, 62, 63, 100])
+def test_shards_are_contiguous_and_unbounded_at_both_ends(shard_count):
+    bounds = shard_bounds(shard_count)
+
+    assert bounds[0][0] is None
+    assert bounds[-1][1] is None
+    for (_, end), (start, _) in zip(bounds, bounds[1:]):
+        assert end == start
+    starts = [start for start, _ in bounds[1:]]
+    assert starts == sorted(set(starts))
+
+
+@pytest.mark.parametrize('shard_count', [1, 2, 3, 7, 8, 16, 61, 62, 63, 100])
+def test_every_id_belongs_to_exactly_one_shard(shard_count):
+    bounds = shard_bounds(shard_count)
+
+    # Chaque premier caractère possible, avec le plus petit et un grand suffixe,
+    # plus des caractères hors alphabet (tri avant les chiffres / après les minuscules)
+    user_ids = ['', '-x', '_x', '~x', '￿']
+    for character in ID_CHARACTERS:
+        user_ids += [character, character + '0', character + 'zzzzzzzz']
+    for user_id in user_ids:
+        assert len(_owners(bounds, user_id)) == 1, user_id
+
+
+def test_shard_count_is_clamped_to_the_alphabet():
+    assert len(shard_bounds(0)) == 1
+    assert len(shard_bounds(100)) == len(ID_CHARACTERS)
+    assert all(start != end for start, end in shard_bounds(100))
+
+
+def test_default_shards_spread_first_characters_evenly():
+    bounds = shard_bounds(8)
+    sizes = [0] * len(bounds)
+    for character in ID_CHARACTERS:
+        sizes[_owners(bounds, character)[0]] += 1
+    assert max(sizes) - min(sizes) <= 1
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from lib.stripe_events import apply_stripe_event, process_stored_event, record_stripe_event
+
+
+def _event(event_id: str, event_type: str, created: int, session_id: str = 'cs_1') -> dict:
+    return {
+        'id': event_id,
+        'type': event_type,
+        'created': created,
+        'data': {'object': {'id': session_id, 'payment_intent': 'pi_1'}}
+    }
+
+
+@pytest.fixture
+def checkout(db):
+    db.document('paymentSessions/cs_1').set({
+        'brandId': 'brand_1',
+        'collaborationIds': ['collab_1', 'collab_2'],
+        'status': 'created'
+    })
+    for collab_id in ('collab_1', 'collab_2'):
+        db.document(f'collaborations/{collab_id}').set({'status': 'accepted', 'paymentStatus': 'not_requested'})
+    return db
+
+
+def _doc(db, path: str) -> dict:
+    return db.document(path).get().to_dict()
+
+
+def test_completed_event_updates_session_and_collaborations(checkout):
+    assert apply_stripe_event(checkout, _event('evt_1', 'checkout.session.completed', 100)) == 'applied'
+
+    assert _doc(checkout, 'paymentSessions/cs_1')['status'] == 'paid'
+    assert _doc(checkout, 'paymentSessions/cs_1')['lastStripeEventCreated'] == 100
+    for collab_id in ('collab_1', 'collab_2'):
+        assert _doc(checkout, f'collaborations/{collab_id}')['paymentStatus'] == 'funds_held'
+    assert _doc(checkout, 'stripeEvents/evt_1')['status'] == 'processed'
+
+
+def test_event_delivered_twice_is_applied_once(checkout):
+    event = _event('evt_1', 'checkout.session.completed', 100)
+    assert apply_stripe_event(checkout, event) == 'applied'
+
+    # La collaboration avance entre les deux livraisons
+    checkout.document('collaborations/collab_1').update({'status': 'in_progress'})
+    assert apply_stripe_event(checkout, event) == 'duplicate'
+
+    assert _doc(checkout, 'collaborations/collab_1')['status'] == 'in_progress'
+
+
+def test_older_event_after_a_newer_one_is_superseded(checkout):
+    assert apply_stripe_event(checkout, _event('evt_2', 'checkout.session.expired', 200)) == 'applied'
+    assert apply_stripe_event(checkout, _event('evt_1', 'checkout.session.completed', 100)) == 'superseded'
+
+    session = _doc(checkout, 'paymentSessions/cs_1')
+    assert session['status'] == 'expired'
+    assert session['lastStripeEventCreated'] == 200
+    assert _doc(checkout, 'collaborations/collab_1')['paymentStatus'] == 'not_requested'
+    # Consigné comme traité : une relivraison ne coûte qu'une lecture
+    assert _doc(checkout, 'stripeEvents/evt_1')['outcome'] == 'superseded'
+    assert apply_stripe_event(checkout, _event('evt_1', 'checkout.session.completed', 100)) == 'duplicate'
+
+
+def test_newer_event_after_an_older_one_is_applied(checkout):
+    assert apply_stripe_event(checkout, _event('evt_1', 'checkout.session.completed', 100)) == 'applied'
+    assert apply_stripe_event(checkout, _event('evt_2', 'checkout.session.expired', 200)) == 'applied'
+    assert _doc(checkout, 'paymentSessions/cs_1')['status'] == 'expired'
+
+
+def test_unrelated_event_is_recorded_without_side_effects(checkout):
+    event = {'id': 'evt_3', 'type': 'customer.created', 'created': 300, 'data': {'object': {'id': 'cus_1'}}}
+    assert apply_stripe_event(checkout, event) == 'applied'
+    assert _doc(checkout, 'paymentSessions/cs_1')['status'] == 'created'
+    assert _doc(checkout, 'stripeEvents/evt_3')['status'] == 'processed'
+
+
+def test_redelivered_webhook_is_only_queued_until_processed(checkout):
+    event = _event('evt_1', 'checkout.session.completed', 100)
+    payload = json.dumps(event).encode('utf-8')
+
+    assert record_stripe_event(checkout, event, payload) is True
+    # Relivré avant traitement : à planifier de nouveau (la tâche précédente a pu échouer)
+    assert record_stripe_event(checkout, event, payload) is True
+
+    assert process_stored_event(checkout, 'evt_1') == 'applied'
+    assert process_stored_event(checkout, 'evt_1') == 'duplicate'
+    assert record_stripe_event(checkout, event, payload) is False
+
+
+def test_missing_stored_event_is_ignored(checkout):
+    assert process_stored_event(checkout, 'evt_unknown') is None
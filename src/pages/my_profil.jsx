@@ -1,7 +1,7 @@
 import React, { useState, useEffect, useMemo, useRef } from 'react'
 import { useNavigate, useLocation } from 'react-router-dom'
 import { useAuth } from '../context/AuthContext'
-import { doc, updateDoc, setDoc, getDoc, collection, query, where, getDocs, orderBy, serverTimestamp } from 'firebase/firestore'
+import { doc, updateDoc, setDoc, getDoc, collection, query, where, getDocs, orderBy, serverTimestamp, arrayRemove } from 'firebase/firestore'
 import {
     db,
     TIKTOK_CONNECT_URL,
@@ -748,6 +748,7 @@ const MyProfile = () => {
             
             await updateDoc(doc(db, 'influencers', currentUser.uid), {
                 socialAccounts: updatedAccounts,
+                connectedPlatforms: arrayRemove(platform),
                 [`tokens.${platform}`]: null
             })
             